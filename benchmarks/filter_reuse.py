@@ -0,0 +1,75 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import click
+import numpy as np
+import SimpleITK as sitk
+
+from tomaat.extras import (
+    TransformChain,
+    FromSITKUint8ToSITKFloat32,
+    FromSITKOriginalIntensitiesToRescaledIntensities,
+    FromSITKOriginalResolutionToStandardResolution,
+    FromSITKStandardResolutionToOriginalResolution,
+    FromSITKRescaledIntensitiesToOriginalIntensities,
+)
+
+
+'''
+Cost of building SimpleITK filters on every call for small volumes, where it is a sizeable fraction of the total.
+
+"fresh" builds new transforms, and therefore new filters, for every request, as the transforms used to do.
+"cached" reuses the same transforms, whose filters are kept across requests.
+'''
+
+
+def make_chain():
+    return TransformChain([
+        FromSITKUint8ToSITKFloat32(fields=['images']),
+        FromSITKOriginalIntensitiesToRescaledIntensities(fields=['images']),
+        FromSITKOriginalResolutionToStandardResolution(fields=['images'], resolution=[1.5, 1.5, 1.5]),
+        FromSITKStandardResolutionToOriginalResolution(fields=['images']),
+        FromSITKRescaledIntensitiesToOriginalIntensities(fields=['images']),
+    ])
+
+
+def make_volume(size):
+    volume = sitk.GetImageFromArray((np.random.rand(size, size, size) * 255).astype(np.uint8))
+    volume.SetSpacing([1., 1., 1.])
+
+    return volume
+
+
+def measure(requests, volume, fresh):
+    chain = make_chain()
+
+    start = time.time()
+
+    for _ in range(requests):
+        if fresh:
+            chain = make_chain()
+        chain({'images': [volume]})
+
+    return requests / (time.time() - start)
+
+
+@click.command()
+@click.option('--requests', default=500, help='number of requests')
+@click.option('--sizes', default='8,16,32,64', help='comma separated edges of the cubic test volumes')
+def benchmark(requests, sizes):
+    print('{:>8} {:>16} {:>16}'.format('size', 'fresh req/s', 'cached req/s'))
+
+    for size in [int(s) for s in sizes.split(',')]:
+        volume = make_volume(size)
+
+        fresh = measure(requests, volume, fresh=True)
+        cached = measure(requests, volume, fresh=False)
+
+        print('{:>8} {:>16.1f} {:>16.1f}'.format(size, fresh, cached))
+
+
+if __name__ == '__main__':
+    benchmark()
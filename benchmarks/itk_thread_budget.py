@@ -0,0 +1,77 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import time
+
+import click
+import numpy as np
+import SimpleITK as sitk
+
+from tomaat.extras import (
+    TransformChain,
+    ThreadBudget,
+    FromSITKUint8ToSITKFloat32,
+    FromSITKOriginalResolutionToStandardResolution,
+)
+
+
+'''
+Aggregate throughput of concurrent pre-processing pipelines with and without a ThreadBudget.
+
+Without a budget every SimpleITK filter uses all the cores, so that N concurrent pipelines run up to N times as many
+threads as there are cores. With a budget the cores are split among the running pipelines.
+'''
+
+
+def make_volume(size):
+    return sitk.GetImageFromArray((np.random.rand(size, size, size) * 255).astype(np.uint8))
+
+
+def run(concurrency, requests_per_worker, size, thread_budget):
+    chain = TransformChain(
+        [
+            FromSITKUint8ToSITKFloat32(fields=['images']),
+            FromSITKOriginalResolutionToStandardResolution(fields=['images'], resolution=[0.7, 0.7, 0.7]),
+        ],
+        thread_budget=thread_budget
+    )
+
+    volume = make_volume(size)
+
+    def worker():
+        for _ in range(requests_per_worker):
+            chain({'images': [volume]})
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+
+    start = time.time()
+
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    elapsed = time.time() - start
+
+    return concurrency * requests_per_worker / elapsed
+
+
+@click.command()
+@click.option('--concurrency', default='1,2,4,8', help='comma separated numbers of concurrent pipelines')
+@click.option('--requests', 'requests_per_worker', default=5, help='requests processed by each pipeline')
+@click.option('--size', default=128, help='edge of the cubic test volume')
+def benchmark(concurrency, requests_per_worker, size):
+    print('cores: {}'.format(ThreadBudget().total_threads))
+    print('{:>12} {:>18} {:>18}'.format('pipelines', 'default req/s', 'budget req/s'))
+
+    for c in [int(c) for c in concurrency.split(',')]:
+        default = run(c, requests_per_worker, size, None)
+        budget = run(c, requests_per_worker, size, ThreadBudget())
+
+        print('{:>12} {:>18.2f} {:>18.2f}'.format(c, default, budget))
+
+
+if __name__ == '__main__':
+    benchmark()
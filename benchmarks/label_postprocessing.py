@@ -0,0 +1,65 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import click
+import numpy as np
+
+from tomaat.extras import (
+    LargestConnectedComponent,
+    RemoveSmallComponents,
+    FillHoles,
+    MorphologicalOpening,
+    MorphologicalClosing,
+)
+
+
+'''
+Time taken by the label map clean-up transforms on a synthetic segmentation: a few large blobs per label plus noise.
+'''
+
+
+def make_label_map(size, labels):
+    label_map = np.zeros((size, size, size), dtype=np.uint8)
+
+    grid = np.ogrid[:size, :size, :size]
+    rng = np.random.RandomState(0)
+
+    for label in range(1, labels + 1):
+        centre = rng.randint(size // 4, 3 * size // 4, size=3)
+        radius = size // 6
+        ball = sum((g - c) ** 2 for g, c in zip(grid, centre)) < radius ** 2
+        label_map[ball & (label_map == 0)] = label
+
+    noise = rng.rand(size, size, size) < 0.001
+    label_map[noise] = rng.randint(1, labels + 1, size=int(noise.sum()))
+
+    return label_map
+
+
+@click.command()
+@click.option('--size', default=512, help='edge of the cubic label map')
+@click.option('--labels', default=3, help='number of labels')
+def benchmark(size, labels):
+    label_map = make_label_map(size, labels)
+
+    transforms = [
+        LargestConnectedComponent(fields=['labels']),
+        RemoveSmallComponents(fields=['labels'], min_size=100),
+        FillHoles(fields=['labels']),
+        MorphologicalOpening(fields=['labels'], radius=1),
+        MorphologicalClosing(fields=['labels'], radius=1),
+    ]
+
+    print('{}^3 label map, {} labels'.format(size, labels))
+
+    for transform in transforms:
+        start = time.time()
+        transform({'labels': [label_map]})
+        print('{:>28} {:8.2f} s'.format(type(transform).__name__, time.time() - start))
+
+
+if __name__ == '__main__':
+    benchmark()
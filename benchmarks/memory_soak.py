@@ -0,0 +1,61 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import click
+import numpy as np
+
+from tomaat.extras import TransformChain, FromLabelVolumeToVTKMesh, LargestConnectedComponent
+from tomaat.memory import MemoryMonitor, soak, tracemalloc
+
+
+'''
+Soak test: run a label clean-up and meshing pipeline many times on the same synthetic segmentation and report the RSS
+growth per request, the memory retained by each transform and whether a leak is suspected.
+'''
+
+
+def make_data(size):
+    grid = np.ogrid[:size, :size, :size]
+    label_map = (sum((g - size // 2) ** 2 for g in grid) < (size // 3) ** 2).astype(np.uint8)
+
+    return {
+        'label': [label_map],
+        'original_spacings_NP': {'label': [(1., 1., 1.)]},
+        'original_origins_NP': {'label': [(0., 0., 0.)]},
+        'original_sizes_std_size': {'label': [label_map.shape]},
+        'original_directions_NP': {'label': [(1., 0., 0., 0., 1., 0., 0., 0., 1.)]},
+        'return_VTK': ['True'],
+        'RAS': ['False'],
+    }
+
+
+@click.command()
+@click.option('--size', default=96, help='edge of the cubic label map')
+@click.option('--requests', default=200, help='number of requests')
+@click.option('--window', default=50, help='number of requests over which growth is measured')
+@click.option('--trace-python', is_flag=True, help='trace Python allocations with tracemalloc')
+def benchmark(size, requests, window, trace_python):
+    chain = TransformChain([
+        LargestConnectedComponent(['label']),
+        FromLabelVolumeToVTKMesh('label', 'mesh'),
+    ])
+
+    monitor = MemoryMonitor(trace_python=trace_python, soak_window=window)
+
+    stats = soak(lambda: chain(make_data(size)), requests, monitor)
+
+    if trace_python:
+        tracemalloc.stop()
+
+    print('requests:                {}'.format(stats['requests']))
+    print('RSS:                     {:.1f} MB'.format(stats['rss_bytes'] / 1e6))
+    print('RSS growth per request:  {:.1f} kB'.format((stats['rss_growth_per_request'] or 0.) / 1e3))
+    print('leak suspected:          {}'.format(stats['leak_suspected']))
+
+    for name, totals in sorted(stats['transforms'].items()):
+        print('{:<26} RSS retained {:8.1f} kB/call'.format(name, totals['rss_delta'] / 1e3 / totals['calls']))
+
+
+if __name__ == '__main__':
+    benchmark()
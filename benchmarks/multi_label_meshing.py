@@ -0,0 +1,75 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import click
+import numpy as np
+
+from tomaat.extras import FromLabelVolumeToVTKMeshes
+
+
+'''
+Wall time of meshing a multi-label segmentation with one worker and with a pool of workers, compared with the time of
+the slowest label alone.
+'''
+
+
+def make_label_map(size, labels):
+    label_map = np.zeros((size, size, size), dtype=np.uint8)
+
+    grid = np.ogrid[:size, :size, :size]
+    rng = np.random.RandomState(0)
+
+    for label in range(1, labels + 1):
+        centre = rng.randint(size // 8, 7 * size // 8, size=3)
+        radius = rng.randint(size // 16, size // 6)
+        ball = sum((g - c) ** 2 for g, c in zip(grid, centre)) < radius ** 2
+        label_map[ball & (label_map == 0)] = label
+
+    return label_map
+
+
+def make_data(label_map):
+    return {
+        'labels': [label_map],
+        'original_spacings_NP': {'labels': [(1., 1., 1.)]},
+        'original_origins_NP': {'labels': [(0., 0., 0.)]},
+        'original_sizes_std_size': {'labels': [label_map.shape]},
+        'original_directions_NP': {'labels': [(1., 0., 0., 0., 1., 0., 0., 0., 1.)]},
+        'return_VTK': ['True'],
+        'RAS': ['False'],
+    }
+
+
+def measure(transform, label_map):
+    start = time.time()
+    transform(make_data(label_map))
+
+    return time.time() - start
+
+
+@click.command()
+@click.option('--size', default=256, help='edge of the cubic label map')
+@click.option('--labels', default=8, help='number of labels')
+@click.option('--workers', default=0, help='number of workers of the pool, 0 for the number of cores')
+def benchmark(size, labels, workers):
+    label_map = make_label_map(size, labels)
+
+    serial = measure(FromLabelVolumeToVTKMeshes('labels', 'mesh', workers=1), label_map)
+    parallel = measure(FromLabelVolumeToVTKMeshes('labels', 'mesh', workers=workers or None), label_map)
+
+    slowest = max(
+        measure(FromLabelVolumeToVTKMeshes('labels', 'mesh', labels=[label], workers=1), label_map)
+        for label in range(1, labels + 1)
+    )
+
+    print('{} labels on {}^3'.format(labels, size))
+    print('one worker:    {:.2f} s'.format(serial))
+    print('pool:          {:.2f} s'.format(parallel))
+    print('slowest label: {:.2f} s'.format(slowest))
+
+
+if __name__ == '__main__':
+    benchmark()
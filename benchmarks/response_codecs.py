@@ -0,0 +1,64 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import click
+import numpy as np
+
+from tomaat.server.encoding import compress_parallel, choose_response_codec, codec_available
+
+
+'''
+Compression of LabelVolume and TransformGrid outputs: time, ratio and estimated time to the client (compression plus
+transfer at a given bandwidth) for each codec, on label maps and displacement fields of increasing size. The defaults
+of choose_response_codec follow these results.
+'''
+
+CANDIDATES = [('none', None), ('zlib', 1), ('zlib', 6), ('gzip', 6), ('zstd', 1), ('zstd', 3), ('lz4', 0)]
+
+
+def make_label_map(size):
+    grid = np.ogrid[:size, :size, :size]
+    ball = sum((g - size // 2) ** 2 for g in grid) < (size // 4) ** 2
+
+    return ball.astype(np.uint8).tobytes()
+
+
+def make_displacement_field(size):
+    grid = np.ogrid[:size, :size, :size]
+    smooth = np.sin(grid[0] / 10.) * np.cos(grid[1] / 7.) + np.sin(grid[2] / 5.)
+
+    return np.stack([smooth, smooth * 0.5, -smooth], axis=-1).astype(np.float32).tobytes()
+
+
+def benchmark_output(name, data, bandwidth):
+    print('{} ({:.1f} MB), auto: {}'.format(name, len(data) / 1e6, choose_response_codec(len(data))))
+
+    for codec, level in CANDIDATES:
+        if not codec_available(codec):
+            continue
+
+        start = time.time()
+        compressed = compress_parallel(codec, data, level)
+        elapsed = time.time() - start
+
+        total = elapsed + len(compressed) / (bandwidth * 1e6)
+
+        print('    {:>5} {:>5} {:8.3f} s  ratio {:8.1f}  to client {:8.3f} s'.format(
+            codec, str(level), elapsed, len(data) / float(max(len(compressed), 1)), total)
+        )
+
+
+@click.command()
+@click.option('--sizes', default='64,128,256', help='comma separated edges of the cubic outputs')
+@click.option('--bandwidth', default=100., help='bandwidth towards the client, in MB/s')
+def benchmark(sizes, bandwidth):
+    for size in [int(s) for s in sizes.split(',')]:
+        benchmark_output('label map {}^3'.format(size), make_label_map(size), bandwidth)
+        benchmark_output('displacement field {}^3'.format(size), make_displacement_field(size), bandwidth)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,74 @@
+import sys, os
+# We need to add "tomaat"-directory (..) to PATH to import the tomaat package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+
+import click
+import numpy as np
+import SimpleITK as sitk
+
+from tomaat.extras import (
+    TransformChain,
+    FromSITKOriginalResolutionToStandardResolution,
+    FromSITKStandardResolutionToOriginalResolution,
+    FromSITKToNumpy,
+    FromNumpyToSITK,
+    FromNumpyOriginalSizeToStandardSize,
+    FromNumpyStandardSizeToOriginalSize,
+    FromSITKOriginalToStandardGrid,
+    FromSITKStandardGridToOriginal,
+)
+
+
+'''
+Round trip from the original volume to the model grid and back, with a resample followed by a pad/crop ("two step")
+and with a single resampling in each direction ("direct").
+'''
+
+
+def make_chains(resolution, size):
+    two_step = TransformChain([
+        FromSITKOriginalResolutionToStandardResolution(fields=['images'], resolution=resolution),
+        FromSITKToNumpy(fields=['images']),
+        FromNumpyOriginalSizeToStandardSize(fields=['images'], size=size),
+        FromNumpyStandardSizeToOriginalSize(fields=['images']),
+        FromNumpyToSITK(fields=['images']),
+        FromSITKStandardResolutionToOriginalResolution(fields=['images']),
+    ])
+
+    direct = TransformChain([
+        FromSITKOriginalToStandardGrid(fields=['images'], resolution=resolution, size=size),
+        FromSITKToNumpy(fields=['images']),
+        FromNumpyToSITK(fields=['images']),
+        FromSITKStandardGridToOriginal(fields=['images']),
+    ])
+
+    return two_step, direct
+
+
+def measure(chain, volume, requests):
+    start = time.time()
+
+    for _ in range(requests):
+        chain({'images': [volume]})
+
+    return (time.time() - start) / requests
+
+
+@click.command()
+@click.option('--requests', default=5, help='number of round trips')
+@click.option('--size', default=256, help='edge of the cubic original volume')
+@click.option('--grid', default=128, help='edge of the cubic model grid')
+def benchmark(requests, size, grid):
+    volume = sitk.GetImageFromArray((np.random.rand(size, size, size) > 0.5).astype(np.float32))
+    volume.SetSpacing([0.5, 0.5, 0.5])
+
+    two_step, direct = make_chains(resolution=[1., 1., 1.], size=[grid] * 3)
+
+    print('two step: {:.3f} s per round trip'.format(measure(two_step, volume, requests)))
+    print('direct:   {:.3f} s per round trip'.format(measure(direct, volume, requests)))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,31 @@
+from tomaat.server.admission import AdmissionController
+
+
+def test_admission_limits():
+    admission = AdmissionController(max_in_flight=2, max_queued=1, retry_after=3)
+
+    assert admission.admit()
+    assert admission.admit()
+    assert admission.admit()
+
+    assert not admission.admit()  # two requests processed, one waiting: full
+    assert admission.rejected == 1
+
+    admission.release()
+
+    assert admission.admit()
+    assert admission.pending == 3
+
+
+def test_admission_stats():
+    admission = AdmissionController(max_in_flight=1, max_queued=0)
+
+    admission.admit()
+    admission.admit()
+    admission.release()
+
+    stats = admission.stats()
+
+    assert stats['admitted'] == 1
+    assert stats['rejected'] == 1
+    assert stats['pending'] == 0
@@ -53,3 +53,51 @@ def test_tomaatapp_basic_functionality_answer():
     assert result['field'] == 11
 
 
+
+
+def test_tomaatapp_progress():
+    from tomaat.context import RequestContext, set_current_context
+
+    reported = []
+
+    context = RequestContext()
+    context.progress_callback = lambda progress, partial_result: reported.append((progress, partial_result))
+
+    preview_app = TomaatApp(
+        preprocess_fun=pre_processing_mock_function,
+        inference_fun=inference_mock_function,
+        postprocess_fun=post_processing_mock_function,
+        preview_fun=lambda data: {'field': data['field'] - 1}
+    )
+
+    set_current_context(context)
+
+    try:
+        result = preview_app({})
+    finally:
+        set_current_context(None)
+
+    assert result['field'] == 11
+    assert reported[0][1] == {'field': -1}
+    assert [progress for progress, _ in reported] == sorted(progress for progress, _ in reported)
+    assert all(partial_result is None for _, partial_result in reported[1:])
+
+    # without a progress callback, as for synchronous requests, the preview is not computed
+    previews = []
+
+    silent_app = TomaatApp(
+        preprocess_fun=pre_processing_mock_function,
+        inference_fun=inference_mock_function,
+        postprocess_fun=post_processing_mock_function,
+        preview_fun=lambda data: previews.append(data)
+    )
+
+    set_current_context(RequestContext())
+
+    try:
+        assert silent_app({})['field'] == 11
+    finally:
+        set_current_context(None)
+
+    assert silent_app({})['field'] == 11
+    assert previews == []
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+
+from tomaat.server import encoding
+
+
+def compress_in_child(queue):
+    compressed = encoding.compress_parallel('gzip', b'tomaat' * 100000, chunk_size=64 * 1024)
+
+    decompressor = encoding.StreamingDecompressor('gzip')
+
+    queue.put((os.getpid(), decompressor.decompress(compressed) + decompressor.flush() == b'tomaat' * 100000))
+
+
+def test_compression_in_forked_child():
+    # the parent creates its pool first, the child must not use it
+    parent_pool = encoding.get_compression_pool()
+    encoding.compress_parallel('gzip', b'tomaat' * 100000, chunk_size=64 * 1024)
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+
+    child = context.Process(target=compress_in_child, args=(queue,))
+    child.start()
+    child.join(30)
+
+    try:
+        assert child.exitcode == 0, 'compression in the forked child did not complete'
+    finally:
+        if child.is_alive():
+            child.terminate()
+
+    pid, decompressed = queue.get(timeout=5)
+
+    assert pid != os.getpid()
+    assert decompressed
+    assert encoding.get_compression_pool() is parent_pool
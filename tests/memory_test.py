@@ -0,0 +1,64 @@
+import numpy as np
+
+from tomaat.extras import TransformChain
+from tomaat.memory import MemoryMonitor, soak, tracemalloc
+
+
+class Allocate(object):
+    def __init__(self, size, keep):
+        self.size = size
+        self.keep = keep
+
+    def __call__(self, data):
+        array = np.ones(self.size, dtype=np.uint8)
+
+        if self.keep is not None:
+            self.keep.append(array)
+
+        return data
+
+
+def test_per_transform_accounting():
+    monitor = MemoryMonitor(trace_python=True)
+
+    leaked = []
+
+    chain = TransformChain([Allocate(10 ** 6, None), Allocate(10 ** 5, leaked)])
+
+    try:
+        stats = soak(lambda: chain({}), 3, monitor)
+    finally:
+        tracemalloc.stop()
+
+    assert stats['requests'] == 3
+    assert stats['transforms']['Allocate']['calls'] == 6
+
+    steps = stats['last_request']['transforms']
+
+    assert [step['name'] for step in steps] == ['Allocate', 'Allocate']
+    assert steps[0]['python_peak'] >= 10 ** 6 > steps[0]['python_delta']
+    assert steps[1]['python_delta'] >= 10 ** 5
+    assert stats['last_request']['python_peak'] >= 10 ** 6
+    assert stats['rss_bytes'] > 0
+
+
+def test_growth_detection():
+    monitor = MemoryMonitor(soak_window=10, growth_threshold=1000)
+
+    def record(rss):
+        return {'rss_after': rss, 'rss_delta': 0, 'python_peak': None, 'transforms': []}
+
+    for i in range(9):
+        monitor.add(record(10 ** 6 + 200 * i))
+
+    assert monitor.growth() is None  # not enough requests yet
+
+    monitor.add(record(10 ** 6 + 200 * 9))
+
+    assert abs(monitor.growth() - 200) < 1e-6
+    assert monitor.leak_suspected()
+
+    for i in range(10):
+        monitor.add(record(10 ** 6 + 50 * (i % 2)))  # noise, no growth
+
+    assert not monitor.leak_suspected()
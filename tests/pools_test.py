@@ -0,0 +1,57 @@
+import threading
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from tomaat.server import pools
+from tomaat.server.pools import EndpointPools, write_body
+
+
+def test_small_bodies_are_returned_as_they_are():
+    request = DummyRequest([b'predict'])
+
+    assert write_body(request, '[]') == '[]'
+    assert request.written == []
+
+
+def test_large_bodies_are_written_in_chunks():
+    body = u'[{"content": "' + u'è' * 5000 + u'"}]'
+
+    request = DummyRequest([b'predict'])
+
+    done = []
+    write_body(request, body, threshold=1000, chunk_size=1024).addCallback(done.append)
+
+    assert done == [None]
+    assert len(request.written) == 10
+    assert all(len(chunk) <= 1024 for chunk in request.written)
+    assert b''.join(request.written) == body.encode('utf-8')
+    assert request.responseHeaders.getRawHeaders(b'content-length') == [str(len(body.encode('utf-8'))).encode()]
+
+
+def test_endpoint_pools(monkeypatch):
+    endpoint_pools = EndpointPools(sizes={'predict': 3}, default_size=2)
+
+    deferred_to = []
+    monkeypatch.setattr(
+        pools.threads, 'deferToThreadPool', lambda reactor, pool, fun, *args: deferred_to.append(pool.name)
+    )
+
+    endpoint_pools.start()
+
+    try:
+        endpoint_pools.defer('uploads', lambda: None)
+        endpoint_pools.defer('predict', lambda: None)
+
+        assert deferred_to == ['tomaat-uploads', 'tomaat-predict']
+
+        done = threading.Event()
+        endpoint_pools.pools['predict'].callInThread(done.set)
+
+        assert done.wait(5)
+
+        stats = endpoint_pools.stats()
+
+        assert stats['predict']['size'] == 3
+        assert stats['admin']['size'] == 2
+    finally:
+        endpoint_pools.stop()
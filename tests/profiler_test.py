@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from tomaat.server.profiler import SamplingProfiler, ProfileWatcher, ProfileInProgress, format_collapsed
+
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler():
+    stop = threading.Event()
+
+    worker = threading.Thread(target=busy_function, args=(stop,), name='busy-worker')
+    worker.start()
+
+    try:
+        counts = SamplingProfiler().run(0.3, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+
+    busy = [stack for stack in counts if 'busy-worker' in stack]
+
+    assert busy
+    assert all(';busy_function (profiler_test.py:' in stack for stack in busy)
+    assert all(stack.startswith('process-') for stack in counts)
+
+    lines = format_collapsed(counts).splitlines()
+
+    assert len(lines) == len(counts)
+    assert int(lines[0].rsplit(' ', 1)[1]) == max(counts.values())
+
+
+def test_one_profile_at_a_time():
+    profiler = SamplingProfiler()
+
+    profiler.lock.acquire()
+
+    with pytest.raises(ProfileInProgress):
+        profiler.run(0.1)
+
+    profiler.lock.release()
+
+
+class CountingWindow(object):
+    """
+    Empty window counting how many times it is read, as a dict proxy of another process would be
+    """
+    def __init__(self):
+        super(CountingWindow, self).__init__()
+        self.reads = 0
+
+    def keys(self):
+        self.reads += 1
+
+        return []
+
+
+def test_watchers_join_profiles():
+    window = {}
+    results = {}
+    started = threading.Event()
+
+    # the watcher normally runs in a delayed-response worker, a thread of this process suffices for the protocol
+    ProfileWatcher(window, results, started).start()
+
+    counts = SamplingProfiler(window=window, results=results, started=started).run(0.8, interval=0.01)
+
+    assert any('tomaat-profile-watcher' in stack for stack in counts)  # sampled by the profiler
+    assert any('MainThread' in stack for stack in counts)  # sampled by the watcher
+    assert results == {} and window == {}
+    assert not started.is_set()
+
+
+def test_idle_watchers_do_not_poll():
+    window = CountingWindow()
+    started = threading.Event()
+
+    ProfileWatcher(window, {}, started).start()
+
+    time.sleep(0.3)
+
+    assert window.reads == 0
+
+
+def test_late_watchers_leave_no_results():
+    window = {'id': 'stale', 'until': time.time() + 0.2, 'interval': 0.01}
+    results = {}
+    started = threading.Event()
+    started.set()
+
+    watcher = ProfileWatcher(window, results, started)
+    watcher.start()
+
+    # the profile is collected while the watcher is still sampling
+    time.sleep(0.1)
+    started.clear()
+    window.clear()
+
+    time.sleep(0.3)
+
+    assert results == {}
+
+    # samples left behind by an earlier profile are dropped by the next one
+    results['stale_1'] = {'process-1;thread;function': 1}
+
+    counts = SamplingProfiler(window=window, results=results, started=started).run(0.1, interval=0.01)
+
+    assert 'process-1;thread;function' not in counts
+    assert results == {}
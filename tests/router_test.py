@@ -0,0 +1,352 @@
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import requests
+from twisted.internet.defer import succeed
+from twisted.web.test.requesthelper import DummyRequest
+
+from tomaat.server import router as router_module
+from tomaat.server import TomaatRouter
+
+
+certpath = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+
+os.makedirs(certpath)
+
+router = TomaatRouter(
+    config={'port': 9100, 'cert_path': os.path.join(certpath, 'tomaat_cert')},
+    replicas=['https://localhost:9101', 'https://localhost:9102/']
+)
+
+
+def make_request(path, args=None, body=b''):
+    request = DummyRequest([path])
+    request.method = b'POST'
+    request.args = args or {}
+    request.content = tempfile.TemporaryFile()
+    request.content.write(body)
+    return request
+
+
+def setup_replicas(monkeypatch, answers):
+    """
+    Replace network access with answers computed locally: answers maps replica url to a function (path, body) -> str
+    """
+    calls = []
+
+    def sync_defer(name, fun, *args):
+        return succeed(fun(*args))
+
+    def forward_data_handler(replica, method, path, body=None, headers=None):
+        calls.append((replica.url, path))
+        answer = answers[replica.url]
+        if answer is None:
+            raise requests.exceptions.ConnectionError()
+        return 200, {}, answer(path, body)
+
+    monkeypatch.setattr(router.pools, 'defer', sync_defer)
+    monkeypatch.setattr(router, 'forward_data_handler', forward_data_handler)
+
+    for replica in router.replicas:
+        replica.healthy = True
+        replica.outstanding = 0
+        replica.routed = 0
+
+    return calls
+
+
+def test_least_outstanding_selection():
+    first, second = router.replicas
+
+    first.healthy = second.healthy = True
+    first.outstanding, second.outstanding = 3, 1
+
+    assert router.select_replica() is second
+
+    second.healthy = False
+
+    assert router.select_replica() is first
+    assert router.select_replica(exclude=[first]) is None
+
+    second.healthy = True
+    first.outstanding = second.outstanding = 0
+
+
+def test_sticky_delayed_responses(monkeypatch):
+    def delayed_replica(path, body):
+        if path == '/predict':
+            return json.dumps([{'type': 'DelayedResponse', 'request_id': 'abc'}])
+        return json.dumps([{'type': 'PlainText', 'content': 'done', 'label': ''}])
+
+    calls = setup_replicas(monkeypatch, {
+        'https://localhost:9101': delayed_replica,
+        'https://localhost:9102': delayed_replica,
+    })
+
+    content = []
+    router.predict(make_request(b'predict', body=b'payload')).addCallback(content.append)
+
+    owner = calls[-1][0]
+    assert router.owners['abc'][0].url == owner
+
+    # make the owner the busiest replica: the request must still be routed to it
+    router.owners['abc'][0].outstanding = 10
+
+    router.responses(make_request(b'responses', args={b'request_id': [b'abc']})).addCallback(content.append)
+
+    assert calls[-1] == (owner, '/responses')
+    assert 'abc' not in router.owners
+
+    router.responses(make_request(b'responses', args={b'request_id': [b'abc']})).addCallback(content.append)
+
+    assert 'cannot be retrieved' in json.loads(content[-1])[0]['content']
+
+
+def test_failover(monkeypatch):
+    calls = setup_replicas(monkeypatch, {
+        'https://localhost:9101': None,
+        'https://localhost:9102': lambda path, body: body,
+    })
+
+    content = []
+    router.predict(make_request(b'predict', body=b'[]')).addCallback(content.append)
+
+    assert [url for url, _ in calls] == ['https://localhost:9101', 'https://localhost:9102']
+    assert not router.replicas[0].healthy
+    assert content == [b'[]']
+
+    request = make_request(b'predict')
+    router.replicas[1].healthy = False
+    router.predict(request).addCallback(content.append)
+
+    assert request.responseCode == 503
+
+
+def test_delayed_request_ids():
+    assert router_module.delayed_request_ids(b'[{"type": "DelayedResponse", "request_id": "x"}]') == ['x']
+    assert router_module.delayed_request_ids('not json') == []
+    assert router_module.delayed_request_ids('{"a": 1}') == []
+
+
+def test_sticky_uploads(monkeypatch):
+    def upload_replica(path, body):
+        if path == '/uploads':
+            return json.dumps({'upload_id': 'f' * 32, 'offset': 0, 'size': 3, 'complete': False})
+        return json.dumps([{'type': 'PlainText', 'content': path, 'label': ''}])
+
+    calls = setup_replicas(monkeypatch, {
+        'https://localhost:9101': upload_replica,
+        'https://localhost:9102': upload_replica,
+    })
+
+    router.create_upload(make_request(b'uploads', args={b'size': [b'3']}))
+
+    owner = calls[-1][0]
+    assert router.upload_owners['f' * 32][0].url == owner
+
+    # chunks and the prediction request follow the upload, whatever the load of its replica
+    router.upload_owners['f' * 32][0].outstanding = 10
+
+    request = make_request(b'uploads', body=b'abc')
+    request.method = b'PUT'
+    router.upload_chunk(request, 'f' * 32)
+
+    assert calls[-1] == (owner, '/uploads/' + 'f' * 32)
+
+    router.predict(make_request(b'predict', args={b'images': [b'upload:' + b'f' * 32]}))
+
+    assert calls[-1] == (owner, '/predict')
+    assert 'f' * 32 not in router.upload_owners
+
+    request = make_request(b'uploads')
+    router.upload_status(request, 'f' * 32)
+
+    assert request.responseCode == 404
+
+
+def test_owner_expiry():
+    router.owners['old'] = (router.replicas[0], 0.)
+    router.upload_owners['recent'] = (router.replicas[0], time.time())
+
+    assert router.expire_owners() == 1
+    assert 'old' not in router.owners
+    assert 'recent' in router.upload_owners
+
+    del router.upload_owners['recent']
+
+
+def test_router_defaults(monkeypatch):
+    class Response(object):
+        status_code = 200
+        headers = {}
+        content = b'[]'
+
+    arguments = {}
+
+    def request(method, url, **kwargs):
+        arguments.update(kwargs)
+        return Response()
+
+    monkeypatch.setattr(router_module.requests, 'request', request)
+
+    router.forward_data_handler(router.replicas[0], 'GET', '/interface')
+
+    assert arguments['verify'] is True
+    assert router.pools.pools['forward'].max == router_module.FORWARD_THREADS
+    assert set(router_module.__all__) == {'TomaatRouter', 'Replica'}
+
+
+LOCALHOST_SCRIPT = '''
+import sys
+import time
+
+sys.path.insert(0, {root!r})
+
+from tomaat.server import TomaatApp, TomaatServiceDelayedResponse, TomaatRouter
+
+
+def postprocess(data):
+    time.sleep(0.5)
+    return {{'text': ['answered by the replica on port {port}']}}
+
+
+config = {{'name': 'localhost test', 'port': {port}, 'cert_path': {cert_path!r}, 'announce': False}}
+
+if {replicas!r}:
+    config.update({{'verify_replicas': False, 'health_check_interval': 0.5}})
+    TomaatRouter(config, {replicas!r}).run()
+else:
+    app = TomaatApp(preprocess_fun=lambda data: data, inference_fun=lambda data: data, postprocess_fun=postprocess)
+    TomaatServiceDelayedResponse(
+        config=config,
+        app=app,
+        input_interface=[{{'type': 'checkbox', 'destination': 'flag', 'text': 'flag'}}],
+        output_interface=[{{'type': 'PlainText', 'field': 'text'}}]
+    ).run()
+'''
+
+
+def free_port():
+    import socket
+
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def start_localhost_process(port, replicas=()):
+    import subprocess
+    import sys
+
+    script = LOCALHOST_SCRIPT.format(
+        root=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        port=port,
+        cert_path=os.path.join(certpath, 'localhost_cert_{}'.format(port)),
+        replicas=list(replicas)
+    )
+
+    # a session of its own, so that the process is stopped together with its worker and manager processes
+    return subprocess.Popen(
+        [sys.executable, '-c', script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+
+
+def stop_localhost_process(process):
+    import signal
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass  # already stopped
+
+    process.wait()
+
+
+def wait_until(condition, timeout=30):
+    end = time.time() + timeout
+
+    while time.time() < end:
+        try:
+            if condition():
+                return True
+        except requests.exceptions.RequestException:
+            pass
+
+        time.sleep(0.1)
+
+    return False
+
+
+def test_router_with_localhost_replicas():
+    import warnings
+
+    warnings.simplefilter('ignore')  # self-signed certificates
+
+    replica_urls = ['https://localhost:{}'.format(free_port()) for _ in range(2)]
+    router_url = 'https://localhost:{}'.format(free_port())
+
+    processes = [start_localhost_process(int(url.rsplit(':', 1)[1])) for url in replica_urls]
+
+    try:
+        for url in replica_urls:
+            assert wait_until(lambda: requests.get(url + '/readyz', verify=False).status_code == 200)
+
+        processes.append(start_localhost_process(int(router_url.rsplit(':', 1)[1]), replica_urls))
+
+        assert wait_until(lambda: requests.get(router_url + '/readyz', verify=False).status_code == 200)
+
+        # every delayed request is polled through the router, which must send the polls to the replica holding it
+        request_ids = []
+
+        for _ in range(4):
+            response = requests.post(router_url + '/predict', data={'flag': 'True'}, verify=False)
+
+            delayed = response.json()[0]
+
+            assert delayed['type'] == 'DelayedResponse'
+            assert response.headers['X-Tomaat-Request-Id'] == delayed['request_id']
+
+            request_ids.append(delayed['request_id'])
+
+        answers = set()
+
+        for request_id in request_ids:
+            def poll():
+                message = requests.post(router_url + '/responses', data={'request_id': request_id}, verify=False).json()
+
+                if message[0]['type'] == 'DelayedResponse':
+                    return False
+
+                answers.add(message[-1]['content'])
+                return True
+
+            assert wait_until(poll)
+
+        assert len(answers) == 2  # both replicas answered
+
+        # the headers of the replicas are passed on
+        response = requests.post(router_url + '/uploads', data={'size': '3'}, verify=False)
+
+        assert response.headers['Content-Type'] == 'application/json'
+        assert response.json()['size'] == 3
+
+        health = requests.get(router_url + '/healthz', verify=False).json()
+
+        assert [replica['healthy'] for replica in health['replicas']] == [True, True]
+
+        stop_localhost_process(processes[0])
+
+        def first_replica_unhealthy():
+            health = requests.get(router_url + '/healthz', verify=False).json()
+            return [replica['healthy'] for replica in health['replicas']] == [False, True]
+
+        assert wait_until(first_replica_unhealthy)
+    finally:
+        for process in processes:
+            stop_localhost_process(process)
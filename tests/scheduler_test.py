@@ -0,0 +1,121 @@
+import time
+
+from twisted.internet.defer import Deferred
+
+from tomaat.context import RequestContext, DeadlineExceeded, RequestCancelled, current_context
+from tomaat.server import scheduler
+from tomaat.server.scheduler import PriorityExecutor, priority_from_string
+
+
+def test_priority_from_string():
+    assert priority_from_string('urgent') == 0
+    assert priority_from_string(' Batch ') == 2
+    assert priority_from_string('5') == 2  # clamped to the priority classes
+    assert priority_from_string('-3') == 0
+    assert priority_from_string(None) == 1
+    assert priority_from_string('unknown') == 1
+
+
+def test_executor_order_and_deadlines(monkeypatch):
+    started = []
+
+    def fake_defer_to_thread(fun, *args):
+        d = Deferred()
+        started.append((args[0].request_id, args, d))
+        return d
+
+    monkeypatch.setattr(scheduler.threads, 'deferToThread', fake_defer_to_thread)
+
+    executor = PriorityExecutor(max_workers=1)
+
+    results = []
+    failures = []
+
+    def submit(request_id, priority, deadline=None):
+        context = RequestContext(request_id=request_id, priority=priority, deadline=deadline)
+        d = executor.submit(context, lambda: request_id)
+        d.addCallbacks(results.append, lambda f: failures.append((request_id, f.check(DeadlineExceeded))))
+
+    submit('first', priority=1)
+    submit('batch', priority=2)
+    submit('normal_late', priority=1, deadline=time.time() + 3600)
+    submit('normal_early', priority=1, deadline=time.time() + 60)
+    submit('urgent_expired', priority=0, deadline=time.time() - 1)
+    submit('urgent', priority=0)
+
+    assert executor.queued == 5
+
+    order = []
+    while started:
+        request_id, args, d = started.pop(0)
+        order.append(request_id)
+
+        if request_id == 'batch':
+            d.errback(ValueError('failing job'))
+        else:
+            d.callback(request_id)
+
+    assert order == ['first', 'urgent', 'normal_early', 'normal_late', 'batch']
+    assert failures == [('urgent_expired', DeadlineExceeded), ('batch', None)]
+
+    stats = executor.stats()
+
+    assert stats['completed'] == {'normal': 3, 'urgent': 1}
+    assert stats['failed'] == {'batch': 1}
+
+    assert stats['expired'] == {'urgent': 1}
+    assert stats['deadline_miss_rate']['urgent'] == 1.
+    assert stats['deadline_miss_rate']['normal'] == 0.
+    assert stats['running'] == 0
+
+
+def test_executor_binds_context(monkeypatch):
+    def sync_defer_to_thread(fun, *args):
+        d = Deferred()
+        d.callback(fun(*args))
+        return d
+
+    monkeypatch.setattr(scheduler.threads, 'deferToThread', sync_defer_to_thread)
+
+    executor = PriorityExecutor(max_workers=1)
+    context = RequestContext(request_id='abc')
+
+    results = []
+    executor.submit(context, lambda: current_context().request_id).addCallback(results.append)
+
+    assert results == ['abc']
+    assert current_context() is None
+
+
+def test_executor_cancellation(monkeypatch):
+    started = []
+
+    def fake_defer_to_thread(fun, *args):
+        d = Deferred()
+        started.append(args[0].request_id)
+        return d
+
+    monkeypatch.setattr(scheduler.threads, 'deferToThread', fake_defer_to_thread)
+
+    executor = PriorityExecutor(max_workers=1)
+
+    contexts = [RequestContext(request_id=request_id) for request_id in ['running', 'removed', 'flagged', 'waiting']]
+
+    failures = []
+    for context in contexts:
+        d = executor.submit(context, lambda: None)
+        d.addErrback(lambda f, request_id=context.request_id: failures.append((request_id, f.check(RequestCancelled))))
+
+    assert executor.cancel(contexts[1])
+    assert not executor.cancel(contexts[0])  # already running
+    assert failures == [('removed', RequestCancelled)]
+    assert executor.queued == 2
+
+    contexts[2].cancel()  # cancelled without the executor knowing, dropped when its turn comes
+
+    executor.running = 0
+    executor._schedule()
+
+    assert started == ['running', 'waiting']
+    assert failures[1] == ('flagged', RequestCancelled)
+    assert executor.stats()['cancelled'] == {'normal': 2}
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+from tomaat.server.scratch import ScratchSpace, ScratchQuotaExceeded
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+
+
+def test_directories_are_removed_on_every_path():
+    scratch = ScratchSpace(root=tempfile.mkdtemp())
+
+    with scratch.request() as path:
+        write(os.path.join(path, 'volume.mha'), 10)
+
+    assert not os.path.exists(path)
+
+    with pytest.raises(RuntimeError):
+        with scratch.request() as path:
+            raise RuntimeError('failing request')
+
+    assert not os.path.exists(path)
+    assert os.listdir(scratch.root) == []
+    assert scratch.stats()['released'] == 2
+
+
+def test_quotas():
+    scratch = ScratchSpace(root=tempfile.mkdtemp(), request_quota=100, total_quota=150)
+
+    path = scratch.allocate()
+    write(os.path.join(path, 'volume.mha'), 120)
+
+    with pytest.raises(ScratchQuotaExceeded):
+        scratch.check(path)
+
+    other = scratch.allocate()
+    write(os.path.join(other, 'volume.mha'), 50)
+    scratch.check(other)
+
+    with pytest.raises(ScratchQuotaExceeded):
+        scratch.allocate()  # 170 bytes in use
+
+    scratch.release(path)
+
+    scratch.release(scratch.allocate())
+
+    stats = scratch.stats()
+    assert stats['rejected'] == 1
+    assert stats['over_quota'] == 1
+    assert stats['usage_bytes'] == 50
+
+
+def test_running_count(monkeypatch):
+    scratch = ScratchSpace(root=tempfile.mkdtemp(), request_quota=100, total_quota=150)
+
+    def walk(path):
+        raise AssertionError('scratch space walked')
+
+    monkeypatch.setattr(scratch, 'usage', walk)
+
+    path = scratch.allocate()
+
+    with scratch.open(path, os.path.join(path, 'volume.mha')) as f:
+        f.write(b'0' * 80)
+
+    scratch.record(40)  # e.g. an upload chunk
+    assert scratch.used == 120
+
+    with pytest.raises(ScratchQuotaExceeded):
+        scratch.ensure_room(40)
+
+    scratch.release(path)
+    assert scratch.used == 40
+
+    monkeypatch.undo()
+
+    # the janitor replaces the count with the content of the disk
+    other = scratch.allocate()
+    write(os.path.join(other, 'volume.mha'), 30)
+
+    scratch.collect()
+    assert scratch.used == 30
+
+
+def test_quota_enforced_while_writing():
+    scratch = ScratchSpace(root=tempfile.mkdtemp(), request_quota=100)
+
+    path = scratch.allocate()
+
+    with scratch.open(path, os.path.join(path, 'volume.mha')) as f:
+        f.write(b'0' * 60)
+
+        with pytest.raises(ScratchQuotaExceeded):
+            f.write(b'0' * 60)
+
+    assert os.path.getsize(os.path.join(path, 'volume.mha')) == 60
+
+
+def test_default_root_is_on_disk():
+    assert ScratchSpace().root == os.path.join(tempfile.gettempdir(), 'tomaat_scratch')
+
+
+def test_janitor_removes_orphans():
+    scratch = ScratchSpace(root=tempfile.mkdtemp(), orphan_age=60)
+
+    old = time.time() - 120
+
+    # allocated long ago but still in use
+    active = scratch.allocate()
+    os.utime(active, (old, old))
+
+    # left behind by this process
+    stale = scratch.allocate()
+    scratch.active.discard(stale)
+    os.utime(stale, (old, old))
+
+    # owned by another live process, which removes it itself
+    live = os.path.join(scratch.root, '{}_0123'.format(os.getppid()))
+    os.mkdir(live)
+    os.utime(live, (old, old))
+
+    dead = os.path.join(scratch.root, '999999999_0123')  # no process has such a pid
+    os.mkdir(dead)
+
+    unrelated = os.path.join(scratch.root, 'not_a_request')
+    os.mkdir(unrelated)
+
+    assert scratch.collect() == 2
+    assert sorted(os.listdir(scratch.root)) == sorted([os.path.basename(active), os.path.basename(live), 'not_a_request'])
@@ -0,0 +1,934 @@
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from tomaat.server import TomaatApp, TomaatService
+
+
+def pre_processing_mock_function(data):
+    return data
+
+
+def inference_mock_function(data):
+    data['text'] = ['{} volumes'.format(len(data['images']))]
+
+    return data
+
+
+def post_processing_mock_function(data):
+    return data
+
+
+certpath = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+
+os.makedirs(certpath)
+
+config = {
+    'name': 'test service',
+    'port': 9000,
+    'cert_path': os.path.join(certpath, 'tomaat_cert'),
+    'max_in_flight': 1,
+    'max_queued': 0,
+    'retry_after': 7,
+}
+
+mock_app = TomaatApp(
+    preprocess_fun=pre_processing_mock_function,
+    inference_fun=inference_mock_function,
+    postprocess_fun=post_processing_mock_function
+)
+
+service = TomaatService(
+    config=config,
+    app=mock_app,
+    input_interface=[
+        {'type': 'volume', 'destination': 'images'},
+        {'type': 'slider', 'destination': 'threshold', 'minimum': 0, 'maximum': 1},
+        {'type': 'radiobutton', 'destination': 'pick', 'text': 'choose:', 'options': ['a', 'b']},
+    ],
+    output_interface=[{'type': 'PlainText', 'field': 'text'}]
+)
+
+
+def test_readiness():
+    service.ready = False
+
+    request = DummyRequest([b'readyz'])
+    response = json.loads(service.readyz(request))
+
+    assert request.responseCode == 503
+    assert request.responseHeaders.getRawHeaders(b'retry-after') == [b'7']
+    assert response['status'] == 'warming up'
+
+    service.ready = True
+
+    request = DummyRequest([b'readyz'])
+    response = json.loads(service.readyz(request))
+
+    assert request.responseCode != 503
+    assert response['status'] == 'ready'
+
+
+def test_health():
+    request = DummyRequest([b'healthz'])
+    response = json.loads(service.healthz(request))
+
+    assert response['status'] == 'ok'
+    assert response['in_flight'] == 0
+
+
+def test_predict_rejected_while_warming_up():
+    service.ready = False
+
+    request = DummyRequest([b'predict'])
+    result = []
+    service.dispatch_prediction(request).addCallback(result.append)
+
+    assert request.responseCode == 503
+    assert json.loads(result[0])[0]['label'] == 'Error!'
+
+    service.ready = True
+
+
+def test_predict_rejected_when_overloaded():
+    service.ready = True
+
+    service.admission.admit()  # occupy the only admission slot
+
+    request = DummyRequest([b'predict'])
+    result = []
+    service.dispatch_prediction(request).addCallback(result.append)
+
+    assert request.responseCode == 503
+    assert request.responseHeaders.getRawHeaders(b'retry-after') == [b'7']
+
+    service.admission.release()
+
+
+def test_warmup():
+    service.ready = False
+
+    savepath = tempfile.mkdtemp()
+
+    try:
+        data = service.make_warmup_data(savepath)
+
+        assert os.path.exists(data['images'][0])
+        assert data['threshold'] == [0.5]
+        assert data['pick'] == ['a']
+    finally:
+        shutil.rmtree(savepath)
+
+    service.warmup_data_handler(2)
+
+    service.warm_up()
+
+    assert service.ready
+
+
+def test_request_context():
+    request = DummyRequest([b'predict'])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Priority', b'urgent')
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Deadline', b'30')
+
+    context = service.make_request_context(request)
+
+    assert context.priority == 0
+    assert 25 < context.deadline - context.received <= 30
+
+    request = DummyRequest([b'predict'])
+    request.args = {b'priority': [b'batch']}
+
+    context = service.make_request_context(request)
+
+    assert context.priority == 2
+    assert context.deadline is None
+
+    service.ready = True
+
+    for deadline in [b'soon', b'-1', b'nan', b'inf']:
+        request = DummyRequest([b'predict'])
+        request.requestHeaders.addRawHeader(b'X-Tomaat-Deadline', deadline)
+
+        service.dispatch_prediction(request)
+
+        assert request.responseCode == 400
+        assert service.admission.pending == 0
+
+
+def test_metrics():
+    request = DummyRequest([b'metrics'])
+    response = json.loads(service.metrics_data_handler(request))
+
+    assert 'admission' in response
+    assert 'deadline_miss_rate' in response['scheduler']
+
+
+def test_metrics_off_the_reactor_thread(monkeypatch):
+    from twisted.internet.defer import succeed
+
+    pools = []
+
+    def defer(name, fun, *args):
+        pools.append(name)
+        return succeed(fun(*args))
+
+    monkeypatch.setattr(service.pools, 'defer', defer)
+
+    result = []
+    service.metrics(DummyRequest([b'metrics'])).addCallback(result.append)
+
+    assert pools == ['admin']
+    assert 'scratch' in json.loads(result[0])
+
+
+def test_compressed_volume_upload():
+    import SimpleITK as sitk
+    import numpy as np
+
+    from tomaat.client import encode_volume
+
+    array = np.random.rand(20, 30, 40).astype(np.float32)
+    volume = sitk.GetImageFromArray(array)
+
+    savepath = tempfile.mkdtemp()
+
+    for codec in ['gzip', 'zstd']:
+        chunks = encode_volume(volume, codec=codec, chunk_size=1000)
+
+        assert len(chunks) > 1
+        assert chunks[0].startswith(codec + '\n')
+
+        request = DummyRequest([b'predict'])
+        request.args = {
+            b'images': [chunk.encode('utf-8') for chunk in chunks],
+            b'threshold': [b'0.3'],
+            b'pick': [b'b'],
+        }
+
+        data = service.parse_request(request, savepath)
+
+        assert np.all(sitk.GetArrayFromImage(sitk.ReadImage(data['images'][0])) == array)
+        assert data['threshold'] == [0.3]
+
+
+def test_predict_with_resumable_upload():
+    import SimpleITK as sitk
+    import numpy as np
+
+    array = np.random.rand(5, 6, 7).astype(np.float32)
+
+    filename = os.path.join(tempfile.mkdtemp(), 'volume.mha')
+    sitk.WriteImage(sitk.GetImageFromArray(array), filename)
+
+    with open(filename, 'rb') as f:
+        payload = f.read()
+
+    request = DummyRequest([b'uploads'])
+    request.args = {b'size': [str(len(payload)).encode('utf-8')]}
+    upload_id = json.loads(service.create_upload_data_handler(request))['upload_id']
+
+    for offset in range(0, len(payload), 100):
+        request = DummyRequest([b'uploads', upload_id.encode('utf-8')])
+        request.requestHeaders.addRawHeader(b'X-Tomaat-Offset', str(offset).encode('utf-8'))
+        request.content = tempfile.TemporaryFile()
+        request.content.write(payload[offset:offset + 100])
+        status = json.loads(service.upload_chunk_data_handler(request, upload_id))
+
+    assert status['complete']
+
+    request = DummyRequest([b'uploads', upload_id.encode('utf-8')])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Offset', b'0')
+    request.content = tempfile.TemporaryFile()
+    service.upload_chunk_data_handler(request, upload_id)
+
+    assert request.responseCode == 409
+
+    request = DummyRequest([b'uploads', upload_id.encode('utf-8')])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Offset', str(len(payload)).encode('utf-8'))
+    request.content = tempfile.TemporaryFile()
+    request.content.write(b'0')
+    service.upload_chunk_data_handler(request, upload_id)
+
+    assert request.responseCode == 413
+
+    request = DummyRequest([b'predict'])
+    request.args = {
+        b'images': [('upload:' + upload_id).encode('utf-8')],
+        b'threshold': [b'0.3'],
+        b'pick': [b'b'],
+    }
+
+    data = service.parse_request(request, tempfile.mkdtemp())
+
+    assert np.all(sitk.GetArrayFromImage(sitk.ReadImage(data['images'][0])) == array)
+
+    request = DummyRequest([b'uploads', upload_id.encode('utf-8')])
+    service.upload_status(request, upload_id)
+
+    assert request.responseCode == 404
+
+
+def test_sparse_label_volume_response():
+    import numpy as np
+    import SimpleITK as sitk
+
+    from tomaat.client import decode_sparse_label_volume
+
+    label_service = TomaatService(
+        config=dict(config),
+        app=mock_app,
+        input_interface=[],
+        output_interface=[{'type': 'SparseLabelVolume', 'field': 'labels'}]
+    )
+
+    labels = np.zeros((30, 20, 10), dtype=np.uint8)
+    labels[5:9, 3:15, 2:4] = 1
+    labels[20, 10, 5] = 2
+
+    image = sitk.GetImageFromArray(labels)
+    image.SetSpacing([0.5, 1., 2.])
+    image.SetOrigin([3., 2., 1.])
+
+    message = label_service.make_response({'labels': [image]}, savepath=None)
+
+    # the content survives the JSON response
+    content = json.loads(json.dumps(message))[0]['content']
+
+    assert content['bbox'] == [[2, 6], [3, 15], [5, 21]]
+
+    decoded = decode_sparse_label_volume(content)
+
+    assert np.array_equal(sitk.GetArrayFromImage(decoded), labels)
+    assert decoded.GetSpacing() == image.GetSpacing()
+    assert decoded.GetOrigin() == image.GetOrigin()
+
+    empty = decode_sparse_label_volume(label_service.make_response(
+        {'labels': [sitk.GetImageFromArray(np.zeros((3, 3, 3), dtype=np.uint8))]}, savepath=None
+    )[0]['content'])
+
+    assert not sitk.GetArrayFromImage(empty).any()
+
+
+def test_client_does_not_import_the_transforms():
+    import subprocess
+    import sys
+
+    script = 'import sys, tomaat.client; print(sorted(m for m in ["tomaat.extras", "vtk"] if m in sys.modules))'
+
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(__file__)))
+
+    assert output.decode('utf-8').strip() == '[]'
+
+
+def test_compressed_outputs():
+    import numpy as np
+    import SimpleITK as sitk
+
+    from tomaat.client import decode_file_content
+
+    labels = np.zeros((40, 30, 20), dtype=np.uint8)
+    labels[10:20, 5:25, 5:15] = 1
+    image = sitk.GetImageFromArray(labels)
+
+    field = sitk.GetImageFromArray(np.random.rand(10, 10, 10, 3), isVector=True)
+
+    for compression in ['none', 'zlib', 'gzip', 'zstd', 'lz4', 'auto']:
+        output_service = TomaatService(
+            config=dict(config),
+            app=mock_app,
+            input_interface=[],
+            output_interface=[
+                {'type': 'LabelVolume', 'field': 'labels', 'compression': compression, 'level': None},
+                {'type': 'TransformGrid', 'field': 'grid', 'compression': compression},
+            ]
+        )
+
+        savepath = tempfile.mkdtemp()
+        message = output_service.make_response({'labels': [image], 'grid': [field]}, savepath)
+
+        assert message[0]['compression'] != 'auto'
+
+        for element, extension, expected in zip(message, ['.mha', '.nii'], [image, field]):
+            filename = os.path.join(savepath, 'decoded' + extension)
+            with open(filename, 'wb') as f:
+                f.write(decode_file_content(json.loads(json.dumps(element))))
+
+            decoded = sitk.ReadImage(filename)
+
+            assert np.array_equal(sitk.GetArrayFromImage(decoded), sitk.GetArrayFromImage(expected))
+
+
+def test_mesh_formats():
+    import vtk
+
+    from tomaat.client import decode_file_content, decode_raw_mesh
+
+    sphere = vtk.vtkSphereSource()
+    sphere.Update()
+    mesh = sphere.GetOutput()
+
+    for mesh_format in ['ascii', 'binary', 'vtp', 'raw']:
+        mesh_service = TomaatService(
+            config=dict(config),
+            app=mock_app,
+            input_interface=[],
+            output_interface=[{'type': 'VTKMesh', 'field': 'mesh', 'format': mesh_format, 'compression': 'zlib'}]
+        )
+
+        element = json.loads(json.dumps(mesh_service.make_response({'mesh': [mesh]}, savepath=None)))[0]
+
+        assert element['format'] == mesh_format
+
+        if mesh_format == 'raw':
+            vertices, triangles = decode_raw_mesh(element['content'])
+
+            assert vertices.shape == (mesh.GetNumberOfPoints(), 3)
+            assert triangles.shape == (mesh.GetNumberOfPolys(), 3)
+        else:
+            reader = vtk.vtkXMLPolyDataReader() if mesh_format == 'vtp' else vtk.vtkPolyDataReader()
+            reader.SetReadFromInputString(True)
+            reader.SetInputString(decode_file_content(element))
+            reader.Update()
+
+            assert reader.GetOutput().GetNumberOfPoints() == mesh.GetNumberOfPoints()
+            assert reader.GetOutput().GetNumberOfPolys() == mesh.GetNumberOfPolys()
+
+
+def test_one_mesh_element_per_label():
+    import vtk
+
+    sphere = vtk.vtkSphereSource()
+    sphere.Update()
+
+    mesh_service = TomaatService(
+        config=dict(config),
+        app=mock_app,
+        input_interface=[],
+        output_interface=[{'type': 'VTKMesh', 'field': 'mesh', 'format': 'raw'}]
+    )
+
+    message = mesh_service.make_response({'mesh': [{2: sphere.GetOutput(), 1: sphere.GetOutput()}]}, savepath=None)
+
+    assert [element['label'] for element in message] == ['1', '2']
+
+
+def test_delayed_response_progress():
+    from tomaat.server import TomaatServiceDelayedResponse
+
+    delayed_service = TomaatServiceDelayedResponse(
+        config=dict(config),
+        app=mock_app,
+        input_interface=[],
+        output_interface=[{'type': 'PlainText', 'field': 'text'}]
+    )
+
+    req_id = str(uuid.uuid4()).replace('-', '')
+
+    delayed_service.reqest_list.append(req_id)
+    delayed_service.publish_progress(req_id, tempfile.mkdtemp(), 0.2, {'text': ['coarse']})
+    delayed_service.publish_progress(req_id, tempfile.mkdtemp(), 0.7)
+
+    request = DummyRequest([b'responses'])
+    request.args = {b'request_id': [req_id.encode('utf-8')]}
+
+    response = json.loads(delayed_service.responses_data_handler(request))
+
+    assert response[0]['type'] == 'DelayedResponse'
+    assert response[0]['progress'] == 0.7
+    assert not response[0]['complete']
+    assert response[1]['content'] == 'coarse'
+
+    delayed_service.store_result(req_id, [{'type': 'PlainText', 'content': 'refined', 'label': ''}])
+
+    state = delayed_service.memory_state()
+
+    assert state['delayed_results'] == 1 and state['delayed_progress'] == 0
+    assert state['delayed_results_bytes'] == len(json.dumps([{'type': 'PlainText', 'content': 'refined', 'label': ''}]))
+
+    response = json.loads(delayed_service.responses_data_handler(request))
+
+    assert response == [{'type': 'PlainText', 'content': 'refined', 'label': ''}]
+
+
+def test_failed_requests_skip_response_creation():
+    import time
+
+    from tomaat.context import RequestContext, set_current_context
+
+    created = []
+
+    failing_service = TomaatService(
+        config=dict(config),
+        app=mock_app,
+        input_interface=service.input_interface,
+        output_interface=service.output_interface
+    )
+    failing_service.make_response = lambda data, savepath: created.append(data)
+
+    request = DummyRequest([b'predict'])
+    request.args = {b'images': [b'0000'], b'threshold': [b'0.3'], b'pick': [b'b']}
+
+    set_current_context(RequestContext(request_id=uuid.uuid4().hex, deadline=time.time() - 1))
+
+    try:
+        response = failing_service.process_request_message(request, tempfile.mkdtemp())
+    finally:
+        set_current_context(None)
+
+    assert response[0]['content'] == 'The deadline of the request expired before inference'
+
+    request.args = {}  # unparsable
+
+    response = failing_service.process_request_message(request, tempfile.mkdtemp())
+
+    assert response[0]['content'] == 'Server-side ERROR during request parsing'
+    assert created == []
+
+
+def test_cancellation():
+    import pytest
+
+    from tomaat.context import RequestCancelled, set_current_context
+    from tomaat.extras import TransformChain
+
+    request_id = uuid.uuid4().hex
+
+    request = DummyRequest([b'predict'])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Request-Id', request_id.encode('utf-8'))
+
+    context = service.make_request_context(request)
+    service.contexts[context.request_id] = context
+
+    request = DummyRequest([b'cancel'])
+    request.args = {b'request_id': [request_id.encode('utf-8')]}
+
+    assert json.loads(service.cancel_data_handler(request)) == {'request_id': request_id, 'cancelled': True}
+    assert context.cancelled()
+
+    del service.contexts[context.request_id]
+
+    assert not json.loads(service.cancel_data_handler(request))['cancelled']
+
+    # a cancelled request stops between transforms
+    applied = []
+    chain = TransformChain([lambda data: applied.append(1) or context.cancel() or data, lambda data: applied.append(2)])
+
+    context.cancel_event.clear()
+    set_current_context(context)
+
+    try:
+        with pytest.raises(RequestCancelled):
+            chain({})
+    finally:
+        set_current_context(None)
+
+    assert applied == [1]
+
+
+def test_request_ids():
+    service.ready = True
+
+    # ids chosen by clients must be hard to guess
+    request = DummyRequest([b'predict'])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Request-Id', b'my-request')
+
+    result = []
+    service.dispatch_prediction(request).addCallback(result.append)
+
+    assert request.responseCode == 400
+    assert service.admission.pending == 0
+
+    # an id that is still in flight is not reused
+    request_id = uuid.uuid4().hex
+
+    service.contexts[request_id] = service.make_request_context(DummyRequest([b'predict']))
+
+    request = DummyRequest([b'predict'])
+    request.requestHeaders.addRawHeader(b'X-Tomaat-Request-Id', request_id.encode('utf-8'))
+
+    service.dispatch_prediction(request).addCallback(result.append)
+
+    assert request.responseCode == 409
+    assert service.admission.pending == 0
+
+    del service.contexts[request_id]
+
+    # without an id the service generates one
+    context = service.make_request_context(DummyRequest([b'predict']))
+
+    assert len(context.request_id) == 32 and context.request_id != request_id
+
+
+def test_predict_cancelled_on_disconnect():
+    service.ready = True
+
+    service.admission.admit()  # keep the only processing slot busy, the request waits in the queue
+    service.executor.running += 1
+
+    service.admission.max_queued = 1
+
+    request = DummyRequest([b'predict'])
+    result = []
+    service.dispatch_prediction(request).addCallback(result.append)
+
+    assert service.executor.queued == 1
+
+    request.processingFailed(Exception('connection lost'))
+
+    assert service.executor.queued == 0
+    assert json.loads(result[0])[0]['content'] == 'The request was cancelled'
+    assert not service.contexts
+
+    service.executor.running -= 1
+    service.admission.release()
+    service.admission.max_queued = 0
+
+
+def test_delayed_request_keeps_admission_slot():
+    from tomaat.context import RequestContext
+    from tomaat.server import TomaatServiceDelayedResponse
+
+    class FakeProcess(object):
+        alive = True
+
+        def is_alive(self):
+            return self.alive
+
+        def join(self):
+            pass
+
+    delayed_service = TomaatServiceDelayedResponse(
+        config=dict(config),
+        app=mock_app,
+        input_interface=[],
+        output_interface=[{'type': 'PlainText', 'field': 'text'}]
+    )
+
+    context = RequestContext(request_id=str(uuid.uuid4()).replace('-', ''))
+
+    process = FakeProcess()
+
+    assert delayed_service.admission.admit()
+
+    # scratch directory left behind by the worker process, e.g. because it crashed
+    savepath = delayed_service.scratch.allocate()
+
+    delayed_service.delayed_processes[context.request_id] = process
+    delayed_service.delayed_savepaths[context.request_id] = savepath
+    delayed_service.release_admission(context)
+
+    # the worker process is still running: the slot is held and new requests are rejected
+    assert delayed_service.admission.pending == 1
+    assert not delayed_service.admission.admit()
+    assert delayed_service.check_delayed_processes() == 0
+
+    process.alive = False
+
+    assert delayed_service.check_delayed_processes() == 1
+    assert delayed_service.admission.pending == 0
+    assert not delayed_service.delayed_processes
+    assert not os.path.exists(savepath)
+    assert savepath not in delayed_service.scratch.active
+
+
+def test_delayed_request_cancellation():
+    import threading
+
+    from tomaat.server import TomaatServiceDelayedResponse
+
+    delayed_service = TomaatServiceDelayedResponse(
+        config=dict(config),
+        app=mock_app,
+        input_interface=[],
+        output_interface=[{'type': 'PlainText', 'field': 'text'}]
+    )
+
+    req_id = str(uuid.uuid4()).replace('-', '')
+
+    event = threading.Event()
+
+    delayed_service.cancel_events[req_id] = event
+    delayed_service.reqest_list.append(req_id)
+    delayed_service.publish_progress(req_id, tempfile.mkdtemp(), 0.2)
+
+    assert delayed_service.cancel_request(req_id)
+    assert event.is_set()
+    assert req_id not in delayed_service.reqest_list
+    assert req_id not in delayed_service.progress_dict
+
+    assert not delayed_service.cancel_request(req_id)
+
+
+def test_scratch_quota_and_cleanup():
+    import SimpleITK as sitk
+    import numpy as np
+
+    from tomaat.client import encode_volume
+
+    chunks = encode_volume(sitk.GetImageFromArray(np.zeros((10, 10, 10), dtype=np.float32)), codec='gzip')
+
+    def make_request():
+        request = DummyRequest([b'predict'])
+        request.args = {
+            b'images': [chunk.encode('utf-8') for chunk in chunks],
+            b'threshold': [b'0.3'],
+            b'pick': [b'b'],
+        }
+        return request
+
+    directories = len(os.listdir(service.scratch.root))
+
+    service.scratch.request_quota = 100  # smaller than the volume
+
+    response = json.loads(service.received_data_handler(make_request()))
+
+    assert response[0]['content'] == 'The request exceeds the scratch space quota'
+    assert len(os.listdir(service.scratch.root)) == directories
+
+    service.scratch.request_quota = None
+    service.scratch.total_quota = 0
+
+    request = make_request()
+    response = json.loads(service.received_data_handler(request))
+
+    assert request.responseCode == 503
+    assert response[0]['label'] == 'Error!'
+
+    service.scratch.total_quota = None
+
+    response = json.loads(service.received_data_handler(make_request()))
+
+    assert response[0]['content'] == '1 volumes'
+    assert len(os.listdir(service.scratch.root)) == directories
+    assert 'scratch' in json.loads(service.metrics_data_handler(DummyRequest([b'metrics'])))
+
+
+def upload_volume(upload_service, array):
+    import SimpleITK as sitk
+
+    filename = os.path.join(tempfile.mkdtemp(), 'volume.mha')
+    sitk.WriteImage(sitk.GetImageFromArray(array), filename)
+
+    with open(filename, 'rb') as f:
+        payload = f.read()
+
+    upload_id = upload_service.uploads.create(len(payload))
+    upload_service.uploads.write(upload_id, 0, payload)
+
+    request = DummyRequest([b'predict'])
+    request.args = {
+        b'images': [('upload:' + upload_id).encode('utf-8')],
+        b'threshold': [b'0.3'],
+        b'pick': [b'b'],
+    }
+
+    return request
+
+
+def test_claim_upload_into_scratch_space():
+    import SimpleITK as sitk
+    import numpy as np
+
+    array = np.random.rand(5, 6, 7).astype(np.float32)
+
+    # default roots, and a scratch space on tmpfs with the spool in the system temp directory, on another filesystem
+    tmpfs_config = dict(config, scratch_tmpfs=True, upload_spool=os.path.join(tempfile.gettempdir(), 'tomaat_uploads'))
+
+    for upload_config in [config, tmpfs_config]:
+        upload_service = TomaatService(
+            config=upload_config,
+            app=mock_app,
+            input_interface=service.input_interface,
+            output_interface=service.output_interface
+        )
+
+        request = upload_volume(upload_service, array)
+
+        with upload_service.scratch.request() as savepath:
+            data = upload_service.parse_request(request, savepath)
+
+            assert np.all(sitk.GetArrayFromImage(sitk.ReadImage(data['images'][0])) == array)
+
+
+def test_scratch_quota_enforced_on_every_write():
+    import numpy as np
+
+    from tomaat.context import RequestContext, set_current_context
+
+    def inference_writing_files(data):
+        # e.g. arrays memory-mapped in the scratch directory of the request
+        np.zeros(1000, dtype=np.float32).tofile(os.path.join(data['savepath'], 'array.raw'))
+
+        data['text'] = ['done']
+
+        return data
+
+    quota_service = TomaatService(
+        config=dict(config, scratch_request_quota=2000),
+        app=TomaatApp(
+            preprocess_fun=pre_processing_mock_function,
+            inference_fun=inference_writing_files,
+            postprocess_fun=post_processing_mock_function
+        ),
+        input_interface=service.input_interface,
+        output_interface=service.output_interface
+    )
+
+    # an upload larger than the quota is refused, and cannot be claimed
+    request = upload_volume(quota_service, np.zeros((10, 10, 10), dtype=np.float32))
+    response = json.loads(quota_service.received_data_handler(request))
+
+    assert response[0]['content'] == 'The request exceeds the scratch space quota'
+
+    upload = DummyRequest([b'uploads'])
+    upload.args = {b'size': [b'3000']}
+    quota_service.create_upload_data_handler(upload)
+
+    assert upload.responseCode == 413
+
+    # 4000 bytes written by the inference, detected at the next checkpoint
+    request = upload_volume(quota_service, np.zeros((2, 2, 2), dtype=np.float32))
+
+    set_current_context(RequestContext(request_id=str(uuid.uuid4()).replace('-', '')))
+
+    try:
+        response = json.loads(quota_service.received_data_handler(request))
+    finally:
+        set_current_context(None)
+
+    assert response[0]['content'] == 'The request exceeds the scratch space quota'
+    assert quota_service.scratch.stats()['over_quota'] == 2
+    assert not quota_service.scratch.active
+
+
+def test_request_tracing():
+    from tomaat.context import RequestContext, set_current_context
+    from tomaat.tracing import FileSpanExporter
+
+    import SimpleITK as sitk
+    import numpy as np
+
+    from tomaat.client import encode_volume
+
+    filename = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+
+    service.span_exporter = FileSpanExporter(filename)
+
+    chunks = encode_volume(sitk.GetImageFromArray(np.zeros((10, 10, 10), dtype=np.float32)), codec='gzip')
+
+    request = DummyRequest([b'predict'])
+    request.args = {b'images': [chunk.encode('utf-8') for chunk in chunks], b'threshold': [b'0.3'], b'pick': [b'b']}
+
+    set_current_context(RequestContext(request_id='traced'))
+
+    try:
+        service.received_data_handler(request)
+    finally:
+        set_current_context(None)
+        service.span_exporter = None
+
+    with open(filename) as f:
+        spans = json.loads(f.read())['resourceSpans'][0]['scopeSpans'][0]['spans']
+
+    names = [s['name'] for s in spans]
+
+    assert names[:2] == ['request', 'parse_request']
+    assert names[-1] == 'make_response'
+    assert {'preprocess', 'inference', 'postprocess'} <= set(names)
+    assert {'key': 'tomaat.request_id', 'value': {'stringValue': 'traced'}} in spans[0]['attributes']
+
+
+def test_slow_trace_export_does_not_delay_responses():
+    import time
+    import threading
+
+    from tomaat.context import RequestContext, set_current_context
+    from tomaat.tracing import BackgroundSpanExporter
+
+    class SlowExporter(object):
+        def __init__(self):
+            self.exported = []
+            self.release = threading.Event()
+
+        def export(self, trace, service_name):
+            self.release.wait(10)  # e.g. an unreachable collector
+            self.exported.append(trace.trace_id)
+
+    exporter = SlowExporter()
+
+    service.span_exporter = BackgroundSpanExporter(exporter)
+
+    request = DummyRequest([b'predict'])
+    request.args = {b'images': [b'0000'], b'threshold': [b'0.3'], b'pick': [b'b']}
+
+    set_current_context(RequestContext(request_id=uuid.uuid4().hex))
+
+    try:
+        start = time.time()
+        response = json.loads(service.received_data_handler(request))
+        elapsed = time.time() - start
+    finally:
+        set_current_context(None)
+        exporter.release.set()
+        service.span_exporter.flush()
+        service.span_exporter = None
+
+    assert response[0]['content'] == '1 volumes'
+    assert elapsed < 5
+    assert len(exporter.exported) == 1
+
+
+def test_profile_endpoint():
+    request = DummyRequest([b'admin', b'profile'])
+
+    service.profile_data_handler(request)
+
+    assert request.responseCode == 404
+
+    from tomaat.server.profiler import SamplingProfiler
+
+    service.profiler = SamplingProfiler()
+    service.config['admin_token'] = 'secret'
+
+    try:
+        request = DummyRequest([b'admin', b'profile'])
+        request.args = {b'seconds': [b'0.1']}
+
+        service.profile_data_handler(request)
+
+        assert request.responseCode == 403
+
+        request = DummyRequest([b'admin', b'profile'])
+        request.args = {b'seconds': [b'0.1']}
+        request.requestHeaders.addRawHeader(b'X-Tomaat-Admin-Token', b'secret')
+
+        collapsed = service.profile_data_handler(request)
+
+        assert request.responseCode is None
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in collapsed.splitlines())
+    finally:
+        service.profiler = None
+        del service.config['admin_token']
+
+
+def test_memory_metrics():
+    from tomaat.memory import MemoryMonitor
+
+    service.memory = MemoryMonitor()
+
+    try:
+        with service.memory.request():
+            pass
+
+        memory = json.loads(service.metrics_data_handler(DummyRequest([b'metrics'])))['memory']
+    finally:
+        service.memory = None
+
+    assert memory['requests'] == 1
+    assert memory['state']['contexts'] == 0
+    assert memory['state']['python_objects'] > 0
@@ -0,0 +1,63 @@
+import threading
+
+import SimpleITK as sitk
+
+from tomaat.extras import ThreadBudget, TransformChain, set_default_thread_budget
+from tomaat.extras.thread_budget import configure_filter, current_thread_budget
+
+
+def test_share_splits_threads_among_pipelines():
+    budget = ThreadBudget(total_threads=8)
+
+    assert budget.share() == 8
+
+    with budget.pipeline():
+        assert budget.share() == 8
+
+        # nested registration from the same thread counts once
+        with budget.pipeline():
+            assert budget.active == 1
+
+        entered = threading.Event()
+        leave = threading.Event()
+
+        def other_pipeline():
+            with budget.pipeline():
+                entered.set()
+                leave.wait()
+
+        t = threading.Thread(target=other_pipeline)
+        t.start()
+        entered.wait()
+
+        assert budget.share() == 4
+
+        leave.set()
+        t.join()
+
+    assert budget.active == 0
+
+
+def test_chain_configures_filters():
+    budget = ThreadBudget(total_threads=3)
+    seen = []
+
+    def transform(data):
+        seen.append(current_thread_budget())
+        seen.append(configure_filter(sitk.ResampleImageFilter()).GetNumberOfThreads())
+        return data
+
+    TransformChain([transform], thread_budget=budget)({})
+
+    assert seen == [budget, 3]
+    assert current_thread_budget() is None
+
+
+def test_default_budget():
+    budget = ThreadBudget(total_threads=2)
+    set_default_thread_budget(budget)
+
+    try:
+        assert configure_filter(sitk.ResampleImageFilter()).GetNumberOfThreads() == 2
+    finally:
+        set_default_thread_budget(None)
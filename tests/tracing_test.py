@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from tomaat.context import RequestContext, set_current_context
+from tomaat.extras import TransformChain
+from tomaat.tracing import Trace, FileSpanExporter, span, payload_size, STATUS_ERROR
+
+
+class Double(object):
+    def __call__(self, data):
+        data['image'] = [data['image'][0] * 2]
+
+        return data
+
+
+class Fail(object):
+    def __call__(self, data):
+        raise ValueError('broken transform')
+
+
+def test_spans_of_a_transform_chain():
+    context = RequestContext(request_id='0123456789abcdef0123456789abcdef')
+    context.trace = Trace(context.request_id)
+
+    set_current_context(context)
+
+    try:
+        with span('preprocess'):
+            TransformChain([Double(), Double()])({'image': [np.zeros(10, dtype=np.float32)]})
+
+        with pytest.raises(ValueError):
+            with span('postprocess'):
+                TransformChain([Fail()])({})
+    finally:
+        set_current_context(None)
+
+    preprocess, first, second, postprocess, failed = context.trace.spans
+
+    assert [s.name for s in context.trace.spans] == ['preprocess', 'Double', 'Double', 'postprocess', 'Fail']
+    assert first.parent_id == second.parent_id == preprocess.span_id
+    assert preprocess.parent_id is None
+    assert first.attributes['tomaat.payload_bytes'] == 40
+    assert failed.status == postprocess.status == STATUS_ERROR
+
+    filename = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+
+    FileSpanExporter(filename).export(context.trace, 'test service')
+    FileSpanExporter(filename).export(context.trace, 'test service')
+
+    with open(filename) as f:
+        lines = [json.loads(line) for line in f]
+
+    assert len(lines) == 2
+
+    resource_spans = lines[0]['resourceSpans'][0]
+    spans = resource_spans['scopeSpans'][0]['spans']
+
+    assert resource_spans['resource']['attributes'][0]['value'] == {'stringValue': 'test service'}
+    assert all(s['traceId'] == context.request_id for s in spans)
+    assert spans[1]['parentSpanId'] == spans[0]['spanId']
+    assert spans[1]['attributes'] == [{'key': 'tomaat.payload_bytes', 'value': {'intValue': '40'}}]
+    assert int(spans[0]['endTimeUnixNano']) >= int(spans[0]['startTimeUnixNano'])
+
+
+def test_untraced_requests():
+    with span('anything') as untraced:
+        assert untraced is None
+
+    assert payload_size({'a': [np.zeros(3, dtype=np.uint8), b'1234'], 'b': 'text'}) == 7
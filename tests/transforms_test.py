@@ -0,0 +1,547 @@
+import os
+import threading
+
+import numpy as np
+import SimpleITK as sitk
+
+from tomaat.extras import (
+    FromLabelVolumeToVTKMeshes,
+    FromLabelVolumeToVTKMesh,
+    ArgmaxNumpy,
+    FromSITKStandardResolutionToOriginalResolution,
+    LargestConnectedComponent,
+    RemoveSmallComponents,
+    FillHoles,
+    MorphologicalOpening,
+    MorphologicalClosing,
+    MemmapArrays,
+    FromITKFormatFilenameToSITK,
+    FromLazySITKToSITK,
+    LazyImage,
+    FromSITKOriginalIntensitiesToRescaledIntensities,
+    FromSITKRescaledIntensitiesToOriginalIntensities,
+    FromSITKOriginalResolutionToStandardResolution,
+    FromSITKOriginalToStandardGrid,
+    FromSITKStandardGridToOriginal,
+    FromSITKToNumpy,
+    FromNumpyToSITK,
+    FromNumpyOriginalSizeToStandardSize,
+    FromNumpyStandardSizeToOriginalSize,
+    FromListToNumpy5DArray,
+    FromNumpy5DArrayToList,
+    FromNumpyListToStandardSize5DArray,
+    FromStandardSize5DArrayToNumpyList,
+    RescaleIntensities5DArray,
+    RestoreIntensities5DArray,
+    Threshold5DArray,
+    ThresholdNumpy,
+    TransformChain,
+    BufferPool,
+)
+
+
+def make_volumes():
+    return [
+        np.random.rand(10, 20, 7).astype(np.float32),
+        np.random.rand(17, 8, 16).astype(np.float32),
+    ]
+
+
+def test_batch_resize_matches_per_volume_resize():
+    volumes = make_volumes()
+
+    per_volume = TransformChain([
+        FromNumpyOriginalSizeToStandardSize(fields=['images'], size=[12, 12, 12]),
+        FromListToNumpy5DArray(fields=['images']),
+    ])({'images': [np.copy(v) for v in volumes]})
+
+    batch = FromNumpyListToStandardSize5DArray(fields=['images'], size=[12, 12, 12])({'images': volumes})
+
+    assert batch['images'].shape == (2, 12, 12, 12, 1)
+    assert np.all(batch['images'] == per_volume['images'])
+    assert batch['pads_std_size'] == per_volume['pads_std_size']
+    assert batch['crops_std_size'] == per_volume['crops_std_size']
+
+    restored_per_volume = TransformChain([
+        FromNumpy5DArrayToList(fields=['images']),
+        FromNumpyStandardSizeToOriginalSize(fields=['images']),
+    ])(per_volume)
+
+    restored = FromStandardSize5DArrayToNumpyList(fields=['images'])(batch)
+
+    for volume, expected in zip(restored['images'], restored_per_volume['images']):
+        assert volume.shape == expected.shape
+        assert np.all(volume == expected)
+
+
+def test_batch_split_keeps_channels():
+    data = FromNumpyListToStandardSize5DArray(fields=['images'], size=[12, 12, 12])({'images': make_volumes()})
+    data['images'] = np.repeat(data['images'], 3, axis=4)
+
+    data = FromStandardSize5DArrayToNumpyList(fields=['images'])(data)
+
+    assert data['images'][0].shape == (10, 20, 7, 3)
+    assert data['images'][1].shape == (17, 8, 16, 3)
+
+
+def test_batch_rescale_and_restore():
+    batch = np.stack([np.random.rand(4, 4, 4, 1) * 100, np.random.rand(4, 4, 4, 1) - 5]).astype(np.float32)
+    original = np.copy(batch)
+
+    data = RescaleIntensities5DArray(fields=['images'], min_intensity=-1., max_intensity=1.)({'images': batch})
+
+    assert np.allclose(data['images'].reshape(2, -1).min(axis=1), -1.)
+    assert np.allclose(data['images'].reshape(2, -1).max(axis=1), 1.)
+
+    data = RestoreIntensities5DArray(fields=['images'], min_intensity=-1., max_intensity=1.)(data)
+
+    assert np.allclose(data['images'], original, atol=1e-4)
+
+
+def test_batch_rescale_ignores_padding():
+    volumes = [np.random.rand(10, 9, 7).astype(np.float32) + 3., np.random.rand(11, 8, 6).astype(np.float32) - 2.]
+
+    rescaled = [(volume - volume.min()) / (volume.max() - volume.min()) * 2. - 1. for volume in volumes]
+
+    per_volume = FromNumpyListToStandardSize5DArray(fields=['images'], size=[12, 12, 12])({'images': rescaled})
+
+    batch = TransformChain([
+        FromNumpyListToStandardSize5DArray(fields=['images'], size=[12, 12, 12]),
+        RescaleIntensities5DArray(fields=['images'], min_intensity=-1., max_intensity=1.),
+    ])({'images': [np.copy(volume) for volume in volumes]})
+
+    # the zeros of the padding do not change the intensity range, and are still zeros afterwards
+    assert np.allclose(batch['images'], per_volume['images'], atol=1e-5)
+    assert np.allclose(batch['original_ranges_min']['images'], [volume.min() for volume in volumes])
+
+
+def test_batch_threshold():
+    batch = np.random.rand(2, 5, 5, 5, 1).astype(np.float32)
+
+    data = Threshold5DArray(image_field='images', threshold_field='threshold')(
+        {'images': batch, 'threshold': [0.2, 0.7]}
+    )
+
+    assert np.all(data['images'][0] == (batch[0] >= 0.2))
+    assert np.all(data['images'][1] == (batch[1] >= 0.7))
+
+    # fractional thresholds of integer arrays are not truncated
+    integers = Threshold5DArray(image_field='images', threshold_field='threshold')(
+        {'images': np.arange(4, dtype=np.int16).reshape(1, 4, 1, 1, 1), 'threshold': [1.5]}
+    )
+
+    assert integers['images'].ravel().tolist() == [0, 0, 1, 1]
+
+    single = ThresholdNumpy(image_field='images', threshold_field='threshold')(
+        {'images': batch[:1], 'threshold': [0.2]}
+    )
+
+    assert np.all(single['images'] == data['images'][:1])
+
+
+def test_resize_with_buffer_pool():
+    pool = BufferPool()
+
+    forward = FromNumpyOriginalSizeToStandardSize(fields=['images'], size=[12, 12, 12], buffer_pool=pool)
+    backward = FromNumpyStandardSizeToOriginalSize(fields=['images'], buffer_pool=pool)
+
+    outputs = []
+    for _ in range(3):
+        volumes = make_volumes()
+        data = forward({'images': [np.copy(v) for v in volumes]})
+        outputs.append(data['images'][0])
+
+        expected = FromNumpyOriginalSizeToStandardSize(fields=['images'], size=[12, 12, 12])({'images': list(volumes)})
+        for volume, expected_volume in zip(data['images'], expected['images']):
+            assert np.all(volume == expected_volume)
+
+        data = backward(data)
+        for volume, original in zip(data['images'], volumes):
+            assert volume.shape == original.shape
+
+    assert outputs[0] is outputs[1] is outputs[2]  # the same buffer is recycled
+    assert pool.allocations == 4
+    assert pool.reuses == 8
+
+
+def test_buffer_pool_is_bounded():
+    pool = BufferPool(max_bytes=600)
+
+    first = pool.get('first', (100,), np.float32)
+    assert pool.get('first', (100,), np.float32) is first
+
+    pool.get('second', (100,), np.float32)  # 800 bytes with the first one, which is dropped
+    assert pool.nbytes() == 400
+    assert pool.evictions == 1
+    assert pool.get('first', (100,), np.float32) is not first
+
+    pool.get('large', (1000,), np.float32)  # larger than the pool, never kept
+    assert pool.nbytes() <= 600
+
+    pool.release()
+    assert pool.nbytes() == 0
+
+
+def test_sitk_filters_are_reused_within_a_thread():
+    rescale = FromSITKOriginalIntensitiesToRescaledIntensities(fields=['images'])
+    restore = FromSITKRescaledIntensitiesToOriginalIntensities(fields=['images'])
+
+    for _ in range(3):
+        original = np.random.rand(6, 7, 8).astype(np.float32) * 100
+        data = rescale({'images': [sitk.GetImageFromArray(original)]})
+        rescaled = sitk.GetArrayFromImage(data['images'][0])
+
+        assert np.isclose(rescaled.min(), 0) and np.isclose(rescaled.max(), 1)
+
+        data = restore(data)
+
+        assert np.allclose(sitk.GetArrayFromImage(data['images'][0]), original, atol=1e-3)
+
+    assert rescale.filters.creations == 2
+    assert restore.filters.creations == 1
+
+    resample = FromSITKOriginalResolutionToStandardResolution(fields=['images'], resolution=[2., 2., 2.])
+    volume = sitk.GetImageFromArray(np.zeros((8, 8, 8), dtype=np.float32))
+
+    thread = threading.Thread(target=resample, args=({'images': [volume]},))
+    thread.start()
+    thread.join()
+
+    assert resample({'images': [volume]})['images'][0].GetSize() == (4, 4, 4)
+    assert resample.filters.creations == 2
+
+
+def make_label_image():
+    z, y, x = np.mgrid[:20, :30, :40]
+    label = (((x - 22) / 12.) ** 2 + ((y - 14) / 9.) ** 2 + ((z - 9) / 6.) ** 2 < 1).astype(np.float32)
+
+    image = sitk.GetImageFromArray(label)
+    image.SetSpacing([0.8, 1.2, 2.])
+    image.SetOrigin([10., -5., 3.])
+    image.SetDirection([0., -1., 0., 1., 0., 0., 0., 0., 1.])
+
+    return label, image
+
+
+def test_standard_grid_round_trip():
+    label, image = make_label_image()
+
+    data = FromSITKOriginalToStandardGrid(fields=['images'], resolution=[1.5, 1.5, 1.5], size=[32, 32, 32])(
+        {'images': [image]}
+    )
+    on_grid = data['images'][0]
+
+    assert on_grid.GetSize() == (32, 32, 32)
+    assert np.allclose(on_grid.GetSpacing(), 1.5)
+    assert on_grid.GetDirection() == image.GetDirection()
+
+    # the grid is centred on the volume
+    centre = lambda im: im.TransformContinuousIndexToPhysicalPoint((np.asarray(im.GetSize()) - 1) / 2.)
+    assert np.allclose(centre(on_grid), centre(image))
+
+    # the model works on numpy arrays, its output is brought back to the grid and then to the original volume
+    data = FromSITKToNumpy(fields=['images'])(data)
+    data = FromNumpyToSITK(fields=['images'])(data)
+    data = FromSITKStandardGridToOriginal(fields=['images'])(data)
+    restored = data['images'][0]
+
+    assert restored.GetSize() == image.GetSize()
+    assert restored.GetSpacing() == image.GetSpacing()
+    assert restored.GetOrigin() == image.GetOrigin()
+    assert restored.GetDirection() == image.GetDirection()
+
+    restored = sitk.GetArrayFromImage(restored) > 0.5
+    dice = 2. * np.sum(restored & (label > 0.5)) / (np.sum(restored) + np.sum(label > 0.5))
+
+    assert dice > 0.9
+
+
+def test_lazy_loading_and_region_of_interest(tmpdir):
+    array = np.random.rand(20, 30, 40).astype(np.float32)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([0.5, 1., 2.])
+    image.SetOrigin([1., 2., 3.])
+
+    filenames = [str(tmpdir.join('{}.mha'.format(i))) for i in range(2)]
+    for filename in filenames:
+        sitk.WriteImage(image, filename)
+
+    data = FromITKFormatFilenameToSITK(fields=['images'], lazy=True)({'images': list(filenames)})
+    lazy = data['images'][0]
+
+    assert isinstance(lazy, LazyImage)
+    assert lazy.GetSize() == (40, 30, 20)
+    assert lazy.GetSpacing() == (0.5, 1., 2.)
+
+    # the region decided from the header is clipped to the volume
+    data['roi'] = [([10, 5, 2], [8, 6, 4]), ([35, 0, 0], [10, 30, 20])]
+    data = FromLazySITKToSITK(fields=['images'], field_roi='roi')(data)
+
+    assert np.array_equal(sitk.GetArrayFromImage(data['images'][0]), array[2:6, 5:11, 10:18])
+    assert np.array_equal(sitk.GetArrayFromImage(data['images'][1]), array[:, :, 35:])
+    assert np.allclose(data['images'][0].GetOrigin(), [1. + 10 * 0.5, 2. + 5 * 1., 3. + 2 * 2.])
+    assert not any(os.path.exists(filename) for filename in filenames)
+
+
+def test_memmap_arrays(tmpdir):
+    image = sitk.GetImageFromArray(np.random.rand(5, 6, 7).astype(np.float32))
+
+    expected = FromSITKToNumpy(fields=['images'])({'images': [image]})['images'][0]
+
+    data = FromSITKToNumpy(fields=['images'], memmap=True)({'images': [image], 'savepath': str(tmpdir)})
+    mapped = data['images'][0]
+
+    assert isinstance(mapped, np.memmap)
+    assert np.array_equal(mapped, expected)
+
+    # other processes can map the same file
+    assert np.array_equal(np.load(mapped.filename, mmap_mode='r'), expected)
+    assert os.path.dirname(mapped.filename) == str(tmpdir)
+
+    data['batch'] = np.ones((1, 1, 4, 4, 4), dtype=np.float32)
+    data = MemmapArrays(fields=['batch'])(data)
+
+    assert isinstance(data['batch'], np.memmap)
+    assert len(tmpdir.listdir()) == 2
+
+    # anonymous files are used without a scratch directory
+    anonymous = MemmapArrays(fields=['images'])({'images': [expected]})['images'][0]
+
+    assert isinstance(anonymous, np.memmap) and anonymous.filename is None
+
+
+def make_label_map():
+    label = np.zeros((20, 20, 20), dtype=np.uint8)
+
+    label[2:10, 2:10, 2:10] = 1  # large component of label 1, with a hole
+    label[5, 5, 5] = 0
+    label[15:17, 15:17, 15:17] = 1  # small component of label 1
+    label[12:18, 2:8, 2:8] = 2  # label 2, touching nothing
+    label[14, 4, 4] = 0
+
+    return label
+
+
+def test_largest_connected_component_and_small_components():
+    label = make_label_map()
+
+    largest = LargestConnectedComponent(fields=['labels'])({'labels': [label]})['labels'][0]
+
+    assert largest.dtype == np.uint8
+    assert np.sum(largest == 1) == 8 ** 3 - 1
+    assert np.array_equal(largest == 2, label == 2)
+
+    cleaned = RemoveSmallComponents(fields=['labels'], min_size=10)({'labels': [label]})['labels'][0]
+
+    assert np.array_equal(cleaned, largest)
+
+    # the input is left untouched
+    assert np.sum(label == 1) == 8 ** 3 - 1 + 8
+
+
+def test_fill_holes_and_morphology_on_sitk_images():
+    label = make_label_map()
+    image = sitk.GetImageFromArray(label)
+    image.SetSpacing([0.5, 0.5, 0.5])
+
+    filled = FillHoles(fields=['labels'], labels=[1])({'labels': [image]})['labels'][0]
+
+    assert filled.GetSpacing() == (0.5, 0.5, 0.5)
+
+    filled = sitk.GetArrayFromImage(filled)
+
+    assert filled[5, 5, 5] == 1
+    assert filled[14, 4, 4] == 0  # label 2 was not processed
+
+    opened = MorphologicalOpening(fields=['labels'], radius=1)({'labels': [label]})['labels'][0]
+
+    # the 2x2x2 component of label 1 is thinner than the ball and disappears
+    assert not opened[15:17, 15:17, 15:17].any()
+
+    closed = MorphologicalClosing(fields=['labels'], radius=1)({'labels': [label]})['labels'][0]
+
+    assert closed[5, 5, 5] == 1 and closed[14, 4, 4] == 2
+
+
+def test_morphology_matches_simpleitk():
+    rng = np.random.RandomState(0)
+    mask = (rng.rand(24, 20, 16) < 0.4).astype(np.uint8)
+    mask[:, :3, :] = 1
+
+    image = sitk.GetImageFromArray(mask)
+
+    for radius in [1, 2]:
+        opened = MorphologicalOpening(fields=['labels'], radius=radius)({'labels': [mask]})['labels'][0]
+        expected = sitk.BinaryMorphologicalOpening(image, [radius] * 3, sitk.sitkBall, 0, 1)
+
+        assert np.array_equal(opened, sitk.GetArrayFromImage(expected))
+
+        closed = MorphologicalClosing(fields=['labels'], radius=radius)({'labels': [mask]})['labels'][0]
+        expected = sitk.BinaryMorphologicalClosing(image, [radius] * 3, sitk.sitkBall, 1, True)
+
+        assert np.array_equal(closed, sitk.GetArrayFromImage(expected))
+
+
+def test_per_label_regions_and_2d_label_maps():
+    import pytest
+
+    from tomaat.extras import PerLabelTransform
+    from tomaat.extras.transforms import label_bounding_boxes, bounding_box
+
+    label = make_label_map()
+
+    boxes = label_bounding_boxes(label, margin=1)
+
+    assert sorted(boxes) == [1, 2]
+    assert boxes[2] == bounding_box(label == 2, margin=1)
+
+    # the same boxes serve the meshes, which select labels and may receive floating point label maps
+    assert label_bounding_boxes(label.astype(np.float32), margin=1, labels=[2]) == {2: boxes[2]}
+    assert list(label_bounding_boxes(label == 1)) == [1]
+
+    # each label is processed within its own bounding box
+    shapes = []
+    kept = PerLabelTransform(fields=['labels'], mask_fun=lambda mask: shapes.append(mask.shape) or mask)(
+        {'labels': [label]}
+    )['labels'][0]
+
+    assert shapes == [(15, 15, 15), (6, 6, 6)]
+    assert np.array_equal(kept, label)
+
+    # 2D label maps are supported, the ball becomes a disk
+    rng = np.random.RandomState(0)
+    mask = (rng.rand(30, 25) < 0.5).astype(np.uint8)
+
+    opened = MorphologicalOpening(fields=['labels'], radius=1)({'labels': [mask]})['labels'][0]
+    expected = sitk.BinaryMorphologicalOpening(sitk.GetImageFromArray(mask), [1, 1], sitk.sitkBall, 0, 1)
+
+    assert np.array_equal(opened, sitk.GetArrayFromImage(expected))
+
+    with pytest.raises(ValueError):
+        MorphologicalOpening(fields=['labels'])({'labels': [np.zeros((2, 3, 4, 5), dtype=np.uint8)]})
+
+
+def test_argmax_and_compact_labels():
+    scores = np.random.rand(2, 10, 9, 8, 4).astype(np.float32)
+
+    labels = ArgmaxNumpy(image_field='images', slab_size=3)({'images': scores})['images']
+
+    assert labels.dtype == np.uint8
+    assert labels.shape == (2, 10, 9, 8, 1)
+    assert np.array_equal(labels[..., 0], np.argmax(scores, axis=-1))
+
+    binary = ThresholdNumpy(image_field='images', threshold_field='threshold', dtype=np.uint8)(
+        {'images': scores[..., :1], 'threshold': [0.5]}
+    )['images']
+
+    assert binary.dtype == np.uint8
+    assert np.array_equal(binary, (scores[..., :1] >= 0.5).astype(np.uint8))
+
+
+def test_argmax_bounds_temporary_memory_for_a_single_volume():
+    import tracemalloc
+
+    scores = np.random.rand(1, 64, 64, 64, 4).astype(np.float32)
+
+    tracemalloc.start()
+
+    try:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+
+        labels = ArgmaxNumpy(image_field='images', slab_size=4)({'images': scores})['images']
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert np.array_equal(labels[..., 0], np.argmax(scores, axis=-1))
+
+    # the uint8 label map (256 KB) and the indices of one slab of 4 x 64 x 64 voxels (128 KB), not the indices of the
+    # whole volume (2 MB)
+    assert peak - start < 1024 * 1024
+
+
+def test_integer_label_maps_stay_integer_through_resampling():
+    labels = np.zeros((8, 8, 8), dtype=np.uint8)
+    labels[2:6, 2:6, 2:6] = 3
+    labels[0, 0, 0] = 1
+
+    image = sitk.GetImageFromArray(labels)
+    image.SetSpacing([2., 2., 2.])
+
+    data = {'images': [image], 'original_spacings': {'images': [(1., 1., 1.)]}}
+    data = FromSITKStandardResolutionToOriginalResolution(fields=['images'])(data)
+
+    assert data['images'][0].GetSize() == (16, 16, 16)
+
+    data = FromSITKToNumpy(fields=['images'], dtype=None)(data)
+
+    # nearest neighbour interpolation does not create labels that do not exist
+    assert data['images'][0].dtype == np.uint8
+    assert set(np.unique(data['images'][0])) == {0, 1, 3}
+
+
+def make_mesh_data(label, **fields):
+    data = {
+        'labels': [label],
+        'original_spacings_NP': {'labels': [(1., 1., 1.)]},
+        'original_origins_NP': {'labels': [(0., 0., 0.)]},
+        'original_sizes_std_size': {'labels': [label.shape]},
+        'original_directions_NP': {'labels': [(1., 0., 0., 0., 1., 0., 0., 0., 1.)]},
+        'return_VTK': ['True'],
+        'RAS': ['False'],
+    }
+    data.update(fields)
+
+    return data
+
+
+def test_mesh_settings_per_request():
+    grid = np.ogrid[:24, :24, :24]
+    ball = (sum((g - 12) ** 2 for g in grid) < 64).astype(np.float32)
+
+    transform = FromLabelVolumeToVTKMesh(
+        'labels', 'mesh', smoothing_iterations_field='smoothing', decimation_field='decimation', preview_field='preview'
+    )
+
+    decimated = transform(make_mesh_data(ball))['mesh'][0]
+    full = transform(make_mesh_data(ball, decimation=[0.]))['mesh'][0]
+    preview = transform(make_mesh_data(ball, decimation=[0.], preview=['True']))['mesh'][0]
+
+    assert 0 < decimated.GetNumberOfPolys() < full.GetNumberOfPolys()
+
+    # without smoothing the vertices stay on the voxel grid of marching cubes
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    preview_points = vtk_to_numpy(preview.GetPoints().GetData())
+    full_points = vtk_to_numpy(full.GetPoints().GetData())
+
+    assert np.all(np.isclose(preview_points * 2, np.round(preview_points * 2)))
+    assert not np.all(np.isclose(full_points * 2, np.round(full_points * 2)))
+
+
+def test_one_mesh_per_label():
+    label = np.zeros((40, 30, 20), dtype=np.uint8)
+    label[5:15, 5:15, 5:15] = 1
+    label[25:35, 10:20, 5:12] = 4
+
+    data = FromLabelVolumeToVTKMeshes('labels', 'mesh', workers=2, decimation=0.)(make_mesh_data(label))
+    meshes = data['mesh'][0]
+
+    assert sorted(meshes.keys()) == [1, 4]
+
+    single = FromLabelVolumeToVTKMesh('labels', 'mesh', decimation=0.)(make_mesh_data((label == 1).astype(np.float32)))
+
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    # cropping does not move the mesh
+    assert np.allclose(
+        vtk_to_numpy(meshes[1].GetPoints().GetData()).mean(axis=0),
+        vtk_to_numpy(single['mesh'][0].GetPoints().GetData()).mean(axis=0),
+        atol=1e-3
+    )
+
+    bounds = meshes[4].GetBounds()
+
+    assert 24 < bounds[0] < bounds[1] < 35 and 9 < bounds[2] < bounds[3] < 20
@@ -0,0 +1,120 @@
+import gzip
+import os
+import tempfile
+import time
+
+import pytest
+
+from tomaat.server.scratch import ScratchQuotaExceeded
+from tomaat.server.uploads import UploadSpool, UploadNotFound, UploadOffsetMismatch, UploadIncomplete, UploadTooLarge
+
+
+def test_resumable_upload():
+    spool = UploadSpool(root=tempfile.mkdtemp())
+
+    payload = os.urandom(1000)
+
+    upload_id = spool.create(len(payload))
+
+    assert spool.write(upload_id, 0, payload[:400]) == 400
+
+    with pytest.raises(UploadOffsetMismatch) as e:
+        spool.write(upload_id, 300, payload[300:])  # the client thinks less data was received
+    assert e.value.expected == 400
+
+    status = spool.status(upload_id)
+    assert status['offset'] == 400 and not status['complete']
+
+    destination = os.path.join(tempfile.mkdtemp(), 'volume.mha')
+
+    with pytest.raises(UploadIncomplete):
+        spool.claim(upload_id, destination)
+
+    spool.write(upload_id, status['offset'], payload[status['offset']:])
+
+    assert spool.status(upload_id)['complete']
+
+    spool.claim(upload_id, destination)
+
+    with open(destination, 'rb') as f:
+        assert f.read() == payload
+
+    with pytest.raises(UploadNotFound):
+        spool.status(upload_id)
+
+
+def test_compressed_upload():
+    spool = UploadSpool(root=tempfile.mkdtemp())
+
+    payload = b'tomaat' * 1000
+    compressed = gzip.compress(payload)
+
+    upload_id = spool.create(len(compressed), codec='gzip')
+    spool.write(upload_id, 0, compressed)
+
+    destination = os.path.join(tempfile.mkdtemp(), 'volume.mha')
+    spool.claim(upload_id, destination)
+
+    with open(destination, 'rb') as f:
+        assert f.read() == payload
+
+
+def test_upload_expiry():
+    spool = UploadSpool(root=tempfile.mkdtemp(), expiry=10)
+
+    old_upload = spool.create(10)
+    new_upload = spool.create(10)
+
+    past = time.time() - 20
+    os.utime(os.path.join(spool.root, old_upload + '.part'), (past, past))
+
+    assert spool.expire() == 1
+
+    with pytest.raises(UploadNotFound):
+        spool.status(old_upload)
+
+    assert spool.status(new_upload)['offset'] == 0
+
+
+def test_invalid_upload_id():
+    spool = UploadSpool(root=tempfile.mkdtemp())
+
+    with pytest.raises(UploadNotFound):
+        spool.status('../../etc/passwd')
+
+
+def test_claim_limited_size():
+    spool = UploadSpool(root=tempfile.mkdtemp())
+
+    payload = b'0' * 1000
+
+    for codec, data in [(None, payload), ('gzip', gzip.compress(payload))]:
+        upload_id = spool.create(len(data), codec)
+        spool.write(upload_id, 0, data)
+
+        with pytest.raises(ScratchQuotaExceeded):
+            spool.claim(upload_id, os.path.join(tempfile.mkdtemp(), 'volume.mha'), max_size=999)
+
+        destination = os.path.join(tempfile.mkdtemp(), 'volume.mha')
+        spool.claim(upload_id, destination, max_size=1000)
+
+        with open(destination, 'rb') as f:
+            assert f.read() == payload
+
+
+def test_uploads_limited_to_declared_size():
+    spool = UploadSpool(root=tempfile.mkdtemp())
+
+    upload_id = spool.create(10)
+
+    spool.write(upload_id, 0, b'0' * 6)
+
+    with pytest.raises(UploadTooLarge):
+        spool.write(upload_id, 6, b'0' * 5)
+
+    assert spool.write(upload_id, 6, b'0' * 4) == 10
+
+    with pytest.raises(UploadTooLarge):
+        spool.write(upload_id, 10, b'0')
+
+    assert spool.status(upload_id)['offset'] == 10
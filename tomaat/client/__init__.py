@@ -0,0 +1,3 @@
+from .upload import *
+from .response import *
+from ..sparse import decode_sparse_label_volume
@@ -0,0 +1,83 @@
+import base64
+import zlib
+
+
+'''
+Client side decoding of the elements of prediction responses. See tomaat.server.encoding for the format of
+compressed outputs.
+'''
+
+
+__all__ = ['decompress_members', 'decode_file_content', 'decode_raw_mesh']
+
+
+def _make_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('the zstd codec requires the zstandard package: pip install zstandard')
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('the lz4 codec requires the lz4 package: pip install lz4')
+
+        return lz4.frame.LZ4FrameDecompressor()
+
+    raise ValueError('unsupported codec {}'.format(codec))
+
+
+def decompress_members(codec, data):
+    '''
+    Decompress a stream made of one or more concatenated compressed members
+    :param codec: one of 'none', 'zlib', 'gzip', 'zstd', 'lz4'
+    :param data: bytes
+    :return: bytes
+    '''
+    if codec == 'none':
+        return data
+
+    output = []
+
+    while data:
+        decompressor = _make_decompressor(codec)
+        output.append(decompressor.decompress(data))
+
+        if not decompressor.eof:
+            raise ValueError('truncated {} stream'.format(codec))
+
+        data = decompressor.unused_data
+
+    return b''.join(output)
+
+
+def decode_file_content(element):
+    '''
+    Decode the content of a LabelVolume, VTKMesh (other than raw) or Transform element of a prediction response
+    :param element: dict element of the response
+    :return: bytes content of the file, for example an MHA file for LabelVolume
+    '''
+    data = base64.b64decode(element['content'])
+
+    return decompress_members(element.get('compression', 'none'), data)
+
+
+def decode_raw_mesh(content):
+    '''
+    Decode the content of a VTKMesh element of a prediction response sent in the raw format
+    :param content: dict content of the element
+    :return: tuple of numpy arrays, float32 vertices (N, 3) and uint32 triangles (M, 3)
+    '''
+    import numpy as np
+
+    vertices = np.frombuffer(base64.b64decode(content['vertices']), dtype='<f4').reshape([-1, 3])
+    triangles = np.frombuffer(base64.b64decode(content['triangles']), dtype='<u4').reshape([-1, 3])
+
+    return vertices.astype(np.float32), triangles.astype(np.uint32)
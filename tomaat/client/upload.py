@@ -0,0 +1,204 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+import requests
+
+
+'''
+Client side encoding of volumes for prediction requests. See tomaat.server.encoding for the format.
+'''
+
+
+__all__ = [
+    'encode_volume', 'compress_file', 'upload_resumable', 'VOLUME_CODECS', 'DEFAULT_CHUNK_SIZE', 'UPLOAD_REFERENCE_PREFIX'
+]
+
+VOLUME_CODECS = ['gzip', 'zstd']
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # bytes of compressed data per chunk
+READ_SIZE = 1024 * 1024
+
+UPLOAD_REFERENCE_PREFIX = 'upload:'
+
+try:
+    _string_types = basestring  # Python 2: str and unicode paths
+except NameError:
+    _string_types = str
+
+
+def _make_compressor(codec, level):
+    if codec == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('the zstd codec requires the zstandard package: pip install zstandard')
+
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    raise ValueError('unsupported codec {}'.format(codec))
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def encode_volume(volume, codec='gzip', level=6, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Compress a volume and split it in base64 encoded chunks, ready to be sent as the values of a volume field
+    :param volume: path of an MHA file or SimpleITK image
+    :param codec: 'gzip' or 'zstd'
+    :param level: compression level
+    :param chunk_size: maximum number of compressed bytes per chunk
+    :return: list of str chunks, the first one carries the codec header
+    '''
+    tmp_dir = None
+
+    if not isinstance(volume, _string_types):
+        import SimpleITK as sitk
+
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'volume.mha')
+        sitk.WriteImage(volume, filename)  # uncompressed, compression happens here
+    else:
+        filename = volume
+
+    compressor = _make_compressor(codec, level)
+
+    chunks = []
+    pending = []
+    pending_size = 0
+
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(READ_SIZE)
+
+                if not data:
+                    break
+
+                compressed = compressor.compress(data)
+
+                pending.append(compressed)
+                pending_size += len(compressed)
+
+                while pending_size >= chunk_size:
+                    buffer = b''.join(pending)
+                    chunks.append(_b64(buffer[:chunk_size]))
+                    pending = [buffer[chunk_size:]]
+                    pending_size = len(pending[0])
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    pending.append(compressor.flush())
+
+    buffer = b''.join(pending)
+    for start in range(0, len(buffer), chunk_size):
+        chunks.append(_b64(buffer[start:start + chunk_size]))
+
+    if not chunks:
+        chunks.append('')
+
+    chunks[0] = codec + '\n' + chunks[0]
+
+    return chunks
+
+
+def compress_file(filename, destination, codec='gzip', level=6):
+    '''
+    Compress a file with one of the codecs understood by the server
+    :param filename: path of the file to be compressed
+    :param destination: path of the compressed file
+    :param codec: 'gzip' or 'zstd'
+    :param level: compression level
+    '''
+    compressor = _make_compressor(codec, level)
+
+    with open(filename, 'rb') as f_in, open(destination, 'wb') as f_out:
+        for data in iter(lambda: f_in.read(READ_SIZE), b''):
+            f_out.write(compressor.compress(data))
+        f_out.write(compressor.flush())
+
+
+def upload_resumable(service_url, filename, codec=None, level=6, chunk_size=DEFAULT_CHUNK_SIZE, retries=5,
+                     retry_delay=1., verify=False):
+    '''
+    Upload a volume to a service through the resumable upload protocol. Interrupted transfers are resumed from the
+    last byte received by the server.
+    :param service_url: base URL of the service, for example https://localhost:9000
+    :param filename: path of the MHA file to be uploaded
+    :param codec: None, 'gzip' or 'zstd': the file is compressed before the upload
+    :param level: compression level
+    :param chunk_size: number of bytes sent per request
+    :param retries: number of consecutive failed requests tolerated before giving up
+    :param retry_delay: seconds to wait after a failed request
+    :param verify: certificate verification, see requests
+    :return: str value to place in the volume field of the prediction request
+    '''
+    service_url = service_url.rstrip('/')
+
+    tmp_dir = None
+
+    if codec is not None:
+        tmp_dir = tempfile.mkdtemp()
+        compressed = os.path.join(tmp_dir, 'volume.mha.' + codec)
+        compress_file(filename, compressed, codec, level)
+        filename = compressed
+
+    try:
+        size = os.path.getsize(filename)
+
+        data = {'size': str(size)}
+        if codec is not None:
+            data['codec'] = codec
+
+        response = requests.post(service_url + '/uploads', data=data, verify=verify)
+        response.raise_for_status()
+
+        status = response.json()
+        upload_url = service_url + '/uploads/' + status['upload_id']
+
+        failures = 0
+
+        with open(filename, 'rb') as f:
+            while True:
+                try:
+                    if status is None:
+                        # ask the server how many bytes it has received
+                        status = requests.get(upload_url, verify=verify).json()
+
+                    if status['complete']:
+                        break
+
+                    f.seek(status['offset'])
+                    chunk = f.read(chunk_size)
+
+                    response = requests.put(
+                        upload_url, data=chunk, headers={'X-Tomaat-Offset': str(status['offset'])}, verify=verify
+                    )
+
+                    if response.status_code not in [200, 409]:  # 409: offset out of sync, resume from server's
+                        response.raise_for_status()
+
+                    status = response.json()
+                    failures = 0
+                except requests.exceptions.RequestException:
+                    failures += 1
+
+                    if failures > retries:
+                        raise
+
+                    time.sleep(retry_delay)
+
+                    status = None
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    return UPLOAD_REFERENCE_PREFIX + status['upload_id']
@@ -0,0 +1,133 @@
+import re
+import threading
+import time
+import uuid
+
+
+'''
+A RequestContext travels with a request through the TomaatApp workflow. It is bound to the thread (or process) that
+processes the request, so that the app and the transforms can check it without changing their signatures.
+'''
+
+
+REQUEST_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def new_request_id():
+    '''
+    :return: str random request identifier, 32 hexadecimal digits
+    '''
+    return uuid.uuid4().hex
+
+
+def is_request_id(value):
+    '''
+    Request identifiers double as the right to cancel the request, so they must be as hard to guess as the ones
+    generated by new_request_id
+    :param value: str identifier supplied by a client
+    :return: bool True if value is made of 32 lowercase hexadecimal digits
+    '''
+    return value is not None and REQUEST_ID_PATTERN.match(value) is not None
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestContext(object):
+    def __init__(self, request_id=None, priority=1, deadline=None, cancel_event=None):
+        '''
+        RequestContext holds the scheduling information of a request
+        :param request_id: identifier of the request
+        :param priority: priority of the request, lower values are served first
+        :param deadline: absolute time (as returned by time.time()) after which the result is useless, None if absent
+        :param cancel_event: event set when the request is cancelled, by default a threading.Event. Requests processed
+        in another process need an event shared between processes, such as multiprocessing.Manager().Event()
+        '''
+        super(RequestContext, self).__init__()
+        self.request_id = request_id
+        self.priority = priority
+        self.deadline = deadline
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self.received = time.time()
+        self.progress_callback = None
+        self.trace = None  # tomaat.tracing.Trace recording the spans of the request, if traced
+        self.memory = None  # tomaat.memory.RequestMemory accounting the memory of the request, if accounted
+        self.scratch_check = None  # callable raising if the request wrote more than its quota of scratch space
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def checkpoint(self):
+        '''
+        Raise an exception if the work for this request should not continue: it was cancelled, its deadline expired
+        or it exceeded its scratch space quota
+        '''
+        if self.cancelled():
+            raise RequestCancelled('request {} was cancelled'.format(self.request_id))
+
+        if self.expired():
+            raise DeadlineExceeded('deadline of request {} expired'.format(self.request_id))
+
+        if self.scratch_check is not None:
+            self.scratch_check()
+
+    def report_progress(self, progress, partial_result=None):
+        '''
+        Publish the progress of the request, and optionally a partial result, through the progress callback, if any
+        :param progress: float fraction of the work done, between 0 and 1
+        :param partial_result: dict partial result with the fields of the output interface (e.g. a coarse segmentation)
+        '''
+        if self.progress_callback is not None:
+            self.progress_callback(progress, partial_result)
+
+
+_local = threading.local()
+
+
+def current_context():
+    return getattr(_local, 'context', None)
+
+
+def set_current_context(context):
+    _local.context = context
+
+
+def checkpoint():
+    '''
+    Check the context bound to the current thread, if any. See RequestContext.checkpoint
+    '''
+    context = current_context()
+
+    if context is not None:
+        context.checkpoint()
+
+
+def progress_requested():
+    '''
+    :return: bool True if the context bound to the current thread publishes progress, so that partial results that
+    are expensive to compute are worth computing
+    '''
+    context = current_context()
+
+    return context is not None and context.progress_callback is not None
+
+
+def report_progress(progress, partial_result=None):
+    '''
+    Report progress to the context bound to the current thread, if any. See RequestContext.report_progress
+    '''
+    context = current_context()
+
+    if context is not None:
+        context.report_progress(progress, partial_result)
@@ -0,0 +1,59 @@
+import sys, os
+# We need to add "tomaat"-directory (../..) to PATH to import the tomaat package
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))))
+
+from multiprocessing import Process
+
+from tomaat.server import TomaatService, TomaatApp, TomaatRouter
+
+NUMBER_OF_REPLICAS = 2
+
+config = {
+    "name": "Example TOMAAT router",
+    "modality": "Example Modality",
+    "task": "Example Task",
+    "anatomy": "Example Anatomy",
+    "description":"Example Description",
+    "port": 9000,
+    "announce": False,
+    "api_key": "",
+}
+
+iface_in = [{'type':'checkbox','destination':'checkbox','text':'checkbox test'}]
+iface_out = [{'type':'PlainText','field':'demotext'}]
+
+def preprocess(data_in):
+    return data_in
+
+def inference(data):
+    return data
+
+def postprocess(output):
+    return {
+        'demotext':["This answer was computed by process {}".format(os.getpid())],
+    }
+
+
+def run_replica(port):
+    replica_config = dict(config)
+    replica_config['port'] = port
+
+    my_app = TomaatApp(preprocess,inference,postprocess)
+
+    my_service = TomaatService(replica_config, my_app, iface_in, iface_out)
+
+    my_service.run()
+
+
+replica_ports = [config['port'] + 1 + i for i in range(NUMBER_OF_REPLICAS)]
+
+for port in replica_ports:
+    Process(target=run_replica, args=(port,)).start()
+
+# the replicas run on this machine with self-signed certificates, which cannot be verified
+router_config = dict(config)
+router_config['verify_replicas'] = False
+
+my_router = TomaatRouter(router_config, ['https://localhost:{}'.format(port) for port in replica_ports])
+
+my_router.run()
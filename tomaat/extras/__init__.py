@@ -1,2 +1,3 @@
 from .transforms import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .thread_budget import ThreadBudget, set_default_thread_budget, get_default_thread_budget
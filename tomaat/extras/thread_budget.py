@@ -0,0 +1,94 @@
+import multiprocessing
+import threading
+
+from contextlib import contextmanager
+
+
+'''
+SimpleITK filters use, by default, as many threads as there are cores. When several requests run their transforms at
+the same time, each one in its own worker thread, the cores end up oversubscribed. A ThreadBudget splits the cores
+among the pipelines running concurrently: transforms ask for their share right before executing a filter.
+'''
+
+_local = threading.local()
+
+_default_budget = None
+
+
+class ThreadBudget(object):
+    def __init__(self, total_threads=None):
+        '''
+        ThreadBudget shares a number of threads among the pipelines running concurrently
+        :param total_threads: number of threads to be shared, by default the number of cores
+        '''
+        super(ThreadBudget, self).__init__()
+        self.total_threads = total_threads if total_threads is not None else multiprocessing.cpu_count()
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def share(self):
+        '''
+        :return: int number of threads a pipeline can use right now
+        '''
+        return max(1, self.total_threads // max(1, self.active))
+
+    @contextmanager
+    def pipeline(self):
+        '''
+        Register the current thread as running a pipeline for the duration of the context. Nested registrations in
+        the same thread, for example a TransformChain run by a service that already registered, count once.
+        '''
+        if getattr(_local, 'budget', None) is self:
+            yield
+            return
+
+        previous = getattr(_local, 'budget', None)
+
+        with self.lock:
+            self.active += 1
+
+        _local.budget = self
+
+        try:
+            yield
+        finally:
+            _local.budget = previous
+
+            with self.lock:
+                self.active -= 1
+
+
+def set_default_thread_budget(budget):
+    '''
+    Set the budget used by the pipelines that do not specify one
+    :param budget: ThreadBudget or None to let SimpleITK use its global default
+    '''
+    global _default_budget
+    _default_budget = budget
+
+
+def get_default_thread_budget():
+    return _default_budget
+
+
+def current_thread_budget():
+    '''
+    :return: the budget of the pipeline running in the current thread, or the default one
+    '''
+    budget = getattr(_local, 'budget', None)
+
+    return budget if budget is not None else _default_budget
+
+
+def configure_filter(filter):
+    '''
+    Set the number of threads of a SimpleITK filter according to the current thread budget, if any
+    :param filter: SimpleITK filter
+    :return: the filter
+    '''
+    budget = current_thread_budget()
+
+    if budget is not None:
+        filter.SetNumberOfThreads(budget.share())
+
+    return filter
@@ -1,33 +1,150 @@
 import SimpleITK as sitk
+import multiprocessing
 import numpy as np
 import os
 
+from multiprocessing.pool import ThreadPool
+
+from .utils import FilterCache, make_memmap, to_memmap
+from ..sparse import bounding_box
+
 '''
 NOTE: The transforms that are added to the data during inference must be IDENTICAL to 
 those used during training on the original data, at least for what concerns the forward transform step
 '''
 
 
+class LazyImage(object):
+    def __init__(self, filename, remove=False):
+        '''
+        LazyImage gives access to the geometry of an ITK compatible file by reading only its header. Pixel data are
+        read when load is called, optionally restricted to a region of interest.
+        :param filename: path of the file
+        :param remove: whether the file should be removed once loaded
+        '''
+        super(LazyImage, self).__init__()
+        self.filename = filename
+        self.remove = remove
+
+        self.reader = sitk.ImageFileReader()
+        self.reader.SetFileName(filename)
+        self.reader.ReadImageInformation()
+
+    def GetSize(self):
+        return self.reader.GetSize()
+
+    def GetSpacing(self):
+        return self.reader.GetSpacing()
+
+    def GetOrigin(self):
+        return self.reader.GetOrigin()
+
+    def GetDirection(self):
+        return self.reader.GetDirection()
+
+    def GetDimension(self):
+        return self.reader.GetDimension()
+
+    def GetPixelID(self):
+        return self.reader.GetPixelID()
+
+    def load(self, roi=None):
+        '''
+        Read the pixel data
+        :param roi: None to read the whole volume, or tuple (index, size) of the region to read, which is clipped to the
+        extent of the volume. Only the region is read from files whose format supports streaming, such as MHA.
+        :return: SimpleITK image
+        '''
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.filename)
+
+        if roi is not None:
+            index, size = clip_region(roi[0], roi[1], self.GetSize())
+            reader.SetExtractIndex(index)
+            reader.SetExtractSize(size)
+
+        volume = reader.Execute()
+
+        if self.remove:
+            os.remove(self.filename)
+
+        return volume
+
+
+def clip_region(index, size, extent):
+    '''
+    Clip a region to the extent of a volume, keeping at least one voxel in each direction
+    :param index: first voxel of the region
+    :param size: size of the region
+    :param extent: size of the volume
+    :return: tuple (index, size) as lists of int
+    '''
+    start = [int(min(max(i, 0), e - 1)) for i, e in zip(index, extent)]
+    stop = [int(min(max(i + s, st + 1), e)) for i, s, st, e in zip(index, size, start, extent)]
+
+    return start, [b - a for a, b in zip(start, stop)]
+
+
 class FromITKFormatFilenameToSITK(object):
-    def __init__(self, fields):
+    def __init__(self, fields, lazy=False, roi=None, field_roi=None):
         '''
         FromITKFormatFilenameToSITK loads ITK compatible files
         :param fields: fields of the dictionary whose content should be replaced by SITK images
+        :param lazy: whether to read only the headers and replace the content with LazyImage handles instead of images.
+        Pixel data are then read by FromLazySITKToSITK.
+        :param roi: tuple (index, size) of the region to read from every volume, None to read whole volumes
+        :param field_roi: field of the data dictionary containing a region (index, size), or None, for each volume.
+        Takes precedence over roi.
         '''
         self.fields = fields
+        self.lazy = lazy
+        self.roi = roi
+        self.field_roi = field_roi
 
     def __call__(self, data):
         for field in self.fields:
             volume_list = []
-            for elem in data[field]:
-                volume = sitk.ReadImage(elem)
+            for i, elem in enumerate(data[field]):
+                volume = LazyImage(elem, remove=True)
+                if not self.lazy:
+                    volume = volume.load(roi_of(data, self.roi, self.field_roi, i))
                 volume_list.append(volume)
-                os.remove(elem)
             data[field] = volume_list
 
         return data
 
 
+class FromLazySITKToSITK(object):
+    def __init__(self, fields, roi=None, field_roi=None):
+        '''
+        FromLazySITKToSITK reads the pixel data of the LazyImage handles created by FromITKFormatFilenameToSITK. The
+        transforms in between can use the geometry of the volumes, for example to decide the region to read.
+        :param fields: fields of the dictionary whose content should be replaced by SITK images
+        :param roi: tuple (index, size) of the region to read from every volume, None to read whole volumes
+        :param field_roi: field of the data dictionary containing a region (index, size), or None, for each volume.
+        Takes precedence over roi.
+        '''
+        super(FromLazySITKToSITK, self).__init__()
+        self.fields = fields
+        self.roi = roi
+        self.field_roi = field_roi
+
+    def __call__(self, data):
+        for field in self.fields:
+            for i in range(len(data[field])):
+                if isinstance(data[field][i], LazyImage):
+                    data[field][i] = data[field][i].load(roi_of(data, self.roi, self.field_roi, i))
+
+        return data
+
+
+def roi_of(data, roi, field_roi, i):
+    if field_roi is not None and field_roi in data:
+        return data[field_roi][i]
+
+    return roi
+
+
 class FromSITKUint8ToSITKFloat32(object):
     def __init__(self, fields):
         '''
@@ -36,10 +153,16 @@ class FromSITKUint8ToSITKFloat32(object):
         '''
         super(FromSITKUint8ToSITKFloat32, self).__init__()
         self.fields = fields
+        self.filters = FilterCache()
 
-    def __call__(self, data):
+    def make_cast_filter(self):
         filter = sitk.CastImageFilter()
         filter.SetOutputPixelType(sitk.sitkFloat32)
+
+        return filter
+
+    def __call__(self, data):
+        filter = self.filters.get('cast', self.make_cast_filter)
         for field in self.fields:
             for i in range(len(data[field])):
                 data[field][i] = filter.Execute(data[field][i])
@@ -55,10 +178,16 @@ class FromSITKFloat32ToSITKUint8(object):
         '''
         super(FromSITKFloat32ToSITKUint8, self).__init__()
         self.fields = fields
+        self.filters = FilterCache()
 
-    def __call__(self, data):
+    def make_cast_filter(self):
         filter = sitk.CastImageFilter()
         filter.SetOutputPixelType(sitk.sitkUInt8)
+
+        return filter
+
+    def __call__(self, data):
+        filter = self.filters.get('cast', self.make_cast_filter)
         for field in self.fields:
             for i in range(len(data[field])):
                 data[field][i] = filter.Execute(data[field][i])
@@ -89,16 +218,21 @@ class FromSITKOriginalIntensitiesToRescaledIntensities(object):
         self.max = max_intensity
         self.field_original_ranges_min = field_original_ranges_min
         self.field_original_ranges_max = field_original_ranges_max
+        self.filters = FilterCache()
 
-    def __call__(self, data):
-        original_ranges_min = {}
-        original_ranges_max = {}
-
+    def make_rescaling_filter(self):
         rescaling_fiter = sitk.RescaleIntensityImageFilter()
         rescaling_fiter.SetOutputMaximum(self.max)
         rescaling_fiter.SetOutputMinimum(self.min)
 
-        min_max_filter = sitk.MinimumMaximumImageFilter()
+        return rescaling_fiter
+
+    def __call__(self, data):
+        original_ranges_min = {}
+        original_ranges_max = {}
+
+        rescaling_fiter = self.filters.get('rescale', self.make_rescaling_filter)
+        min_max_filter = self.filters.get('min_max', sitk.MinimumMaximumImageFilter)
 
         for field in self.fields:
             original_ranges_max[field] = []
@@ -109,7 +243,7 @@ class FromSITKOriginalIntensitiesToRescaledIntensities(object):
                 original_ranges_max[field].append(min_max_filter.GetMaximum())
                 original_ranges_min[field].append(min_max_filter.GetMinimum())
 
-                data[field][i] = rescaling_fiter.Execute(data[field][i], self.min, self.max)
+                data[field][i] = rescaling_fiter.Execute(data[field][i])
 
         data[self.field_original_ranges_min] = original_ranges_min
         data[self.field_original_ranges_max] = original_ranges_max
@@ -134,14 +268,16 @@ class FromSITKRescaledIntensitiesToOriginalIntensities(object):
         self.fields = fields
         self.field_original_ranges_min = field_original_ranges_min
         self.field_original_ranges_max = field_original_ranges_max
+        self.filters = FilterCache()
 
     def __call__(self, data):
         original_ranges_min = data[self.field_original_ranges_min]
         original_ranges_max = data[self.field_original_ranges_max]
+
+        rescaling_fiter = self.filters.get('rescale', sitk.RescaleIntensityImageFilter)
+
         for field in self.fields:
             for i in range(len(data[field])):
-                rescaling_fiter = sitk.RescaleIntensityImageFilter()
-
                 rescaling_fiter.SetOutputMaximum(original_ranges_max[field][i])
                 rescaling_fiter.SetOutputMinimum(original_ranges_min[field][i])
 
@@ -151,22 +287,39 @@ class FromSITKRescaledIntensitiesToOriginalIntensities(object):
 
 
 class FromSITKOriginalResolutionToStandardResolution(object):
-    def __init__(self, fields, resolution, field_original_spacings='original_spacings', field_spacing_metric=None):
+    def __init__(self,
+                 fields,
+                 resolution,
+                 field_original_spacings='original_spacings',
+                 field_spacing_metric=None,
+                 interpolator=sitk.sitkLinear
+                 ):
         '''
         FromSITKOriginalResolutionToStandardResolution makes all the volumes have the same resolution
         :param fields: fields of the dictionary whose content should be modified
         :param resolution: the new resolution of the data in three directions
         :param field_original_spacings: field to use for the data dictionary to store original resolutions
+        :param interpolator: SimpleITK interpolator, for example sitk.sitkLinear or sitk.sitkNearestNeighbor
         '''
         super(FromSITKOriginalResolutionToStandardResolution, self).__init__()
         self.fields = fields
         self.resolution = resolution
         self.field_original_spacings = field_original_spacings
         self.field_spacing_metric = field_spacing_metric
+        self.interpolator = interpolator
+        self.filters = FilterCache()
+
+    def make_resampler(self):
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetInterpolator(self.interpolator)
+
+        return resampler
 
     def __call__(self, data):
         original_spacings = {}
 
+        resampler = self.filters.get('resample', self.make_resampler)
+
         for field in self.fields:
             original_spacings[field] = []
 
@@ -185,10 +338,9 @@ class FromSITKOriginalResolutionToStandardResolution(object):
 
                 original_spacings[field].append(data[field][i].GetSpacing())
 
-                resampler = sitk.ResampleImageFilter()
                 resampler.SetReferenceImage(data[field][i])
-                resampler.SetOutputSpacing(resolution)
-                resampler.SetSize(new_size)
+                resampler.SetOutputSpacing([float(s) for s in resolution])
+                resampler.SetSize([int(s) for s in new_size])
 
                 data[field][i] = resampler.Execute(data[field][i])
         data[self.field_original_spacings] = original_spacings
@@ -197,41 +349,199 @@ class FromSITKOriginalResolutionToStandardResolution(object):
 
 
 class FromSITKStandardResolutionToOriginalResolution(object):
-    def __init__(self, fields, field_original_spacings='original_spacings'):
+    def __init__(self, fields, field_original_spacings='original_spacings', interpolator=None):
         '''
         FromSITKStandardResolutionToOriginalResolution makes all the volumes return to their original resolution
         :param fields: fields of the dictionary whose content should be modified
         :param field_original_spacings: the fields of the data dictionary where the original resolutions are stored
+        :param interpolator: SimpleITK interpolator. By default label maps with an integer pixel type, such as the
+        output of ArgmaxNumpy or ThresholdNumpy with dtype=np.uint8, use nearest neighbour, other volumes linear.
         '''
         super(FromSITKStandardResolutionToOriginalResolution, self).__init__()
         self.fields = fields
         self.field_original_spacings = field_original_spacings
+        self.interpolator = interpolator
+        self.filters = FilterCache()
 
     def __call__(self, data):
         original_spacings = data[self.field_original_spacings]
 
+        resampler = self.filters.get('resample', sitk.ResampleImageFilter)
+
         for field in self.fields:
             for i in range(len(data[field])):
                 factor = \
                     np.asarray(data[field][i].GetSpacing()) / np.asarray(original_spacings[field][i], dtype=float)
                 new_size = np.asarray(data[field][i].GetSize() * factor, dtype=int)
 
-                resampler = sitk.ResampleImageFilter()
+                resampler.SetInterpolator(self.interpolator if self.interpolator is not None else
+                                          default_interpolator(data[field][i]))
                 resampler.SetReferenceImage(data[field][i])
                 resampler.SetOutputSpacing(original_spacings[field][i])
-                resampler.SetSize(new_size)
+                resampler.SetSize([int(s) for s in new_size])
+
+                data[field][i] = resampler.Execute(data[field][i])
+
+        return data
+
+
+class FromSITKOriginalToStandardGrid(object):
+    def __init__(self,
+                 fields,
+                 resolution,
+                 size,
+                 field_original_geometries='original_geometries',
+                 field_spacing_metric=None,
+                 interpolator=sitk.sitkLinear,
+                 default_value=0.
+                 ):
+        '''
+        FromSITKOriginalToStandardGrid resamples the volumes directly onto a grid of fixed size and resolution, centred
+        on the volume. It is equivalent to FromSITKOriginalResolutionToStandardResolution followed by
+        FromNumpyOriginalSizeToStandardSize, with a single interpolation and without the intermediate volume.
+        :param fields: fields of the dictionary whose content should be modified
+        :param resolution: the resolution of the grid in three directions
+        :param size: the size of the grid in three directions, typically the input size of the model
+        :param field_original_geometries: field to use in data dictionary to store the original geometries
+        :param field_spacing_metric: field of the data dictionary containing the unit of the spacing of each volume,
+        'millimeters' or 'meters', None for millimeters
+        :param interpolator: SimpleITK interpolator, for example sitk.sitkLinear or sitk.sitkNearestNeighbor
+        :param default_value: value of the grid points falling outside of the volume
+        '''
+        super(FromSITKOriginalToStandardGrid, self).__init__()
+        self.fields = fields
+        self.resolution = resolution
+        self.size = size
+        self.field_original_geometries = field_original_geometries
+        self.field_spacing_metric = field_spacing_metric
+        self.interpolator = interpolator
+        self.default_value = default_value
+        self.filters = FilterCache()
+
+    def make_resampler(self):
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetInterpolator(self.interpolator)
+        resampler.SetDefaultPixelValue(self.default_value)
+        resampler.SetSize([int(s) for s in self.size])
+
+        return resampler
+
+    def __call__(self, data):
+        original_geometries = {}
+
+        resampler = self.filters.get('resample', self.make_resampler)
+
+        for field in self.fields:
+            original_geometries[field] = []
+
+            for i in range(len(data[field])):
+                volume = data[field][i]
+
+                resolution = np.asarray(self.resolution, dtype=float)
+                if self.field_spacing_metric is not None and data[self.field_spacing_metric][i] == 'meters':
+                    resolution = resolution / 1000.
+
+                original_geometries[field].append(image_geometry(volume))
+
+                # the centre of the grid is the centre of the volume
+                centre = np.asarray(
+                    volume.TransformContinuousIndexToPhysicalPoint((np.asarray(volume.GetSize()) - 1) / 2.)
+                )
+                direction = np.asarray(volume.GetDirection()).reshape([3, 3])
+                half_extent = (np.asarray(self.size, dtype=float) - 1) / 2. * resolution
+
+                resampler.SetOutputDirection(volume.GetDirection())
+                resampler.SetOutputSpacing([float(s) for s in resolution])
+                resampler.SetOutputOrigin([float(o) for o in centre - np.dot(direction, half_extent)])
+
+                data[field][i] = resampler.Execute(volume)
+
+        data[self.field_original_geometries] = original_geometries
+
+        return data
+
+
+class FromSITKStandardGridToOriginal(object):
+    def __init__(self,
+                 fields,
+                 field_original_geometries='original_geometries',
+                 interpolator=sitk.sitkNearestNeighbor,
+                 default_value=0.
+                 ):
+        '''
+        FromSITKStandardGridToOriginal resamples the volumes produced on the grid of FromSITKOriginalToStandardGrid,
+        for example label maps, back onto the geometry of the original volumes with a single interpolation
+        :param fields: fields of the dictionary whose content should be modified
+        :param field_original_geometries: field of the data dictionary where the original geometries are stored
+        :param interpolator: SimpleITK interpolator, nearest neighbour by default to keep labels intact
+        :param default_value: value of the points of the original volume falling outside of the grid
+        '''
+        super(FromSITKStandardGridToOriginal, self).__init__()
+        self.fields = fields
+        self.field_original_geometries = field_original_geometries
+        self.interpolator = interpolator
+        self.default_value = default_value
+        self.filters = FilterCache()
+
+    def make_resampler(self):
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetInterpolator(self.interpolator)
+        resampler.SetDefaultPixelValue(self.default_value)
+
+        return resampler
+
+    def __call__(self, data):
+        original_geometries = data[self.field_original_geometries]
+
+        resampler = self.filters.get('resample', self.make_resampler)
+
+        for field in self.fields:
+            for i in range(len(data[field])):
+                geometry = original_geometries[field][i]
+
+                resampler.SetSize(geometry['size'])
+                resampler.SetOutputSpacing(geometry['spacing'])
+                resampler.SetOutputOrigin(geometry['origin'])
+                resampler.SetOutputDirection(geometry['direction'])
 
                 data[field][i] = resampler.Execute(data[field][i])
 
         return data
 
 
+def image_geometry(volume):
+    '''
+    :param volume: SimpleITK image
+    :return: dict containing size, spacing, origin and direction of the image
+    '''
+    return {
+        'size': [int(s) for s in volume.GetSize()],
+        'spacing': volume.GetSpacing(),
+        'origin': volume.GetOrigin(),
+        'direction': volume.GetDirection(),
+    }
+
+
+def default_interpolator(volume):
+    '''
+    :param volume: SimpleITK image
+    :return: nearest neighbour interpolation for integer pixel types, which hold labels, linear otherwise
+    '''
+    if 'integer' in volume.GetPixelIDTypeAsString():
+        return sitk.sitkNearestNeighbor
+
+    return sitk.sitkLinear
+
+
 class FromSITKToNumpy(object):
     def __init__(self,
                  fields,
                  field_original_spacing='original_spacings_NP',
                  field_original_direction='original_directions_NP',
-                 field_original_origins='original_origins_NP'
+                 field_original_origins='original_origins_NP',
+                 memmap=False,
+                 field_savepath='savepath',
+                 dtype=np.float32
                  ):
         '''
         FromSITKToNumpy converts SITK data in numpy arrays
@@ -239,12 +549,18 @@ class FromSITKToNumpy(object):
         :param field_original_spacing: field data dictionary used to store original spacing of sitk volumes
         :param field_original_direction: field data dictionary used to store original direction of sitk volumes
         :param field_original_origins: field data dictionary used to store original origin coordinate of sitk volumes
+        :param memmap: whether to store the arrays in files instead of memory (see MemmapArrays)
+        :param field_savepath: field of the data dictionary containing the directory where the files are stored
+        :param dtype: type of the arrays, None to keep the pixel type of the images
         '''
         super(FromSITKToNumpy, self).__init__()
         self.fields = fields
         self.field_original_spacing = field_original_spacing
         self.field_original_direction = field_original_direction
         self.field_original_origins = field_original_origins
+        self.memmap = memmap
+        self.field_savepath = field_savepath
+        self.dtype = dtype
 
     def __call__(self, data):
         original_directions = {}
@@ -261,7 +577,16 @@ class FromSITKToNumpy(object):
                 original_directions[field].append(data[field][i].GetDirection())
                 original_origins[field].append(data[field][i].GetOrigin())
 
-                data[field][i] = np.transpose(sitk.GetArrayFromImage(data[field][i]).astype(dtype=np.float32), [2, 1, 0])
+                view = np.transpose(sitk.GetArrayViewFromImage(data[field][i]), [2, 1, 0])
+                dtype = self.dtype if self.dtype is not None else view.dtype
+
+                if self.memmap:
+                    # copied straight from the image buffer into the file, without an intermediate array
+                    array = make_memmap(view.shape, dtype, data.get(self.field_savepath, None))
+                    array[...] = view
+                    data[field][i] = array
+                else:
+                    data[field][i] = view.astype(dtype)
 
         data[self.field_original_spacing] = original_spacings
         data[self.field_original_direction] = original_directions
@@ -270,6 +595,33 @@ class FromSITKToNumpy(object):
         return data
 
 
+class MemmapArrays(object):
+    def __init__(self, fields, field_savepath='savepath'):
+        '''
+        MemmapArrays moves numpy arrays to files, so that the operating system can page them out and other processes
+        can map them without copying. The files are stored in the scratch directory of the request, which the service
+        removes once the response is sent. Without a scratch directory anonymous temporary files are used, which
+        disappear together with the arrays.
+        :param fields: fields of the dictionary whose content should be modified, either lists of arrays or arrays
+        :param field_savepath: field of the data dictionary containing the directory where the files are stored
+        '''
+        super(MemmapArrays, self).__init__()
+        self.fields = fields
+        self.field_savepath = field_savepath
+
+    def __call__(self, data):
+        directory = data.get(self.field_savepath, None)
+
+        for field in self.fields:
+            if isinstance(data[field], np.ndarray):
+                data[field] = to_memmap(data[field], directory)
+            else:
+                for i in range(len(data[field])):
+                    data[field][i] = to_memmap(data[field][i], directory)
+
+        return data
+
+
 class FromNumpyToSITK(object):
     def __init__(self,
                  fields,
@@ -312,7 +664,8 @@ class FromNumpyOriginalSizeToStandardSize(object):
                  size,
                  field_pads='pads_std_size',
                  field_crops="crops_std_size",
-                 field_original_sizes='original_sizes_std_size'
+                 field_original_sizes='original_sizes_std_size',
+                 buffer_pool=None
                  ):
         '''
         FromNumpyOriginalSizeToStandardSize resizes data to predefined size.
@@ -321,6 +674,8 @@ class FromNumpyOriginalSizeToStandardSize(object):
         :param field_pads: field of data dictionary to use to store paddings used in this transform
         :param field_crops: field of data dictionary to use to store crops used in this transform
         :param field_original_sizes: field of data dictionary to use to store sizes used in this transform
+        :param buffer_pool: optional BufferPool providing the output arrays. Pooled outputs are recycled the next time
+        this transform runs in the same thread
         '''
         self.fields = fields
         self.size = np.asarray(size)
@@ -329,6 +684,8 @@ class FromNumpyOriginalSizeToStandardSize(object):
         self.field_crops = field_crops
         self.field_original_sizes = field_original_sizes
 
+        self.buffer_pool = buffer_pool
+
     def __call__(self, data):
         pads = {}
         crops = {}
@@ -340,37 +697,13 @@ class FromNumpyOriginalSizeToStandardSize(object):
             for i in range(len(data[field])):
                 original_sizes[field].append(np.asarray(data[field][i].shape))
 
-                pad_amount = self.size - data[field][i].shape
-
-                pad_before = np.floor(pad_amount / 2.).astype(int)
-                pad_after = np.ceil(pad_amount / 2.).astype(int)
-
-                pad_before[pad_before < 0] = 0
-                pad_after[pad_after < 0] = 0
-
-                pad_vec = ((pad_before[0], pad_after[0]), (pad_before[1], pad_after[1]), (pad_before[2], pad_after[2]))
-
-                data_t = np.pad(data[field][i], pad_vec, mode='constant')
+                pad_vec, crop_vec, original_slices, resized_slices = pad_crop_regions(data[field][i].shape, self.size)
 
-                crop_amount = data_t.shape - self.size
-
-                crop_before = np.floor(crop_amount / 2.).astype(int)
-                crop_after = np.ceil(crop_amount / 2.).astype(int)
-
-                crop_before[crop_before < 0] = 0
-                crop_after[crop_after < 0] = 0
-
-                crop_vec = (
-                    (crop_before[0], crop_after[0]),
-                    (crop_before[1], crop_after[1]),
-                    (crop_before[2], crop_after[2])
+                # copy the overlapping region only, no intermediate padded volume is created
+                data_t = make_zeroed_buffer(
+                    self.buffer_pool, (id(self), field, i), tuple(self.size), data[field][i].dtype, np.any(pad_vec)
                 )
-
-                data_t = data_t[
-                         crop_vec[0][0]:data_t.shape[0] - crop_vec[0][1],
-                         crop_vec[1][0]:data_t.shape[1] - crop_vec[1][1],
-                         crop_vec[2][0]:data_t.shape[2] - crop_vec[2][1]
-                         ]
+                data_t[resized_slices] = data[field][i][original_slices]
 
                 crops[field].append(crop_vec)
                 pads[field].append(pad_vec)
@@ -390,7 +723,8 @@ class FromNumpyStandardSizeToOriginalSize(object):
                  fields,
                  field_pads='pads_std_size',
                  field_crops="crops_std_size",
-                 field_original_sizes='original_sizes_std_size'
+                 field_original_sizes='original_sizes_std_size',
+                 buffer_pool=None
                  ):
         '''
         FromNumpyOriginalSizeToStandardSize resizes data to original size. This method pads with zeros
@@ -399,6 +733,8 @@ class FromNumpyStandardSizeToOriginalSize(object):
         :param field_pads: field of data dictionary to use to read paddings used in this transform
         :param field_crops: field of data dictionary to use to read crops used in this transform
         :param field_original_sizes: field of data dictionary to use to read sizes used in this transform
+        :param buffer_pool: optional BufferPool providing the output arrays. Pooled outputs are recycled the next time
+        this transform runs in the same thread
         '''
         self.fields = fields
 
@@ -406,18 +742,29 @@ class FromNumpyStandardSizeToOriginalSize(object):
         self.field_crops = field_crops
         self.field_original_sizes = field_original_sizes
 
+        self.buffer_pool = buffer_pool
+
     def __call__(self, data):
         pads = data[self.field_pads]
         crops = data[self.field_crops]
         original_sizes = data[self.field_original_sizes]
         for field in self.fields:
             for i in range(len(data[field])):
-                data_t = np.pad(data[field][i], crops[field][i], mode='constant')
-                data_t = data_t[
-                         pads[field][i][0][0]:data_t.shape[0] - pads[field][i][0][1],
-                         pads[field][i][1][0]:data_t.shape[1] - pads[field][i][1][1],
-                         pads[field][i][2][0]:data_t.shape[2] - pads[field][i][2][1]
-                         ]
+                original_size = tuple(int(s) for s in original_sizes[field][i])
+                shape = data[field][i].shape
+
+                original_slices = tuple(
+                    slice(crops[field][i][d][0], original_size[d] - crops[field][i][d][1]) for d in range(3)
+                )
+                resized_slices = tuple(
+                    slice(pads[field][i][d][0], shape[d] - pads[field][i][d][1]) for d in range(3)
+                )
+
+                data_t = make_zeroed_buffer(
+                    self.buffer_pool, (id(self), field, i), original_size, data[field][i].dtype,
+                    np.any(crops[field][i])
+                )
+                data_t[original_slices] = data[field][i][resized_slices]
 
                 data[field][i] = data_t
 
@@ -426,6 +773,27 @@ class FromNumpyStandardSizeToOriginalSize(object):
         return data
 
 
+def make_zeroed_buffer(buffer_pool, key, shape, dtype, needs_zeros):
+    '''
+    Get an output array from a buffer pool, or allocate it if no pool is given
+    :param buffer_pool: BufferPool or None
+    :param key: key identifying the buffer in the pool
+    :param shape: shape of the array
+    :param dtype: type of the array
+    :param needs_zeros: whether part of the array will not be overwritten and must therefore be zero
+    :return: numpy array
+    '''
+    if buffer_pool is None:
+        return np.zeros(shape, dtype=dtype) if needs_zeros else np.empty(shape, dtype=dtype)
+
+    buffer = buffer_pool.get(key, shape, dtype)
+
+    if needs_zeros:
+        buffer.fill(0)
+
+    return buffer
+
+
 class FromListToNumpy5DArray(object):
     def __init__(self, fields):
         '''
@@ -461,123 +829,944 @@ class FromNumpy5DArrayToList(object):
         return data
 
 
-class FromLabelVolumeToVTKMesh(object):
-    mesh_reduction_percentage = 0.90
-
-    def __init__(
-            self,
-            label_filed,
-            mesh_field,
-            return_VTK_field='return_VTK',
-            spacings_field='original_spacings_NP',
-            sizes_field='original_sizes_std_size',
-            origins_field='original_origins_NP',
-            directions_field='original_directions_NP',
-            convert_to_ras_field='RAS'
-    ):
-
-        self.label_filed = label_filed
-        self.mesh_field = mesh_field
-        self.return_VTK_field = return_VTK_field
-        self.spacings_field = spacings_field
-        self.sizes_field = sizes_field
-        self.origins_field = origins_field
-        self.directions_field = directions_field
-        self.convert_to_ras_field = convert_to_ras_field
+def pad_crop_regions(shape, size):
+    '''
+    Compute how a volume of a given shape is centred into a volume of a given size, padding and cropping as needed
+    :param shape: shape of the original volume
+    :param size: desired size
+    :return: pad_vec, crop_vec (as stored by FromNumpyOriginalSizeToStandardSize), and the slices of the region
+    shared by the two volumes in the original volume and in the resized one
+    '''
+    shape = np.asarray(shape[:3])
+    size = np.asarray(size)
 
-    def __call__(self, data):
-        import vtk
-        from vtk.util.numpy_support import numpy_to_vtk
+    pad_amount = size - shape
 
-        meshes = []
+    pad_before = np.floor(pad_amount / 2.).astype(int)
+    pad_after = np.ceil(pad_amount / 2.).astype(int)
 
-        for label, spacing, origin, size, direction, return_VTK, convert_to_ras in zip(
-                data[self.label_filed],
-                data[self.spacings_field][self.label_filed],
-                data[self.origins_field][self.label_filed],
-                data[self.sizes_field][self.label_filed],
-                data[self.directions_field][self.label_filed],
-                data[self.return_VTK_field],
-                data[self.convert_to_ras_field],
-        ):
-            if return_VTK == "False":
-                continue
+    pad_before[pad_before < 0] = 0
+    pad_after[pad_after < 0] = 0
 
-            label = np.transpose(np.copy(label), [2, 1, 0])
+    crop_amount = -pad_amount
 
-            vtk_voxelmap = vtk.vtkImageData()
-            vtk_voxelmap.SetSpacing(spacing[0], spacing[1], spacing[2])
-            vtk_voxelmap.SetOrigin(origin[0], origin[1], origin[2])
-            vtk_voxelmap.SetDimensions(size[0], size[1], size[2])
-            vtk_voxelmap.SetScalarType(vtk.VTK_FLOAT)
+    crop_before = np.floor(crop_amount / 2.).astype(int)
+    crop_after = np.ceil(crop_amount / 2.).astype(int)
 
-            vtk_data_array = numpy_to_vtk(num_array=label.ravel(), deep=True, array_type=vtk.VTK_FLOAT)
+    crop_before[crop_before < 0] = 0
+    crop_after[crop_after < 0] = 0
 
-            points = vtk_voxelmap.GetPointData()
-            points.SetScalars(vtk_data_array)
+    pad_vec = tuple((pad_before[i], pad_after[i]) for i in range(3))
+    crop_vec = tuple((crop_before[i], crop_after[i]) for i in range(3))
 
-            contour = vtk.vtkDiscreteMarchingCubes()
-            contour.SetInput(vtk_voxelmap)
-            contour.ComputeNormalsOn()
-            contour.GenerateValues(1, 1, 1)
-            contour.Update()
+    overlap = np.minimum(shape, size)
 
-            polydata = vtk.vtkPolyData()
-            polydata.DeepCopy(contour.GetOutput())
+    original_slices = tuple(slice(crop_before[i], crop_before[i] + overlap[i]) for i in range(3))
+    resized_slices = tuple(slice(pad_before[i], pad_before[i] + overlap[i]) for i in range(3))
 
-            smoother = vtk.vtkSmoothPolyDataFilter()
-            smoother.SetInput(polydata)
-            smoother.SetNumberOfIterations(150)
-            smoother.SetFeatureAngle(60)
-            smoother.SetRelaxationFactor(0.05)
-            smoother.FeatureEdgeSmoothingOff()
-            smoother.Update()
+    return pad_vec, crop_vec, original_slices, resized_slices
 
-            transform = vtk.vtkTransform()
-            if convert_to_ras == 'True':
-                mat = np.asarray(direction).reshape([3, 3])
-                conversion_mat = np.asarray([-1, 0, 0, 0, -1, 0, 0, 0, 1]).reshape([3, 3])
-                direction = np.matmul(conversion_mat, mat).flatten()
 
-            dir_homo = np.asarray([direction[0], direction[1], direction[2], 0.,
-                                   direction[3], direction[4], direction[5], 0.,
-                                   direction[6], direction[7], direction[8], 0.,
-                                   0., 0., 0., 1.]).reshape([4, 4])
+class FromNumpyListToStandardSize5DArray(object):
+    def __init__(self,
+                 fields,
+                 size,
+                 dtype=np.float32,
+                 field_pads='pads_std_size',
+                 field_crops="crops_std_size",
+                 field_original_sizes='original_sizes_std_size'
+                 ):
+        '''
+        FromNumpyListToStandardSize5DArray resizes a list of volumes to a predefined size and stacks them in a single
+        5D array (N, X, Y, Z, 1) ready for inference. It replaces FromNumpyOriginalSizeToStandardSize followed by
+        FromListToNumpy5DArray: each volume is copied once, directly into its place in the batch.
+        :param fields: fields of the dictionary whose content should be modified
+        :param size: desired image size in the three directions
+        :param dtype: type of the 5D array
+        :param field_pads: field of data dictionary to use to store paddings used in this transform
+        :param field_crops: field of data dictionary to use to store crops used in this transform
+        :param field_original_sizes: field of data dictionary to use to store sizes used in this transform
+        '''
+        self.fields = fields
+        self.size = np.asarray(size)
+        self.dtype = dtype
 
-            transform.SetMatrix(dir_homo.flatten())
+        self.field_pads = field_pads
+        self.field_crops = field_crops
+        self.field_original_sizes = field_original_sizes
 
-            transformFilter = vtk.vtkTransformPolyDataFilter()
-            transformFilter.SetTransform(transform)
-            transformFilter.SetInputConnection(smoother.GetOutputPort())
-            transformFilter.Update()
+    def __call__(self, data):
+        pads = {}
+        crops = {}
+        original_sizes = {}
+        for field in self.fields:
+            pads[field] = []
+            crops[field] = []
+            original_sizes[field] = []
 
-            mesh = vtk.vtkPolyData()
+            batch = np.zeros((len(data[field]),) + tuple(self.size) + (1,), dtype=self.dtype)
 
-            mesh.ShallowCopy(transformFilter.GetOutput())
+            for i in range(len(data[field])):
+                original_sizes[field].append(np.asarray(data[field][i].shape))
 
-            decimator = vtk.vtkDecimatePro()
-            decimator.SetInput(mesh)
-            decimator.SetTargetReduction(self.mesh_reduction_percentage)
-            decimator.SetPreserveTopology(1)
-            decimator.Update()
+                pad_vec, crop_vec, original_slices, resized_slices = pad_crop_regions(data[field][i].shape, self.size)
 
-            clean_poly_data_filter = vtk.vtkCleanPolyData()
-            clean_poly_data_filter.SetInput(decimator.GetOutput())
-            clean_poly_data_filter.Update()
+                batch[(i,) + resized_slices + (0,)] = data[field][i][original_slices]
 
-            meshes.append(clean_poly_data_filter.GetOutput())
+                pads[field].append(pad_vec)
+                crops[field].append(crop_vec)
 
-        data[self.mesh_field] = meshes
+            data[field] = batch
 
+        data[self.field_pads] = pads
+        data[self.field_crops] = crops
+        data[self.field_original_sizes] = original_sizes
         return data
 
 
-class ThresholdNumpy(object):
-    def __init__(self, image_field, threshold_field):
-        self.image_field = image_field
-        self.threshold_field = threshold_field
+class FromStandardSize5DArrayToNumpyList(object):
+    def __init__(self,
+                 fields,
+                 field_pads='pads_std_size',
+                 field_crops="crops_std_size",
+                 field_original_sizes='original_sizes_std_size'
+                 ):
+        '''
+        FromStandardSize5DArrayToNumpyList splits a 5D array (N, X, Y, Z, C) in a list of volumes having their
+        original size. It replaces FromNumpy5DArrayToList followed by FromNumpyStandardSizeToOriginalSize.
+        Single channel outputs produce 3D volumes, multi channel outputs produce 4D volumes (X, Y, Z, C).
+        :param fields: fields of the dictionary whose content should be modified
+        :param field_pads: field of data dictionary to use to read paddings used in this transform
+        :param field_crops: field of data dictionary to use to read crops used in this transform
+        :param field_original_sizes: field of data dictionary to use to read sizes used in this transform
+        '''
+        self.fields = fields
+
+        self.field_pads = field_pads
+        self.field_crops = field_crops
+        self.field_original_sizes = field_original_sizes
 
     def __call__(self, data):
-        data[self.image_field] = (data[self.image_field] >= data[self.threshold_field]).astype(np.float32)
+        original_sizes = data[self.field_original_sizes]
+        for field in self.fields:
+            batch = data[field]
+            channels = batch.shape[4:]
+            if channels == (1,):
+                channels = ()
 
-        return data
+            data_t = []
+            for i in range(batch.shape[0]):
+                original_size = tuple(original_sizes[field][i][:3])
+
+                _, _, original_slices, resized_slices = pad_crop_regions(original_size, batch.shape[1:4])
+
+                volume = np.zeros(original_size + channels, dtype=batch.dtype)
+                volume[original_slices] = batch[i][resized_slices].reshape(volume[original_slices].shape)
+
+                data_t.append(volume)
+
+            data[field] = data_t
+
+        return data
+
+
+class RescaleIntensities5DArray(object):
+    def __init__(self,
+                 fields,
+                 min_intensity=0.,
+                 max_intensity=1.,
+                 field_original_ranges_min='original_ranges_min',
+                 field_original_ranges_max='original_ranges_max',
+                 field_original_sizes='original_sizes_std_size'
+                 ):
+        '''
+        RescaleIntensities5DArray rescales each volume of a 5D array (N, X, Y, Z, C) to the same intensity range.
+        Volumes padded by FromNumpyListToStandardSize5DArray are rescaled as they would have been before padding:
+        the intensity range is measured on the original voxels only and the padding is left untouched.
+        :param fields: fields of the dictionary whose content should be modified
+        :param min_intensity: the lower end of the new intensity range
+        :param max_intensity: the higher end of the new intensity range
+        :param field_original_ranges_min: field to use in data dictionary to store original intensity minima
+        :param field_original_ranges_max: field to use in data dictionary to store original intensity maxima
+        :param field_original_sizes: field of data dictionary containing the sizes stored by
+        FromNumpyListToStandardSize5DArray. If absent the whole volumes are rescaled
+        '''
+        self.fields = fields
+        self.min = min_intensity
+        self.max = max_intensity
+        self.field_original_ranges_min = field_original_ranges_min
+        self.field_original_ranges_max = field_original_ranges_max
+        self.field_original_sizes = field_original_sizes
+
+    def __call__(self, data):
+        original_ranges_min = {}
+        original_ranges_max = {}
+
+        for field in self.fields:
+            batch = data[field]
+            if not np.issubdtype(batch.dtype, np.floating):
+                batch = batch.astype(np.float32)
+
+            original_sizes = data.get(self.field_original_sizes, {}).get(field)
+
+            if original_sizes is not None:
+                minima, maxima = self.rescale_valid_regions(batch, original_sizes)
+
+                data[field] = batch
+
+                original_ranges_min[field] = minima
+                original_ranges_max[field] = maxima
+
+                continue
+
+            flat = batch.reshape(batch.shape[0], -1)
+            minima = flat.min(axis=1)
+            maxima = flat.max(axis=1)
+
+            ranges = maxima - minima
+            scale = np.where(ranges > 0, (self.max - self.min) / np.where(ranges > 0, ranges, 1), 0)
+
+            broadcast_shape = (-1,) + (1,) * (batch.ndim - 1)
+
+            batch -= minima.reshape(broadcast_shape).astype(batch.dtype)
+            batch *= scale.reshape(broadcast_shape).astype(batch.dtype)
+            batch += batch.dtype.type(self.min)
+
+            data[field] = batch
+
+            original_ranges_min[field] = minima.tolist()
+            original_ranges_max[field] = maxima.tolist()
+
+        data[self.field_original_ranges_min] = original_ranges_min
+        data[self.field_original_ranges_max] = original_ranges_max
+
+        return data
+
+    def rescale_valid_regions(self, batch, original_sizes):
+        '''
+        Rescale, in place, the region of each volume holding original voxels
+        :param batch: floating point 5D array
+        :param original_sizes: list of the original sizes of the volumes
+        :return: lists of the minima and maxima of the original voxels
+        '''
+        minima = []
+        maxima = []
+
+        for i in range(batch.shape[0]):
+            _, _, _, resized_slices = pad_crop_regions(tuple(original_sizes[i][:3]), batch.shape[1:4])
+
+            region = batch[i][resized_slices]  # a view, modified in place
+
+            minimum = region.min()
+            maximum = region.max()
+
+            value_range = maximum - minimum
+            scale = (self.max - self.min) / value_range if value_range > 0 else 0
+
+            region -= minimum
+            region *= batch.dtype.type(scale)
+            region += batch.dtype.type(self.min)
+
+            minima.append(float(minimum))
+            maxima.append(float(maximum))
+
+        return minima, maxima
+
+
+class RestoreIntensities5DArray(object):
+    def __init__(self,
+                 fields,
+                 min_intensity=0.,
+                 max_intensity=1.,
+                 field_original_ranges_min='original_ranges_min',
+                 field_original_ranges_max='original_ranges_max'
+                 ):
+        '''
+        RestoreIntensities5DArray brings each volume of a 5D array back to the intensity range it had before
+        RescaleIntensities5DArray.
+        :param fields: fields of the dictionary whose content should be modified
+        :param min_intensity: the lower end of the intensity range used by RescaleIntensities5DArray
+        :param max_intensity: the higher end of the intensity range used by RescaleIntensities5DArray
+        :param field_original_ranges_min: field in the data dictionary containing the minima of the original volumes
+        :param field_original_ranges_max: field in the data dictionary containing the maxima of the original volumes
+        '''
+        self.fields = fields
+        self.min = min_intensity
+        self.max = max_intensity
+        self.field_original_ranges_min = field_original_ranges_min
+        self.field_original_ranges_max = field_original_ranges_max
+
+    def __call__(self, data):
+        for field in self.fields:
+            batch = data[field]
+            if not np.issubdtype(batch.dtype, np.floating):
+                batch = batch.astype(np.float32)
+
+            minima = np.asarray(data[self.field_original_ranges_min][field], dtype=batch.dtype)
+            maxima = np.asarray(data[self.field_original_ranges_max][field], dtype=batch.dtype)
+
+            scale = (maxima - minima) / (self.max - self.min)
+
+            broadcast_shape = (-1,) + (1,) * (batch.ndim - 1)
+
+            batch -= batch.dtype.type(self.min)
+            batch *= scale.reshape(broadcast_shape)
+            batch += minima.reshape(broadcast_shape)
+
+            data[field] = batch
+
+        return data
+
+
+class Threshold5DArray(object):
+    def __init__(self, image_field, threshold_field, dtype=np.float32):
+        '''
+        Threshold5DArray binarizes a 5D array (N, X, Y, Z, C) using one threshold per volume
+        :param image_field: field of the dictionary containing the 5D array
+        :param threshold_field: field of the dictionary containing the list of thresholds, one per volume or a
+        single one for all the volumes
+        :param dtype: type of the binarized array
+        '''
+        self.image_field = image_field
+        self.threshold_field = threshold_field
+        self.dtype = dtype
+
+    def __call__(self, data):
+        batch = data[self.image_field]
+
+        # compared in their own type: casting to the type of the array would truncate fractional thresholds of
+        # integer arrays
+        thresholds = np.asarray(data[self.threshold_field]).reshape((-1,) + (1,) * (batch.ndim - 1))
+
+        data[self.image_field] = (batch >= thresholds).astype(self.dtype)
+
+        return data
+
+
+class FromLabelVolumeToVTKMesh(object):
+    mesh_reduction_percentage = 0.90
+    smoothing_iterations = 150
+
+    def __init__(
+            self,
+            label_filed,
+            mesh_field,
+            return_VTK_field='return_VTK',
+            spacings_field='original_spacings_NP',
+            sizes_field='original_sizes_std_size',
+            origins_field='original_origins_NP',
+            directions_field='original_directions_NP',
+            convert_to_ras_field='RAS',
+            smoothing_iterations=None,
+            decimation=None,
+            smoothing_iterations_field=None,
+            decimation_field=None,
+            preview_field=None
+    ):
+        '''
+        FromLabelVolumeToVTKMesh extracts a surface mesh from each label volume
+        :param smoothing_iterations: iterations of the smoother, by default smoothing_iterations
+        :param decimation: fraction of the triangles removed by the decimation, by default mesh_reduction_percentage
+        :param smoothing_iterations_field: field of the data dictionary, typically filled by a slider of the input
+        interface, overriding smoothing_iterations for the request
+        :param decimation_field: field of the data dictionary overriding decimation for the request
+        :param preview_field: field of the data dictionary, typically filled by a checkbox of the input interface,
+        which skips smoothing when 'True' to return a coarse mesh quickly
+        '''
+
+        self.label_filed = label_filed
+        self.mesh_field = mesh_field
+        self.return_VTK_field = return_VTK_field
+        self.spacings_field = spacings_field
+        self.sizes_field = sizes_field
+        self.origins_field = origins_field
+        self.directions_field = directions_field
+        self.convert_to_ras_field = convert_to_ras_field
+        self.smoothing_iterations = smoothing_iterations if smoothing_iterations is not None else \
+            self.smoothing_iterations
+        self.decimation = decimation if decimation is not None else self.mesh_reduction_percentage
+        self.smoothing_iterations_field = smoothing_iterations_field
+        self.decimation_field = decimation_field
+        self.preview_field = preview_field
+
+    def __call__(self, data):
+        meshes = []
+
+        for i, (label, spacing, origin, size, direction, return_VTK, convert_to_ras) in enumerate(zip(
+                data[self.label_filed],
+                data[self.spacings_field][self.label_filed],
+                data[self.origins_field][self.label_filed],
+                data[self.sizes_field][self.label_filed],
+                data[self.directions_field][self.label_filed],
+                data[self.return_VTK_field],
+                data[self.convert_to_ras_field],
+        )):
+            if return_VTK == "False":
+                continue
+
+            smoothing_iterations = int(request_value(data, self.smoothing_iterations_field, i, self.smoothing_iterations))
+            decimation = float(request_value(data, self.decimation_field, i, self.decimation))
+
+            if str(request_value(data, self.preview_field, i, 'False')) == 'True':
+                smoothing_iterations = 0
+
+            meshes.append(make_label_mesh(
+                label, spacing, origin, size, direction, convert_to_ras == 'True', smoothing_iterations, decimation
+            ))
+
+        data[self.mesh_field] = meshes
+
+        return data
+
+
+class FromLabelVolumeToVTKMeshes(FromLabelVolumeToVTKMesh):
+    def __init__(self, label_filed, mesh_field, labels=None, workers=None, **kwargs):
+        '''
+        FromLabelVolumeToVTKMeshes extracts one surface mesh per label of each label volume. Each label is cropped to
+        its bounding box, and the labels are meshed in parallel by a pool of threads (VTK releases the GIL while its
+        filters run). The content of mesh_field is a list with, for each volume, a dict label -> vtkPolyData.
+        :param labels: labels to mesh, by default all the labels present in each volume
+        :param workers: number of threads, by default the number of cores
+        Other arguments are those of FromLabelVolumeToVTKMesh.
+        '''
+        super(FromLabelVolumeToVTKMeshes, self).__init__(label_filed, mesh_field, **kwargs)
+        self.labels = labels
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+
+    def __call__(self, data):
+        meshes = []
+
+        for i, (label, spacing, origin, size, direction, return_VTK, convert_to_ras) in enumerate(zip(
+                data[self.label_filed],
+                data[self.spacings_field][self.label_filed],
+                data[self.origins_field][self.label_filed],
+                data[self.sizes_field][self.label_filed],
+                data[self.directions_field][self.label_filed],
+                data[self.return_VTK_field],
+                data[self.convert_to_ras_field],
+        )):
+            if return_VTK == "False":
+                continue
+
+            smoothing_iterations = int(request_value(data, self.smoothing_iterations_field, i, self.smoothing_iterations))
+            decimation = float(request_value(data, self.decimation_field, i, self.decimation))
+
+            if str(request_value(data, self.preview_field, i, 'False')) == 'True':
+                smoothing_iterations = 0
+
+            regions = label_bounding_boxes(label, margin=1, labels=self.labels)
+
+            def mesh_label(value):
+                region = regions[value]
+                start = np.asarray([r.start for r in region])
+
+                return make_label_mesh(
+                    label[region],
+                    spacing,
+                    np.asarray(origin) + start * np.asarray(spacing),
+                    label[region].shape,
+                    direction,
+                    convert_to_ras == 'True',
+                    smoothing_iterations,
+                    decimation,
+                    value=value
+                )
+
+            values = sorted(regions.keys())
+
+            pool = ThreadPool(max(1, min(self.workers, len(values))))
+            try:
+                label_meshes = pool.map(mesh_label, values)
+            finally:
+                pool.close()
+                pool.join()
+
+            meshes.append(dict(zip(values, label_meshes)))
+
+        data[self.mesh_field] = meshes
+
+        return data
+
+
+def request_value(data, field, i, default):
+    '''
+    :return: the value of a field of the data dictionary for the i-th volume, the only value if the field holds one
+    value for all the volumes, or default if the field is None or missing
+    '''
+    if field is None or field not in data or len(data[field]) == 0:
+        return default
+
+    values = data[field]
+
+    return values[min(i, len(values) - 1)]
+
+
+def make_label_mesh(label, spacing, origin, size, direction, convert_to_ras, smoothing_iterations, decimation,
+                    value=1):
+    '''
+    Extract the surface of a label as a VTK mesh
+    :param label: numpy label volume, indexed x, y, z
+    :param spacing: spacing of the volume
+    :param origin: origin of the volume
+    :param size: size of the volume
+    :param direction: direction cosines of the volume, 9 values
+    :param convert_to_ras: whether to convert the mesh to the RAS convention (as used by 3D Slicer)
+    :param smoothing_iterations: iterations of the smoother, 0 to skip smoothing
+    :param decimation: fraction of the triangles removed by the decimation, 0 to skip decimation
+    :param value: value of the label whose surface is extracted
+    :return: vtkPolyData
+    '''
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk
+
+    label = np.transpose(np.copy(label), [2, 1, 0])
+
+    vtk_voxelmap = vtk.vtkImageData()
+    vtk_voxelmap.SetSpacing(spacing[0], spacing[1], spacing[2])
+    vtk_voxelmap.SetOrigin(origin[0], origin[1], origin[2])
+    vtk_voxelmap.SetDimensions(size[0], size[1], size[2])
+
+    vtk_data_array = numpy_to_vtk(num_array=label.ravel(), deep=True, array_type=vtk.VTK_FLOAT)
+
+    points = vtk_voxelmap.GetPointData()
+    points.SetScalars(vtk_data_array)
+
+    contour = vtk.vtkDiscreteMarchingCubes()
+    contour.SetInputData(vtk_voxelmap)
+    contour.ComputeNormalsOn()
+    contour.GenerateValues(1, value, value)
+
+    surface = contour
+
+    if smoothing_iterations > 0:
+        smoother = vtk.vtkSmoothPolyDataFilter()
+        smoother.SetInputConnection(contour.GetOutputPort())
+        smoother.SetNumberOfIterations(smoothing_iterations)
+        smoother.SetFeatureAngle(60)
+        smoother.SetRelaxationFactor(0.05)
+        smoother.FeatureEdgeSmoothingOff()
+        surface = smoother
+
+    transform = vtk.vtkTransform()
+    if convert_to_ras:
+        mat = np.asarray(direction).reshape([3, 3])
+        conversion_mat = np.asarray([-1, 0, 0, 0, -1, 0, 0, 0, 1]).reshape([3, 3])
+        direction = np.matmul(conversion_mat, mat).flatten()
+
+    dir_homo = np.asarray([direction[0], direction[1], direction[2], 0.,
+                           direction[3], direction[4], direction[5], 0.,
+                           direction[6], direction[7], direction[8], 0.,
+                           0., 0., 0., 1.]).reshape([4, 4])
+
+    transform.SetMatrix(dir_homo.flatten())
+
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(transform)
+    transformFilter.SetInputConnection(surface.GetOutputPort())
+
+    surface = transformFilter
+
+    if decimation > 0:
+        decimator = vtk.vtkDecimatePro()
+        decimator.SetInputConnection(surface.GetOutputPort())
+        decimator.SetTargetReduction(decimation)
+        decimator.SetPreserveTopology(1)
+        surface = decimator
+
+    clean_poly_data_filter = vtk.vtkCleanPolyData()
+    clean_poly_data_filter.SetInputConnection(surface.GetOutputPort())
+    clean_poly_data_filter.Update()
+
+    mesh = vtk.vtkPolyData()
+    mesh.ShallowCopy(clean_poly_data_filter.GetOutput())
+
+    return mesh
+
+
+class ThresholdNumpy(object):
+    def __init__(self, image_field, threshold_field, dtype=np.float32):
+        '''
+        ThresholdNumpy binarizes the output of the model
+        :param image_field: field of the dictionary containing the array
+        :param threshold_field: field of the dictionary containing the threshold
+        :param dtype: type of the binarized array, np.uint8 keeps the label map four times smaller than float32
+        '''
+        self.image_field = image_field
+        self.threshold_field = threshold_field
+        self.dtype = dtype
+
+    def __call__(self, data):
+        binary = data[self.image_field] >= data[self.threshold_field]
+
+        # booleans are reinterpreted as uint8 without copying
+        data[self.image_field] = binary.view(np.uint8) if np.dtype(self.dtype) == np.uint8 else binary.astype(self.dtype)
+
+        return data
+
+
+class ArgmaxNumpy(object):
+    def __init__(self, image_field, dtype=None, axis=-1, slab_size=16):
+        '''
+        ArgmaxNumpy turns the class scores of a multi-class model, for example the output of a softmax, into a label
+        map holding the index of the highest scoring class of each voxel. The channel axis is kept with size one, so
+        that the transforms of single channel outputs can follow. The scores are processed by slabs cut along their
+        longest axis other than the classes, a spatial one for a (N, X, Y, Z, C) batch whatever N, so that the
+        temporary int64 indices produced by np.argmax never take more memory than a slab.
+        :param image_field: field of the dictionary containing the array of scores, channels last by default
+        :param dtype: type of the label map, by default np.uint8 for up to 256 classes and np.uint16 otherwise
+        :param axis: axis of the classes
+        :param slab_size: number of entries along the slab axis processed at once
+        '''
+        self.image_field = image_field
+        self.dtype = dtype
+        self.axis = axis
+        self.slab_size = slab_size
+
+    def __call__(self, data):
+        scores = data[self.image_field]
+        axis = self.axis % scores.ndim
+
+        dtype = self.dtype
+        if dtype is None:
+            dtype = np.uint8 if scores.shape[axis] <= 256 else np.uint16
+
+        shape = list(scores.shape)
+        shape[axis] = 1
+
+        labels = np.empty(shape, dtype=dtype)
+
+        # the batch axis is usually of length one, slabs along it would not bound the temporary indices
+        slab_axis = max((a for a in range(scores.ndim) if a != axis), key=lambda a: scores.shape[a])
+
+        for start in range(0, scores.shape[slab_axis], self.slab_size):
+            region = [slice(None)] * scores.ndim
+            region[slab_axis] = slice(start, start + self.slab_size)
+            region = tuple(region)
+
+            labels[region] = np.expand_dims(np.argmax(scores[region], axis=axis), axis)
+
+        data[self.image_field] = labels
+
+        return data
+
+
+LABEL_BLOCK_SIZE = 1 << 24
+
+
+def label_values(array):
+    '''
+    :param array: numpy label map
+    :return: list of the labels, other than 0, present in the label map
+    '''
+    if array.dtype.kind == 'b':
+        return [True] if array.any() else []
+
+    if array.dtype.kind == 'u' and array.dtype.itemsize <= 2:
+        # histogram by blocks: bincount converts its input to intp, which would take eight times the label map
+        flat = array.ravel()
+        counts = np.zeros(np.iinfo(array.dtype).max + 1, dtype=np.int64)
+        for start in range(0, flat.size, LABEL_BLOCK_SIZE):
+            counts += np.bincount(flat[start:start + LABEL_BLOCK_SIZE], minlength=counts.size)
+
+        return [int(label) for label in np.flatnonzero(counts[1:]) + 1]
+
+    return [label for label in np.unique(array).tolist() if label != 0]
+
+
+def label_bounding_boxes(array, margin=0, labels=None):
+    '''
+    Find the bounding boxes of all the labels of a label map in a single pass
+    :param array: numpy label map of integers or booleans, 2D or 3D. Floating point values are rounded
+    :param margin: number of voxels added around each bounding box, within the array
+    :param labels: labels of interest, by default all the labels other than 0 present in the label map
+    :return: dict label -> tuple of slices of its bounding box
+    '''
+    if array.dtype.kind == 'b':
+        array = array.view(np.uint8)
+    elif array.dtype.kind not in 'ui':
+        array = np.round(array).astype(np.int32)
+
+    statistics = sitk.LabelShapeStatisticsImageFilter()
+    statistics.Execute(sitk.GetImageFromArray(np.ascontiguousarray(array)))
+
+    boxes = {}
+
+    for label in statistics.GetLabels():
+        if labels is not None and label not in labels:
+            continue
+
+        box = statistics.GetBoundingBox(label)  # index then size, in ITK order (x first)
+
+        index = box[:array.ndim][::-1]
+        size = box[array.ndim:][::-1]
+
+        boxes[int(label)] = tuple(
+            slice(max(i - margin, 0), min(i + n + margin, array.shape[axis]))
+            for axis, (i, n) in enumerate(zip(index, size))
+        )
+
+    return boxes
+
+
+class PerLabelTransform(object):
+    def __init__(self, fields, labels=None, mask_fun=None):
+        '''
+        PerLabelTransform is the base of the transforms cleaning up label maps, either numpy arrays or SITK images,
+        2D or 3D. Each label is processed independently as a binary mask, by process_mask, within its bounding box.
+        The bounding boxes of all the labels are found in a single pass over the label map, and each label is then
+        processed within its own box only. Voxels removed from a label become background, and voxels added to a label
+        are taken from the background only, never from other labels.
+        Subclasses override process_mask, other clean-ups can be run by passing mask_fun.
+        :param fields: fields of the dictionary whose content should be modified
+        :param labels: labels to process, by default all the labels present in each label map
+        :param mask_fun: Callable processing the mask of a label (see process_mask), by default the mask is kept
+        '''
+        super(PerLabelTransform, self).__init__()
+        self.fields = fields
+        self.labels = labels
+        self.mask_fun = mask_fun
+        self.filters = FilterCache()
+
+        # number of voxels around a label that process_mask may add to it
+        self.margin = 0
+
+    def process_mask(self, mask):
+        '''
+        :param mask: numpy boolean array, True inside the label, cropped around it
+        :return: numpy boolean array, True inside the processed label
+        '''
+        if self.mask_fun is None:
+            return mask
+
+        return self.mask_fun(mask)
+
+    def label_regions(self, output):
+        '''
+        :param output: numpy label map
+        :return: list of (label, tuple of slices of its bounding box) for the labels to process
+        '''
+        if output.dtype.kind in 'biu':
+            boxes = label_bounding_boxes(output, self.margin)
+
+            labels = self.labels if self.labels is not None else sorted(boxes)
+
+            return [(label, boxes[label]) for label in labels if label in boxes]
+
+        # labels stored as floating point values: one scan of the label map per label
+        regions = []
+
+        for label in (self.labels if self.labels is not None else label_values(output)):
+            region = bounding_box(output == label, self.margin)
+
+            if region is not None:
+                regions.append((label, region))
+
+        return regions
+
+    def process_volume(self, volume):
+        is_image = isinstance(volume, sitk.Image)
+
+        output = sitk.GetArrayFromImage(volume) if is_image else np.array(volume)
+
+        if output.ndim not in [2, 3]:
+            raise ValueError('{} processes 2D or 3D label maps, got {} dimensions'.format(
+                type(self).__name__, output.ndim
+            ))
+
+        for label, region in self.label_regions(output):
+            cropped = output[region]
+            mask = cropped == label
+
+            result = self.process_mask(mask)
+
+            cropped[mask] = 0
+            cropped[result & (cropped == 0)] = label
+
+        if is_image:
+            image = sitk.GetImageFromArray(output)
+            image.CopyInformation(volume)
+            return image
+
+        return output
+
+    def __call__(self, data):
+        for field in self.fields:
+            for i in range(len(data[field])):
+                data[field][i] = self.process_volume(data[field][i])
+
+        return data
+
+
+def execute_on_mask(filter, mask):
+    '''
+    Run a SimpleITK filter on a numpy boolean mask
+    :param filter: SimpleITK filter taking a binary uint8 image
+    :param mask: numpy boolean array
+    :return: numpy boolean array, True where the output of the filter is not 0
+    '''
+    return sitk.GetArrayFromImage(filter.Execute(sitk.GetImageFromArray(mask.view(np.uint8)))) != 0
+
+
+class LargestConnectedComponent(PerLabelTransform):
+    def __init__(self, fields, labels=None, fully_connected=False):
+        '''
+        LargestConnectedComponent keeps, for each label, only its largest connected component
+        :param fields: fields of the dictionary whose content should be modified
+        :param labels: labels to process, by default all the labels present in each label map
+        :param fully_connected: whether voxels touching by a corner or an edge are connected, or only by a face
+        '''
+        super(LargestConnectedComponent, self).__init__(fields, labels)
+        self.fully_connected = fully_connected
+
+    def make_components_filter(self):
+        components = sitk.ConnectedComponentImageFilter()
+        components.SetFullyConnected(self.fully_connected)
+
+        return components
+
+    def process_mask(self, mask):
+        components = self.filters.get('components', self.make_components_filter)
+        relabel = self.filters.get('relabel', sitk.RelabelComponentImageFilter)
+
+        labelled = relabel.Execute(components.Execute(sitk.GetImageFromArray(mask.view(np.uint8))))
+
+        # components are relabelled by decreasing size
+        return sitk.GetArrayViewFromImage(labelled) == 1
+
+
+class RemoveSmallComponents(PerLabelTransform):
+    def __init__(self, fields, min_size, labels=None, fully_connected=False):
+        '''
+        RemoveSmallComponents removes, for each label, the connected components smaller than a given size
+        :param fields: fields of the dictionary whose content should be modified
+        :param min_size: number of voxels of the smallest component that is kept
+        :param labels: labels to process, by default all the labels present in each label map
+        :param fully_connected: whether voxels touching by a corner or an edge are connected, or only by a face
+        '''
+        super(RemoveSmallComponents, self).__init__(fields, labels)
+        self.min_size = min_size
+        self.fully_connected = fully_connected
+
+    def make_components_filter(self):
+        components = sitk.ConnectedComponentImageFilter()
+        components.SetFullyConnected(self.fully_connected)
+
+        return components
+
+    def make_relabel_filter(self):
+        relabel = sitk.RelabelComponentImageFilter()
+        relabel.SetMinimumObjectSize(int(self.min_size))
+
+        return relabel
+
+    def process_mask(self, mask):
+        components = self.filters.get('components', self.make_components_filter)
+        relabel = self.filters.get('relabel', self.make_relabel_filter)
+
+        labelled = relabel.Execute(components.Execute(sitk.GetImageFromArray(mask.view(np.uint8))))
+
+        return sitk.GetArrayViewFromImage(labelled) != 0
+
+
+class FillHoles(PerLabelTransform):
+    def __init__(self, fields, labels=None, fully_connected=False):
+        '''
+        FillHoles fills, for each label, the background regions completely enclosed by the label
+        :param fields: fields of the dictionary whose content should be modified
+        :param labels: labels to process, by default all the labels present in each label map
+        :param fully_connected: connectivity of the label, see LargestConnectedComponent
+        '''
+        super(FillHoles, self).__init__(fields, labels)
+        self.fully_connected = fully_connected
+
+    def make_fill_filter(self):
+        fill = sitk.BinaryFillholeImageFilter()
+        fill.SetForegroundValue(1)
+        fill.SetFullyConnected(self.fully_connected)
+
+        return fill
+
+    def process_mask(self, mask):
+        return execute_on_mask(self.filters.get('fill', self.make_fill_filter), mask)
+
+
+def ball_offsets(radius, ndim=3):
+    '''
+    :param radius: int radius of the ball, in voxels
+    :param ndim: number of dimensions, 2 for a disk
+    :return: list of the offsets of the voxels of a ball, the same as the SimpleITK sitkBall kernel
+    '''
+    grid = np.mgrid[(slice(-radius, radius + 1),) * ndim].reshape(ndim, -1).T
+
+    return [tuple(offset) for offset in grid if np.sum(offset ** 2) <= (radius + .5) ** 2]
+
+
+def binary_erode(mask, radius, border_value=True):
+    '''
+    Erode a mask with a ball, as a sequence of whole-array logical operations on shifted copies of the mask
+    :param mask: numpy boolean array
+    :param radius: int radius of the ball, in voxels
+    :param border_value: value assumed outside of the array
+    :return: numpy boolean array
+    '''
+    return _shifted_reduce(mask, radius, border_value, np.logical_and, True)
+
+
+def binary_dilate(mask, radius, border_value=False):
+    '''
+    Dilate a mask with a ball, see binary_erode
+    '''
+    return _shifted_reduce(mask, radius, border_value, np.logical_or, False)
+
+
+def _shifted_reduce(mask, radius, border_value, operation, initial_value):
+    padded = np.pad(mask, radius, mode='constant', constant_values=border_value)
+    shape = mask.shape
+
+    output = np.full(shape, initial_value, dtype=bool)
+
+    for offset in ball_offsets(radius, mask.ndim):
+        shifted = padded[tuple(slice(radius + o, radius + o + n) for o, n in zip(offset, shape))]
+        operation(output, shifted, out=output)
+
+    return output
+
+
+class MorphologicalOpening(PerLabelTransform):
+    def __init__(self, fields, radius=1, labels=None):
+        '''
+        MorphologicalOpening removes, for each label, the structures thinner than a ball of the given radius. The
+        result is the same as SimpleITK BinaryMorphologicalOpening with a sitkBall kernel.
+        :param fields: fields of the dictionary whose content should be modified
+        :param radius: radius of the ball, in voxels
+        :param labels: labels to process, by default all the labels present in each label map
+        '''
+        super(MorphologicalOpening, self).__init__(fields, labels)
+        self.radius = int(radius)
+        self.margin = self.radius + 1
+
+    def process_mask(self, mask):
+        return binary_dilate(binary_erode(mask, self.radius), self.radius)
+
+
+class MorphologicalClosing(PerLabelTransform):
+    def __init__(self, fields, radius=1, labels=None):
+        '''
+        MorphologicalClosing fills, for each label, the gaps thinner than a ball of the given radius. The result is
+        the same as SimpleITK BinaryMorphologicalClosing with a sitkBall kernel and a safe border.
+        :param fields: fields of the dictionary whose content should be modified
+        :param radius: radius of the ball, in voxels
+        :param labels: labels to process, by default all the labels present in each label map
+        '''
+        super(MorphologicalClosing, self).__init__(fields, labels)
+        self.radius = int(radius)
+        self.margin = self.radius + 1
+
+    def process_mask(self, mask):
+        r = self.radius
+
+        # the mask is padded so that the border does not erode what the dilation added
+        padded = np.pad(mask, r, mode='constant', constant_values=False)
+        closed = binary_erode(binary_dilate(padded, r), r)
+
+        return closed[(slice(r, -r),) * mask.ndim] if r > 0 else closed
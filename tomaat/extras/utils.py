@@ -1,10 +1,186 @@
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from .thread_budget import current_thread_budget, configure_filter
+from ..context import checkpoint
+from ..tracing import span, payload_size
+from ..memory import measure
+
+
 class TransformChain(object):
-    def __init__(self, transforms_list):
+    def __init__(self, transforms_list, thread_budget=None):
+        '''
+        TransformChain applies a list of transforms in sequence
+        :param transforms_list: list of transforms
+        :param thread_budget: ThreadBudget limiting the threads used by SimpleITK filters, by default the one set
+        through set_default_thread_budget, if any
+        '''
         super(TransformChain, self).__init__()
         self.transforms_list = transforms_list
+        self.thread_budget = thread_budget
 
     def __call__(self, data):
+        budget = self.thread_budget if self.thread_budget is not None else current_thread_budget()
+
+        if budget is None:
+            return self.run(data)
+
+        with budget.pipeline():
+            return self.run(data)
+
+    def run(self, data):
         for transform in self.transforms_list:
-            data = transform(data)
+            checkpoint()  # stop between transforms if the request was cancelled or its deadline expired
+
+            with span(type(transform).__name__) as transform_span, measure(type(transform).__name__):
+                data = transform(data)
+
+                if transform_span is not None:
+                    transform_span.set_attribute('tomaat.payload_bytes', payload_size(data))
 
         return data
+
+
+# bytes of buffers kept by a BufferPool for each thread, by default
+BUFFER_POOL_MAX_BYTES = 1 << 29
+
+
+class BufferPool(object):
+    def __init__(self, max_bytes=BUFFER_POOL_MAX_BYTES):
+        '''
+        BufferPool hands out numpy arrays that are reused across calls instead of being allocated every time.
+        Buffers belong to the thread that requested them and are identified by a key: requesting the same key again
+        from the same thread returns the same array, therefore an array must not be used anymore once the transform
+        that obtained it runs again in the same thread. This holds for TomaatApp, which runs a whole request in one
+        thread, as long as results are not kept across requests.
+        Each thread keeps at most max_bytes of buffers: the least recently requested ones are dropped beyond that, and
+        release drops all the buffers of the current thread.
+        :param max_bytes: maximum number of bytes kept for each thread, None for no limit
+        '''
+        super(BufferPool, self).__init__()
+        self.local = threading.local()
+        self.max_bytes = max_bytes
+        self.allocations = 0
+        self.reuses = 0
+        self.evictions = 0
+
+    def get(self, key, shape, dtype):
+        '''
+        :param key: hashable identifying the buffer, for example (id(transform), field, index)
+        :param shape: shape of the array
+        :param dtype: type of the array
+        :return: numpy array with undefined content
+        '''
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = OrderedDict()
+
+        shape = tuple(int(s) for s in shape)
+        dtype = np.dtype(dtype)
+
+        buffer = buffers.pop(key, None)
+
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.allocations += 1
+        else:
+            self.reuses += 1
+
+        if self.max_bytes is not None and buffer.nbytes > self.max_bytes:
+            return buffer  # never kept
+
+        buffers[key] = buffer  # most recently requested last
+
+        if self.max_bytes is not None:
+            held = sum(b.nbytes for b in buffers.values())
+
+            while held > self.max_bytes:
+                _, oldest = buffers.popitem(last=False)
+                held -= oldest.nbytes
+                self.evictions += 1
+
+        return buffer
+
+    def release(self):
+        '''
+        Drop the buffers of the current thread, for example once a request is over
+        '''
+        self.local.buffers = OrderedDict()
+
+    def nbytes(self):
+        '''
+        :return: number of bytes held by the pool for the current thread
+        '''
+        return sum(buffer.nbytes for buffer in getattr(self.local, 'buffers', {}).values())
+
+
+class FilterCache(object):
+    def __init__(self):
+        '''
+        FilterCache keeps SimpleITK filter instances that are reused across calls instead of being built every time.
+        Filters are not thread safe, therefore each thread gets its own instances. Parameters that are the same for
+        every call should be set once by the factory; those that change should be set before each Execute.
+        '''
+        super(FilterCache, self).__init__()
+        self.local = threading.local()
+        self.creations = 0
+
+    def get(self, name, factory):
+        '''
+        :param name: hashable identifying the filter within the owner of the cache
+        :param factory: callable without arguments returning a new, configured, filter
+        :return: the filter of the current thread, with its number of threads set by the current thread budget
+        '''
+        filters = getattr(self.local, 'filters', None)
+        if filters is None:
+            filters = self.local.filters = {}
+
+        filter = filters.get(name)
+
+        if filter is None:
+            filter = filters[name] = factory()
+            self.creations += 1
+
+        return configure_filter(filter)
+
+
+def make_memmap(shape, dtype, directory=None):
+    '''
+    Create an array backed by a file instead of memory
+    :param shape: shape of the array
+    :param dtype: type of the array
+    :param directory: directory where the array is stored as a .npy file, typically the savepath of the request,
+    which is removed together with the array once the response is sent. Other processes can open the file with
+    np.load(filename, mmap_mode='r+'). If None, the array is stored in an anonymous temporary file that disappears
+    when the array is garbage collected.
+    :return: np.memmap, whose filename attribute is None for anonymous arrays
+    '''
+    shape = tuple(int(s) for s in shape)
+
+    if directory is not None:
+        filename = os.path.join(directory, str(uuid.uuid4()).replace('-', '') + '.npy')
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+
+    with tempfile.TemporaryFile() as f:
+        return np.memmap(f, mode='w+', dtype=dtype, shape=shape)
+
+
+def to_memmap(array, directory=None):
+    '''
+    Copy an array to a file backed array, see make_memmap
+    :param array: numpy array
+    :param directory: directory where the array is stored, None for an anonymous temporary file
+    :return: np.memmap with the same content as array
+    '''
+    if isinstance(array, np.memmap):
+        return array
+
+    mapped = make_memmap(array.shape, array.dtype, directory)
+    mapped[...] = array
+
+    return mapped
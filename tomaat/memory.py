@@ -0,0 +1,318 @@
+import gc
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from .context import RequestContext, current_context, set_current_context
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+'''
+Memory accounting. A MemoryMonitor measures each request run within monitor.request(): resident set size (RSS) and,
+if Python allocations are traced (tracemalloc), the bytes allocated by Python code, before and after the request and
+at its peak. TransformChain measures each transform of a request in the same way (see measure).
+
+Memory retained by a request is the difference between after and before. A single request retains memory for many
+legitimate reasons (caches, pools, allocator fragmentation), a leak shows as a steady growth of RSS over many
+requests: the monitor fits a line through the RSS after the last soak_window requests and flags a leak when the growth
+over the window exceeds growth_threshold.
+
+tracemalloc counts the allocations of the whole process, so measures of concurrent requests include each other's
+allocations. Allocations of SimpleITK and VTK are not seen by tracemalloc, only by RSS.
+'''
+
+
+MEMORY_HISTORY = 1000  # requests
+SOAK_WINDOW = 50  # requests
+GROWTH_THRESHOLD = 64 * 1024 * 1024  # bytes over SOAK_WINDOW requests
+
+
+def rss_bytes():
+    '''
+    :return: int resident set size of the process in bytes, None if unknown
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    '''
+    :return: int highest resident set size of the process in bytes, None if unknown
+    '''
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def python_tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def traced_memory():
+    '''
+    :return: tuple (current, peak) bytes allocated by Python code, (None, None) if allocations are not traced
+    '''
+    if not python_tracing():
+        return None, None
+
+    return tracemalloc.get_traced_memory()
+
+
+def reset_traced_peak():
+    if python_tracing() and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def difference(after, before):
+    if after is None or before is None:
+        return None
+
+    return after - before
+
+
+class RequestMemory(object):
+    def __init__(self):
+        '''
+        RequestMemory accumulates the measures of one request
+        '''
+        super(RequestMemory, self).__init__()
+        self.start = time.time()
+        self.rss_before = rss_bytes()
+        self.python_before, _ = traced_memory()
+        self.python_peak = self.python_before
+        self.transforms = []
+
+        reset_traced_peak()
+
+    def update_peak(self):
+        _, peak = traced_memory()
+
+        if peak is not None:
+            self.python_peak = max(self.python_peak, peak)
+
+    def finish(self):
+        '''
+        :return: dict record of the request
+        '''
+        self.update_peak()
+
+        rss_after = rss_bytes()
+        python_after, _ = traced_memory()
+
+        return {
+            'duration': time.time() - self.start,
+            'rss_before': self.rss_before,
+            'rss_after': rss_after,
+            'rss_delta': difference(rss_after, self.rss_before),
+            'python_delta': difference(python_after, self.python_before),
+            'python_peak': difference(self.python_peak, self.python_before),
+            'transforms': self.transforms,
+        }
+
+
+@contextmanager
+def measure(name):
+    '''
+    Measure the memory allocated by the enclosed work, as a step of the request bound to the current thread, if its
+    memory is accounted
+    :param name: name of the step, for example the class of a transform
+    '''
+    context = current_context()
+
+    usage = getattr(context, 'memory', None)
+
+    if usage is None:
+        yield
+        return
+
+    usage.update_peak()
+    reset_traced_peak()
+
+    rss_before = rss_bytes()
+    python_before, _ = traced_memory()
+
+    try:
+        yield
+    finally:
+        python_after, python_peak = traced_memory()
+
+        usage.update_peak()
+
+        usage.transforms.append({
+            'name': name,
+            'rss_delta': difference(rss_bytes(), rss_before),
+            'python_delta': difference(python_after, python_before),
+            'python_peak': difference(python_peak, python_before),
+        })
+
+
+class MemoryMonitor(object):
+    def __init__(self, trace_python=False, soak_window=SOAK_WINDOW, growth_threshold=GROWTH_THRESHOLD,
+                 history=MEMORY_HISTORY):
+        '''
+        MemoryMonitor keeps the memory records of the last requests and aggregates them per transform
+        :param trace_python: start tracing Python allocations with tracemalloc, which slows down Python code
+        :param soak_window: number of requests over which RSS growth is measured
+        :param growth_threshold: RSS growth in bytes over soak_window requests above which a leak is suspected
+        :param history: number of request records kept
+        '''
+        super(MemoryMonitor, self).__init__()
+        self.soak_window = soak_window
+        self.growth_threshold = growth_threshold
+        self.records = deque(maxlen=history)
+        self.transforms = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        # called with the record of every request, for example to send it to another process
+        self.on_record = None
+
+        if trace_python and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def request(self):
+        '''
+        Account the memory of the enclosed request, bound to the current thread
+        '''
+        context = current_context()
+
+        bound = context is None
+
+        if bound:
+            # transforms find the accounting of the request through the context
+            context = RequestContext()
+            set_current_context(context)
+
+        usage = context.memory = RequestMemory()
+
+        try:
+            yield usage
+        finally:
+            context.memory = None
+
+            if bound:
+                set_current_context(None)
+
+            self.add(usage.finish())
+
+    def add(self, record):
+        '''
+        :param record: dict record of a request, as returned by RequestMemory.finish
+        '''
+        with self.lock:
+            self.records.append(record)
+            self.requests += 1
+
+            for step in record['transforms']:
+                totals = self.transforms.setdefault(
+                    step['name'], {'calls': 0, 'rss_delta': 0, 'python_delta': 0, 'python_peak': 0}
+                )
+
+                totals['calls'] += 1
+                totals['rss_delta'] += step['rss_delta'] or 0
+                totals['python_delta'] += step['python_delta'] or 0
+                totals['python_peak'] = max(totals['python_peak'], step['python_peak'] or 0)
+
+        if self.on_record is not None:
+            self.on_record(record)
+
+    def growth(self):
+        '''
+        :return: float RSS growth in bytes per request over the last soak_window requests (least squares fit), None if
+        fewer requests have been recorded
+        '''
+        with self.lock:
+            rss = [record['rss_after'] for record in self.records if record['rss_after'] is not None]
+
+        rss = rss[-self.soak_window:]
+
+        if len(rss) < max(self.soak_window, 2):
+            return None
+
+        n = float(len(rss))
+        mean_x = (n - 1) / 2.
+        mean_y = sum(rss) / n
+
+        covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(rss))
+        variance = sum((x - mean_x) ** 2 for x in range(len(rss)))
+
+        return covariance / variance
+
+    def leak_suspected(self):
+        growth = self.growth()
+
+        return growth is not None and growth * self.soak_window > self.growth_threshold
+
+    def stats(self):
+        with self.lock:
+            records = list(self.records)
+            transforms = dict((name, dict(totals)) for name, totals in self.transforms.items())
+
+        peaks = [record['python_peak'] for record in records if record['python_peak'] is not None]
+        retained = [record['rss_delta'] for record in records if record['rss_delta'] is not None]
+
+        python_current, _ = traced_memory()
+
+        return {
+            'requests': self.requests,
+            'rss_bytes': rss_bytes(),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'python_tracing': python_tracing(),
+            'python_traced_bytes': python_current,
+            'request_python_peak_max': max(peaks) if peaks else None,
+            'request_rss_retained_mean': float(sum(retained)) / len(retained) if retained else None,
+            'rss_growth_per_request': self.growth(),
+            'leak_suspected': self.leak_suspected(),
+            'last_request': records[-1] if records else None,
+            'transforms': transforms,
+        }
+
+
+@contextmanager
+def account(monitor):
+    '''
+    Account the memory of the enclosed request with monitor, if not None. See MemoryMonitor.request
+    '''
+    if monitor is None:
+        yield None
+        return
+
+    with monitor.request() as usage:
+        yield usage
+
+
+def soak(fun, iterations, monitor):
+    '''
+    Soak test: run fun repeatedly, accounting each run as a request
+    :param fun: callable running one request
+    :param iterations: number of runs
+    :param monitor: MemoryMonitor accounting the runs
+    :return: dict statistics of the monitor after the runs
+    '''
+    for _ in range(iterations):
+        with monitor.request():
+            fun()
+
+    gc.collect()
+
+    return monitor.stats()
@@ -1 +1,2 @@
 from .service import *
+from .router import *
@@ -0,0 +1,54 @@
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_QUEUED = 16
+DEFAULT_RETRY_AFTER = 10  # seconds
+
+
+class AdmissionController(object):
+    """
+    An AdmissionController limits the number of requests that a TomaatService accepts, counting both the requests
+    being processed and those waiting for their turn. Requests exceeding the limit are rejected right away, so that
+    the latency of the admitted requests stays bounded when the service is overloaded.
+    """
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_queued=DEFAULT_MAX_QUEUED, retry_after=DEFAULT_RETRY_AFTER):
+        """
+        To instantiate an AdmissionController the following arguments are needed
+        :type max_in_flight: int maximum number of requests processed at the same time
+        :type max_queued: int maximum number of admitted requests waiting for processing
+        :type retry_after: int number of seconds rejected clients are asked to wait before retrying
+        """
+        super(AdmissionController, self).__init__()
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+
+        self.pending = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self):
+        return self.max_in_flight + self.max_queued
+
+    def admit(self):
+        """
+        Try to admit a new request. Admitted requests must call release once they are done.
+        :return: bool True if the request is admitted, False if it is rejected
+        """
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            return False
+
+        self.pending += 1
+        self.admitted += 1
+
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,297 @@
+import base64
+import multiprocessing
+import os
+import sys
+import threading
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+
+'''
+Compressed volume uploads.
+
+A volume field can carry a compressed MHA file. In this case the first value of the field starts with the name of the
+codec followed by a newline, and the compressed file is split in one or more values of the same field, each one
+base64 encoded independently:
+
+    <codec> newline <base64 of chunk 1>, <base64 of chunk 2>, ...
+
+Chunks are decoded and decompressed one at a time and written straight to the file read by the app, so that the
+whole decompressed volume is never held in memory. The compressed payload is: Twisted parses the body of the request
+into request.args before the service sees it, so all the base64 encoded chunks are in memory at once. Volumes too
+large for that are sent through resumable uploads (see tomaat.server.uploads), which are spooled to disk chunk by
+chunk.
+
+Compressed outputs.
+
+LabelVolume and TransformGrid outputs can declare a 'compression' in the output interface (see RESPONSE_CODECS) and
+optionally a 'level'. The file is then written uncompressed, cut in chunks that are compressed in parallel, and the
+compressed members are concatenated. The element of the response carries the codec in its 'compression' field.
+'''
+
+VOLUME_CODECS = ['gzip', 'zstd']
+
+RESPONSE_CODECS = ['none', 'zlib', 'gzip', 'zstd', 'lz4', 'auto']
+
+DEFAULT_LEVELS = {'zlib': 6, 'gzip': 6, 'zstd': 3, 'lz4': 0}
+
+RESPONSE_CHUNK_SIZE = 4 * 1024 * 1024  # bytes of uncompressed data per compressed member
+
+# thresholds between the codecs chosen by choose_response_codec
+SMALL_OUTPUT_SIZE = 8 * 1024 * 1024
+LARGE_OUTPUT_SIZE = 128 * 1024 * 1024
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _reset_compression_pool():
+    '''
+    Forget the compression pool in a forked child: the child inherits the pool object but not its threads, and
+    possibly a lock held by another thread of the parent
+    '''
+    global _pool, _pool_pid, _pool_lock
+
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_compression_pool)
+
+
+def _get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('the zstd codec requires the zstandard package: pip install zstandard')
+
+    return zstandard
+
+
+def _get_lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError('the lz4 codec requires the lz4 package: pip install lz4')
+
+    return lz4.frame
+
+
+class StreamingDecompressor(object):
+    def __init__(self, codec):
+        '''
+        StreamingDecompressor decompresses data incrementally. Streams made of several concatenated members, as
+        produced by compressing chunks in parallel, are supported.
+        :param codec: one of 'gzip', 'zlib', 'zstd', 'lz4'
+        '''
+        super(StreamingDecompressor, self).__init__()
+        self.codec = codec
+        self.decompressor = self._make_decompressor()
+
+    def _make_decompressor(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.codec == 'zlib':
+            return zlib.decompressobj()
+        elif self.codec == 'zstd':
+            return _get_zstandard().ZstdDecompressor().decompressobj()
+        elif self.codec == 'lz4':
+            return _get_lz4().LZ4FrameDecompressor()
+
+        raise ValueError('unsupported codec {}'.format(self.codec))
+
+    def decompress(self, data):
+        output = []
+
+        while data:
+            if self.decompressor.eof:
+                # the current member is complete: what is left belongs to the next one
+                self.decompressor = self._make_decompressor()
+
+            output.append(self.decompressor.decompress(data))
+
+            data = self.decompressor.unused_data if self.decompressor.eof else b''
+
+        return b''.join(output)
+
+    def flush(self):
+        if self.codec in ['zstd', 'lz4']:
+            return b''
+
+        return self.decompressor.flush()
+
+
+def split_codec_header(value):
+    '''
+    Check whether the value of a volume field declares a codec
+    :param value: str first value of the field
+    :return: tuple (codec or None, rest of the value)
+    '''
+    for codec in VOLUME_CODECS:
+        if value.startswith(codec + '\n'):
+            return codec, value[len(codec) + 1:]
+
+    return None, value
+
+
+def write_compressed_volume(codec, chunks, fileobj):
+    '''
+    Decode and decompress the chunks of a compressed volume, writing the result to fileobj as it is produced
+    :param codec: codec declared by the client
+    :param chunks: iterable of str base64 encoded chunks of compressed data, codec header removed
+    :param fileobj: file object open for binary writing
+    :return: int number of decompressed bytes written
+    '''
+    decompressor = StreamingDecompressor(codec)
+
+    written = 0
+
+    for chunk in chunks:
+        data = decompressor.decompress(_base64_decode(chunk))
+        fileobj.write(data)
+        written += len(data)
+
+    data = decompressor.flush()
+    fileobj.write(data)
+    written += len(data)
+
+    return written
+
+
+def compress_member(codec, level, data):
+    '''
+    Compress data as an independent member: concatenated members form a valid stream of the codec
+    :param codec: one of 'zlib', 'gzip', 'zstd', 'lz4'
+    :param level: compression level
+    :param data: bytes to compress
+    :return: bytes
+    '''
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'zstd':
+        return _get_zstandard().ZstdCompressor(level=level).compress(data)
+    elif codec == 'lz4':
+        return _get_lz4().compress(data, compression_level=level)
+
+    raise ValueError('unsupported codec {}'.format(codec))
+
+
+def get_compression_pool():
+    '''
+    :return: ThreadPool shared by the parallel compressions of the current process, with one thread per core. The
+    codecs release the GIL while compressing, so the threads run in parallel.
+    '''
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        # the pool of the parent is useless in a forked process, such as a delayed-response worker
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(multiprocessing.cpu_count())
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def compress_parallel(codec, data, level=None, chunk_size=RESPONSE_CHUNK_SIZE, pool=None):
+    '''
+    Compress data in chunks, in parallel, and concatenate the compressed members
+    :param codec: one of 'none', 'zlib', 'gzip', 'zstd', 'lz4'
+    :param data: bytes to compress
+    :param level: compression level, None for the default level of the codec
+    :param chunk_size: number of uncompressed bytes per member
+    :param pool: ThreadPool to use, by default the one returned by get_compression_pool
+    :return: bytes
+    '''
+    if codec == 'none':
+        return data
+
+    level = level if level is not None else DEFAULT_LEVELS[codec]
+
+    chunks = [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)] or [b'']
+
+    if len(chunks) == 1:
+        return compress_member(codec, level, chunks[0])
+
+    pool = pool if pool is not None else get_compression_pool()
+
+    return b''.join(pool.map(lambda chunk: compress_member(codec, level, chunk), chunks))
+
+
+def decompress(codec, data):
+    '''
+    :param codec: one of 'none', 'zlib', 'gzip', 'zstd', 'lz4'
+    :param data: bytes produced by compress_parallel
+    :return: bytes
+    '''
+    if codec == 'none':
+        return data
+
+    decompressor = StreamingDecompressor(codec)
+
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def codec_available(codec):
+    try:
+        if codec == 'zstd':
+            _get_zstandard()
+        elif codec == 'lz4':
+            _get_lz4()
+    except ImportError:
+        return False
+
+    return True
+
+
+def choose_response_codec(size):
+    '''
+    Choose a codec for an output of a given size, following the results of benchmarks/response_codecs.py: zstd
+    compresses label maps better and faster than zlib at every size, while for the largest outputs, typically
+    displacement fields that barely compress, the fastest codec wins. zlib is used when the other codecs are missing.
+    :param size: int number of uncompressed bytes
+    :return: tuple (codec, level)
+    '''
+    if size > LARGE_OUTPUT_SIZE:
+        if codec_available('lz4'):
+            return 'lz4', 0
+        if codec_available('zstd'):
+            return 'zstd', 1
+        return 'zlib', 1
+
+    if codec_available('zstd'):
+        return 'zstd', 3
+
+    return ('zlib', 6) if size <= SMALL_OUTPUT_SIZE else ('zlib', 1)
+
+
+def compress_output(element, data):
+    '''
+    Compress an output according to the settings of its element of the output interface
+    :param element: dict element of the output interface, with a 'compression' field and optionally 'level'
+    :param data: bytes to compress
+    :return: tuple (codec used, compressed bytes)
+    '''
+    codec = element['compression']
+    level = element.get('level', None)
+
+    if codec not in RESPONSE_CODECS:
+        raise ValueError('unsupported codec {}'.format(codec))
+
+    if codec == 'auto':
+        codec, level = choose_response_codec(len(data))
+
+    return codec, compress_parallel(codec, data, level)
+
+
+def _base64_decode(data_in):
+    if sys.version_info.major == 2:
+        return base64.decodestring(data_in)
+    else:
+        return base64.decodebytes(data_in.encode("ascii"))
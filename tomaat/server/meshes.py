@@ -0,0 +1,91 @@
+import base64
+
+import numpy as np
+
+
+'''
+Serialization of VTKMesh outputs. The format is chosen by the 'format' field of the element of the output interface:
+
+    'ascii'   legacy VTK file, ASCII (default)
+    'binary'  legacy VTK file, binary
+    'vtp'     VTK XML PolyData file, binary, zlib compressed
+    'raw'     dict {'vertices': base64 of float32 (N, 3) little endian,
+                    'triangles': base64 of uint32 (M, 3) little endian}
+
+Meshes are serialized in memory, without temporary files.
+'''
+
+MESH_FORMATS = ['ascii', 'binary', 'vtp', 'raw']
+
+
+def serialize_mesh(mesh, mesh_format='ascii'):
+    """
+    :type mesh: vtkPolyData mesh to serialize
+    :type mesh_format: str one of MESH_FORMATS
+    :return: bytes content of the file, or dict for the raw format
+    """
+    import vtk
+
+    if mesh_format in ['ascii', 'binary']:
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetInputData(mesh)
+        writer.SetWriteToOutputString(True)
+
+        if mesh_format == 'binary':
+            writer.SetFileTypeToBinary()
+        else:
+            writer.SetFileTypeToASCII()
+
+        writer.Write()
+
+        content = writer.GetOutputStdString()
+
+        return content if isinstance(content, bytes) else content.encode('utf-8')
+
+    elif mesh_format == 'vtp':
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetInputData(mesh)
+        writer.SetWriteToOutputString(True)
+        writer.SetDataModeToBinary()
+        writer.SetCompressorTypeToZLib()
+        writer.Write()
+
+        return writer.GetOutputString().encode('utf-8')
+
+    elif mesh_format == 'raw':
+        vertices, triangles = mesh_to_arrays(mesh)
+
+        return {
+            'vertices': base64.b64encode(vertices.astype('<f4').tobytes()).decode('ascii'),
+            'triangles': base64.b64encode(triangles.astype('<u4').tobytes()).decode('ascii'),
+        }
+
+    raise ValueError('unsupported mesh format {}'.format(mesh_format))
+
+
+def mesh_to_arrays(mesh):
+    """
+    :type mesh: vtkPolyData mesh
+    :return: tuple of numpy arrays, float32 vertices (N, 3) and uint32 triangles (M, 3)
+    """
+    import vtk
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    polys = mesh.GetPolys()
+
+    offsets = vtk_to_numpy(polys.GetOffsetsArray())
+
+    if np.any(np.diff(offsets) != 3):
+        triangulate = vtk.vtkTriangleFilter()
+        triangulate.SetInputData(mesh)
+        triangulate.Update()
+        mesh = triangulate.GetOutput()
+        polys = mesh.GetPolys()
+
+    if mesh.GetNumberOfPoints() == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint32)
+
+    vertices = vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float32)
+    triangles = vtk_to_numpy(polys.GetConnectivityArray()).astype(np.uint32).reshape([-1, 3])
+
+    return vertices, triangles
@@ -0,0 +1,166 @@
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred
+from twisted.python.threadpool import ThreadPool
+
+
+'''
+Thread pools of the service and streaming of response bodies.
+
+Each group of endpoints runs its blocking work in a thread pool of its own, so that a burst of predictions cannot
+starve uploads or polls, and the number of concurrent predictions is not capped by the size of the reactor thread
+pool. The sizes come from the 'thread_pools' field of the service configuration, for example
+
+    'thread_pools': {'predict': 8, 'uploads': 2, 'responses': 2, 'admin': 1}
+
+Large response bodies are written back through a pull producer, in chunks of RESPONSE_WRITE_CHUNK bytes, each one
+written only once the transport has sent the previous one, so that the reactor keeps serving /interface and health
+checks while a response of hundreds of megabytes is sent.
+'''
+
+
+THREAD_POOL_NAMES = ['predict', 'uploads', 'responses', 'admin']
+DEFAULT_POOL_SIZE = 4
+
+RESPONSE_WRITE_CHUNK = 256 * 1024  # bytes
+RESPONSE_STREAMING_THRESHOLD = 1024 * 1024  # bytes
+
+
+class EndpointPools(object):
+    """
+    EndpointPools holds one Twisted ThreadPool per group of endpoints. The pools are started when the reactor starts
+    and stopped when it shuts down.
+    """
+    def __init__(self, sizes=None, default_size=DEFAULT_POOL_SIZE, names=THREAD_POOL_NAMES):
+        """
+        :type sizes: dict pool name (see THREAD_POOL_NAMES) -> maximum number of threads
+        :type default_size: int maximum number of threads of the pools whose size is not given
+        :type names: list of str names of the pools, by default those of the endpoints of a TomaatService
+        """
+        super(EndpointPools, self).__init__()
+
+        sizes = sizes or {}
+
+        self.pools = {}
+
+        for name in names:
+            self.pools[name] = ThreadPool(minthreads=0, maxthreads=int(sizes.get(name, default_size)),
+                                          name='tomaat-{}'.format(name))
+
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+
+        for pool in self.pools.values():
+            pool.start()
+
+        self.started = True
+
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if not self.started:
+            return
+
+        for pool in self.pools.values():
+            pool.stop()
+
+        self.started = False
+
+    def defer(self, name, fun, *args, **kwargs):
+        """
+        Run fun(*args, **kwargs) in the pool called name. Before the pools are started (for example in tests, where
+        the reactor does not run), the reactor thread pool is used instead.
+        :type name: str name of the pool
+        :type fun: Callable blocking work
+        :return: Deferred firing with the result of fun
+        """
+        if not self.started:
+            return threads.deferToThread(fun, *args, **kwargs)
+
+        return threads.deferToThreadPool(reactor, self.pools[name], fun, *args, **kwargs)
+
+    def stats(self):
+        stats = {}
+
+        for name, pool in self.pools.items():
+            stats[name] = {
+                'size': pool.max,
+                'threads': len(pool.threads),
+                'working': len(pool.working),
+                'backlog': pool._team.statistics().backloggedWorkCount if hasattr(pool, '_team') else pool.q.qsize(),
+            }
+
+        return stats
+
+
+class BodyProducer(object):
+    """
+    BodyProducer is a pull producer writing a body to a request in chunks. Its Deferred (done) fires once the whole
+    body has been written or the client has gone, Klein finishes the request afterwards.
+    """
+    def __init__(self, request, body, chunk_size=RESPONSE_WRITE_CHUNK):
+        """
+        :type request: Request request being answered
+        :type body: bytes body of the response
+        :type chunk_size: int number of bytes written at a time
+        """
+        super(BodyProducer, self).__init__()
+        self.request = request
+        self.body = body
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.done = Deferred()
+
+    def resumeProducing(self):
+        if self.done.called:
+            return
+
+        if self.offset >= len(self.body):
+            self.request.unregisterProducer()
+            self.done.callback(None)
+            return
+
+        self.request.write(self.body[self.offset:self.offset + self.chunk_size])
+        self.offset += self.chunk_size
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        if not self.done.called:
+            self.done.callback(None)
+
+
+def encode_body(body):
+    """
+    :type body: str or bytes body of a response
+    :return: bytes body encoded in UTF-8
+    """
+    return body if isinstance(body, bytes) else body.encode('utf-8')
+
+
+def write_body(request, body, threshold=RESPONSE_STREAMING_THRESHOLD, chunk_size=RESPONSE_WRITE_CHUNK):
+    """
+    Answer a request with body: small bodies are returned to Klein as they are, large ones are written in chunks by
+    a BodyProducer
+    :type request: Request request being answered
+    :type body: str or bytes body of the response, preferably already encoded outside of the reactor thread
+    :type threshold: int size in bytes above which the body is streamed
+    :type chunk_size: int number of bytes written at a time
+    :return: value to be returned by the Klein route: the body, or a Deferred firing once the body has been written
+    """
+    if len(body) <= threshold:
+        return body
+
+    body = encode_body(body)
+
+    request.setHeader('Content-Length', str(len(body)))
+
+    producer = BodyProducer(request, body, chunk_size)
+
+    request.notifyFinish().addErrback(lambda _: producer.stopProducing())
+    request.registerProducer(producer, False)
+
+    return producer.done
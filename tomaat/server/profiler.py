@@ -0,0 +1,219 @@
+import os
+import sys
+import threading
+import time
+import uuid
+
+
+'''
+Sampling profiler for live services. While a profile is being taken, a thread wakes up every interval and records
+the stack of every other thread of the process (sys._current_frames), including the reactor thread and the workers of
+the reactor thread pool. Threads are never interrupted nor traced, so the cost is limited to the sampling thread and
+nothing at all is paid outside profiles.
+
+Profiles are returned as collapsed stacks, one line per distinct stack, frames separated by ';' from the outermost
+(the name of the thread) to the innermost, followed by the number of samples:
+
+    MainThread;run (base.py:1412);mainLoop (base.py:1422);doPoll (epollreactor.py:228) 97
+
+which is the input format of flamegraph.pl and is read directly by speedscope.
+
+Delayed-response workers run in processes of their own: a ProfileWatcher thread in each worker joins the profiles
+announced through a dictionary shared between processes and stores its own samples in another one. Between profiles
+the watchers block on an event shared between processes, set while a profile is being taken, so they do not poll.
+'''
+
+
+DEFAULT_PROFILE_INTERVAL = 0.01  # seconds
+MIN_PROFILE_INTERVAL = 0.001  # seconds
+MAX_PROFILE_SECONDS = 60
+
+PROFILE_COLLECT_DELAY = 0.5  # seconds given to the watchers to store their samples once a profile is over
+
+
+class ProfileInProgress(Exception):
+    pass
+
+
+def frame_label(frame):
+    code = frame.f_code
+
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def collect_stack(frame):
+    '''
+    :param frame: innermost frame of a thread
+    :return: tuple of frame labels, from the outermost to the innermost
+    '''
+    stack = []
+
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+
+    return tuple(reversed(stack))
+
+
+def sample(counts, exclude, prefix=()):
+    '''
+    Record the current stack of every thread of the process
+    :param counts: dict collapsed stack -> number of samples, updated in place
+    :param exclude: set of thread identifiers not to sample
+    :param prefix: tuple of frames prepended to every stack, for example the process
+    '''
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+
+    for ident, frame in sys._current_frames().items():
+        if ident in exclude:
+            continue
+
+        stack = ';'.join(prefix + (names.get(ident, 'thread-{}'.format(ident)),) + collect_stack(frame))
+
+        counts[stack] = counts.get(stack, 0) + 1
+
+
+def profile(seconds, interval=DEFAULT_PROFILE_INTERVAL, prefix=()):
+    '''
+    Sample the threads of the current process (except the calling one) for a while
+    :param seconds: duration of the profile
+    :param interval: seconds between samples
+    :param prefix: tuple of frames prepended to every stack
+    :return: dict collapsed stack -> number of samples
+    '''
+    counts = {}
+
+    exclude = set([threading.current_thread().ident])
+
+    end = time.time() + seconds
+
+    while time.time() < end:
+        sample(counts, exclude, prefix)
+        time.sleep(interval)
+
+    return counts
+
+
+def format_collapsed(counts):
+    '''
+    :param counts: dict collapsed stack -> number of samples
+    :return: str collapsed stacks, one per line, most frequent first
+    '''
+    lines = ['{} {}'.format(stack, count) for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+class SamplingProfiler(object):
+    """
+    A SamplingProfiler takes one profile at a time of the service process and, if a shared window, result
+    dictionary and event are given, of the delayed-response worker processes watching them (see ProfileWatcher).
+    """
+    def __init__(self, window=None, results=None, started=None):
+        """
+        :type window: dict shared between processes (multiprocessing.Manager().dict()) announcing the current profile
+        :type results: dict shared between processes receiving the samples of the worker processes
+        :type started: Event shared between processes (multiprocessing.Manager().Event()) set during profiles
+        """
+        super(SamplingProfiler, self).__init__()
+        self.window = window
+        self.results = results
+        self.started = started
+        self.lock = threading.Lock()
+
+        self.profiles = 0
+
+    def run(self, seconds, interval=DEFAULT_PROFILE_INTERVAL):
+        """
+        Take a profile, blocking the calling thread for its whole duration
+        :type seconds: float duration, at most MAX_PROFILE_SECONDS
+        :type interval: float seconds between samples, at least MIN_PROFILE_INTERVAL
+        :return: dict collapsed stack -> number of samples
+        """
+        seconds = min(max(float(seconds), 0.), MAX_PROFILE_SECONDS)
+        interval = max(float(interval), MIN_PROFILE_INTERVAL)
+
+        if not self.lock.acquire(False):
+            raise ProfileInProgress('a profile is already being taken')
+
+        try:
+            profile_id = str(uuid.uuid4()).replace('-', '')
+
+            if self.results is not None:
+                # samples stored by watchers that finished after the collection of an earlier profile
+                for key in list(self.results.keys()):
+                    self.results.pop(key, None)
+
+            if self.window is not None:
+                self.window.update({'id': profile_id, 'until': time.time() + seconds, 'interval': interval})
+
+            if self.started is not None:
+                self.started.set()
+
+            counts = profile(seconds, interval, prefix=('process-{}'.format(os.getpid()),))
+
+            if self.results is not None:
+                # watchers store their samples once the profile is over
+                time.sleep(PROFILE_COLLECT_DELAY + interval)
+
+                for key in list(self.results.keys()):
+                    if key.startswith(profile_id):
+                        for stack, count in self.results.pop(key).items():
+                            counts[stack] = counts.get(stack, 0) + count
+
+            self.profiles += 1
+
+            return counts
+        finally:
+            if self.started is not None:
+                self.started.clear()
+
+            if self.window is not None:
+                self.window.clear()
+
+            self.lock.release()
+
+
+class ProfileWatcher(threading.Thread):
+    """
+    A ProfileWatcher runs in a delayed-response worker process and joins the profiles taken by the SamplingProfiler
+    of the service, storing the samples of its process in the shared result dictionary.
+    """
+    def __init__(self, window, results, started):
+        """
+        :type window: dict shared window of the SamplingProfiler
+        :type results: dict shared results of the SamplingProfiler
+        :type started: Event shared event of the SamplingProfiler
+        """
+        super(ProfileWatcher, self).__init__(name='tomaat-profile-watcher')
+        self.daemon = True
+        self.window = window
+        self.results = results
+        self.started = started
+
+    def run(self):
+        done = None
+
+        while True:
+            try:
+                self.started.wait()  # blocks until a profile is started
+                window = dict(self.window)
+            except (EOFError, IOError, OSError):
+                return  # the service is gone
+
+            remaining = window.get('until', 0) - time.time()
+
+            if window.get('id') != done and remaining > 0:
+                counts = profile(remaining, window['interval'], prefix=('process-{}'.format(os.getpid()),))
+
+                try:
+                    # the samples of a profile already collected would never be removed
+                    if self.window.get('id') == window['id']:
+                        self.results['{}_{}'.format(window['id'], os.getpid())] = counts
+                except (EOFError, IOError, OSError):
+                    return  # the service is gone
+
+                done = window['id']
+            else:
+                # profile already joined, the event is cleared once its samples are collected
+                time.sleep(PROFILE_COLLECT_DELAY)
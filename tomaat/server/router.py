@@ -0,0 +1,495 @@
+import json
+import requests
+import time
+import traceback
+
+from klein import Klein
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from twisted.logger import Logger
+
+from .service import make_endpoint_specification
+from .pools import EndpointPools
+from .uploads import UPLOAD_REFERENCE_PREFIX
+
+
+__all__ = ['TomaatRouter', 'Replica']
+
+
+HEALTH_CHECK_INTERVAL = 5  # seconds
+
+# seconds without activity after which the router forgets the replica owning a delayed request or an upload
+OWNER_EXPIRY = 3600
+OWNER_EXPIRY_CHECK_INTERVAL = 60  # seconds
+
+# forwarded requests wait for the replicas in a pool of their own, health checks are never queued behind them
+ROUTER_POOL_NAMES = ['forward', 'health']
+FORWARD_THREADS = 32
+HEALTH_CHECK_THREADS = 1
+
+FORWARDED_HEADERS = [
+    'Content-Type', 'X-Tomaat-Priority', 'X-Tomaat-Deadline', 'X-Tomaat-Request-Id', 'X-Tomaat-Offset'
+]
+
+# headers of the answers of the replicas that describe the connection to the replica rather than the answer, the
+# answer to the client gets its own. The others (Content-Type, Retry-After, X-Tomaat-Request-Id, ...) are passed on
+NOT_RETURNED_HEADERS = [
+    'Connection', 'Keep-Alive', 'Transfer-Encoding', 'Content-Length', 'Content-Encoding', 'Date', 'Server'
+]
+
+logger = Logger()
+
+
+class Replica(object):
+    def __init__(self, url):
+        """
+        A Replica is a TomaatService process the router can forward requests to
+        :type url: str base URL of the replica, for example https://localhost:9001
+        """
+        super(Replica, self).__init__()
+        self.url = url.rstrip('/')
+        self.healthy = True
+        self.outstanding = 0
+        self.routed = 0
+
+    def stats(self):
+        return {'url': self.url, 'healthy': self.healthy, 'outstanding': self.outstanding, 'routed': self.routed}
+
+
+class TomaatRouter(object):
+    """
+    A TomaatRouter exposes several replicas of the same TomaatService, typically running on the same machine on
+    different ports, as a single service. Prediction requests are sent to the healthy replica with the least
+    outstanding requests. Requests for delayed responses are sent to the replica that received the original request,
+    and the chunks of a resumable upload, as well as the prediction request referencing it, to the replica holding the
+    upload. Cancellations are sent to the replica owning the delayed request or, for synchronous requests, to every
+    replica.
+    """
+    klein_app = Klein()
+
+    health_check_task = None
+
+    owner_expiry_task = None
+
+    def __init__(self, config, replicas):
+        """
+        To instantiate a TomaatRouter the following arguments are needed
+        :type config: dict configuration containing 'port' and optionally 'cert_path', 'health_check_interval',
+        'verify_replicas' (certificate verification towards the replicas: True (default), False, or the path of the
+        certificate of the replicas), 'replica_timeout', 'owner_expiry', 'forward_threads' and 'health_check_threads'
+        :type replicas: list of str base URLs of the replicas
+        """
+        super(TomaatRouter, self).__init__()
+
+        self.config = config
+        self.replicas = [Replica(url) for url in replicas]
+
+        # delayed request id -> (replica owning its result, time of the last activity)
+        self.owners = {}
+
+        # upload id -> (replica holding the upload, time of the last activity)
+        self.upload_owners = {}
+
+        self.pools = EndpointPools(
+            sizes={
+                'forward': self.config.get('forward_threads', FORWARD_THREADS),
+                'health': self.config.get('health_check_threads', HEALTH_CHECK_THREADS),
+            },
+            names=ROUTER_POOL_NAMES
+        )
+
+        self.config['endpoint_specification'] = make_endpoint_specification(self.config)
+
+    def select_replica(self, exclude=()):
+        """
+        Select the healthy replica with the least outstanding requests
+        :type exclude: list of Replica replicas that should not be selected
+        :return: Replica or None if no healthy replica is available
+        """
+        candidates = [replica for replica in self.replicas if replica.healthy and replica not in exclude]
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda replica: (replica.outstanding, replica.routed))
+
+    def remember_owner(self, owners, key, replica):
+        owners[key] = (replica, time.time())
+
+    def find_owner(self, owners, key):
+        """
+        :type owners: dict owners or upload_owners
+        :type key: str delayed request id or upload id
+        :return: Replica owning key, None if unknown. Its activity time is refreshed
+        """
+        entry = owners.get(key)
+
+        if entry is None:
+            return None
+
+        self.remember_owner(owners, key, entry[0])
+
+        return entry[0]
+
+    def expire_owners(self):
+        """
+        Forget the owners of the delayed requests and uploads without activity for longer than 'owner_expiry' seconds:
+        results that are never fetched and uploads that are never used
+        :return: int number of forgotten entries
+        """
+        oldest = time.time() - self.config.get('owner_expiry', OWNER_EXPIRY)
+        removed = 0
+
+        for owners in [self.owners, self.upload_owners]:
+            for key, (_, last_activity) in list(owners.items()):
+                if last_activity < oldest:
+                    owners.pop(key, None)
+                    removed += 1
+
+        return removed
+
+    def referenced_upload(self, request):
+        """
+        :type request: Request prediction request
+        :return: tuple (upload id, Replica holding it) for the first known upload referenced by a field of the
+        request, (None, None) if there is none
+        """
+        prefix = UPLOAD_REFERENCE_PREFIX.encode('utf-8')
+
+        for values in (request.args or {}).values():
+            for value in values:
+                if not isinstance(value, bytes):
+                    value = value.encode('utf-8')
+
+                if not value.startswith(prefix):
+                    continue
+
+                upload_id = value[len(prefix):].strip().decode('utf-8')
+
+                owner = self.find_owner(self.upload_owners, upload_id)
+
+                if owner is not None:
+                    return upload_id, owner
+
+        return None, None
+
+    def forward_data_handler(self, replica, method, path, body=None, headers=None):
+        response = requests.request(
+            method,
+            replica.url + path,
+            data=body,
+            headers=headers,
+            verify=self.config.get('verify_replicas', True),
+            timeout=self.config.get('replica_timeout', None),
+        )
+
+        headers = dict(
+            (name, value) for name, value in response.headers.items()
+            if name.lower() not in [header.lower() for header in NOT_RETURNED_HEADERS]
+        )
+
+        return response.status_code, headers, response.content
+
+    @inlineCallbacks
+    def forward(self, request, method, path, replica=None):
+        """
+        Forward the request to a replica and copy the replica's answer, status and headers included (except those in
+        NOT_RETURNED_HEADERS), into the response to the client. If the
+        chosen replica cannot be reached it is flagged as unhealthy and, unless a replica was imposed, another
+        replica is tried.
+        :type request: Request request sent by the client
+        :type method: str HTTP method
+        :type path: str path of the endpoint on the replica
+        :type replica: Replica replica that must receive the request, None to let the router choose
+        :return: tuple (Replica that answered or None, content of the answer)
+        """
+        body = None
+        if method in ['POST', 'PUT']:
+            request.content.seek(0)
+            body = request.content.read()
+
+        headers = {}
+        for header in FORWARDED_HEADERS:
+            value = request.getHeader(header)
+            if value is not None:
+                headers[header] = value
+
+        tried = []
+
+        while True:
+            target = replica if replica is not None else self.select_replica(exclude=tried)
+
+            if target is None:
+                request.setResponseCode(503)
+                returnValue((None, json.dumps(make_router_error_response('No replica is available'))))
+
+            tried.append(target)
+
+            target.outstanding += 1
+            target.routed += 1
+
+            try:
+                code, replica_headers, content = \
+                    yield self.pools.defer('forward', self.forward_data_handler, target, method, path, body, headers)
+            except requests.exceptions.ConnectionError:
+                logger.error('replica {} is unreachable'.format(target.url))
+                target.healthy = False
+
+                if replica is not None:
+                    request.setResponseCode(502)
+                    returnValue((None, json.dumps(make_router_error_response('The replica is unreachable'))))
+
+                continue
+            except:
+                traceback.print_exc()
+                request.setResponseCode(502)
+                returnValue((None, json.dumps(make_router_error_response('Error while contacting the replica'))))
+            finally:
+                target.outstanding -= 1
+
+            request.setResponseCode(code)
+            for name, value in replica_headers.items():
+                request.setHeader(name, value)
+
+            returnValue((target, content))
+
+    @klein_app.route('/interface', methods=['GET'])
+    @inlineCallbacks
+    def interface(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'GET')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        _, content = yield self.forward(request, 'GET', '/interface')
+
+        returnValue(content)
+
+    @klein_app.route('/predict', methods=['POST'])
+    @inlineCallbacks
+    def predict(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'POST')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        # a volume sent through a resumable upload is only available on the replica holding the upload
+        upload_id, upload_owner = self.referenced_upload(request)
+
+        replica, content = yield self.forward(request, 'POST', '/predict', replica=upload_owner)
+
+        if replica is not None:
+            for request_id in delayed_request_ids(content):
+                self.remember_owner(self.owners, request_id, replica)
+
+            if upload_id is not None:
+                # the replica has claimed the upload
+                self.upload_owners.pop(upload_id, None)
+
+        returnValue(content)
+
+    @klein_app.route('/uploads', methods=['POST'])
+    @inlineCallbacks
+    def create_upload(self, request):
+        replica, content = yield self.forward(request, 'POST', '/uploads')
+
+        if replica is not None:
+            try:
+                upload_id = json.loads(content)['upload_id']
+            except (ValueError, KeyError, TypeError):
+                upload_id = None
+
+            if upload_id is not None:
+                self.remember_owner(self.upload_owners, upload_id, replica)
+
+        returnValue(content)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['GET'])
+    @inlineCallbacks
+    def upload_status(self, request, upload_id):
+        result = yield self.forward_upload(request, 'GET', upload_id)
+
+        returnValue(result)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['PUT'])
+    @inlineCallbacks
+    def upload_chunk(self, request, upload_id):
+        result = yield self.forward_upload(request, 'PUT', upload_id)
+
+        returnValue(result)
+
+    @inlineCallbacks
+    def forward_upload(self, request, method, upload_id):
+        """
+        Forward a request about an upload to the replica holding it
+        :type request: Request request sent by the client
+        :type method: str HTTP method
+        :type upload_id: str upload id
+        :return: content of the answer
+        """
+        owner = self.find_owner(self.upload_owners, upload_id)
+
+        if owner is None:
+            request.setResponseCode(404)
+            returnValue(json.dumps(make_router_error_response('Unknown upload {}'.format(upload_id))))
+
+        _, content = yield self.forward(request, method, '/uploads/' + upload_id, replica=owner)
+
+        returnValue(content)
+
+    @klein_app.route('/responses', methods=['POST'])
+    @inlineCallbacks
+    def responses(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'POST')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        raw = (request.args or {}).get(b'request_id', [b''])[0]
+        request_id = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+
+        owner = self.find_owner(self.owners, request_id)
+
+        if owner is None:
+            response = [{
+                'type': 'PlainText',
+                'content': 'The results of request {} cannot be retrieved'.format(request_id),
+                'label': ''
+            }]
+            returnValue(json.dumps(response))
+
+        replica, content = yield self.forward(request, 'POST', '/responses', replica=owner)
+
+        if replica is not None and request_id not in delayed_request_ids(content):
+            # the final result has been delivered, the replica has forgotten the request
+            self.owners.pop(request_id, None)
+
+        returnValue(content)
+
+    @klein_app.route('/cancel', methods=['POST'])
+    @inlineCallbacks
+    def cancel(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'POST')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        raw = (request.args or {}).get(b'request_id', [b''])[0]
+        request_id = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+
+        owner = self.owners.pop(request_id, (None, None))[0]
+
+        if owner is not None:
+            _, content = yield self.forward(request, 'POST', '/cancel', replica=owner)
+            returnValue(content)
+
+        # the replica processing a synchronous request is not known, every healthy replica is asked to cancel it
+        cancelled = False
+
+        for replica in [replica for replica in self.replicas if replica.healthy]:
+            replica_found, content = yield self.forward(request, 'POST', '/cancel', replica=replica)
+
+            if replica_found is not None:
+                try:
+                    cancelled = cancelled or json.loads(content)['cancelled']
+                except (ValueError, KeyError, TypeError):
+                    pass
+
+        request.setResponseCode(200)
+
+        returnValue(json.dumps({'request_id': request_id, 'cancelled': cancelled}))
+
+    @klein_app.route('/healthz', methods=['GET'])
+    def healthz(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        health = {
+            'status': 'ok',
+            'ready': any(replica.healthy for replica in self.replicas),
+            'replicas': [replica.stats() for replica in self.replicas],
+        }
+
+        return json.dumps(health)
+
+    @klein_app.route('/readyz', methods=['GET'])
+    def readyz(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        if not any(replica.healthy for replica in self.replicas):
+            request.setResponseCode(503)
+            return json.dumps({'status': 'no replica ready'})
+
+        return json.dumps({'status': 'ready'})
+
+    def health_check_data_handler(self, replica):
+        response = requests.get(
+            replica.url + '/readyz',
+            verify=self.config.get('verify_replicas', True),
+            timeout=self.config.get('health_check_interval', HEALTH_CHECK_INTERVAL),
+        )
+
+        return response.status_code == 200
+
+    @inlineCallbacks
+    def check_replicas(self):
+        """
+        Query the readiness endpoint of all replicas and update their health status
+        """
+        for replica in self.replicas:
+            try:
+                healthy = yield self.pools.defer('health', self.health_check_data_handler, replica)
+            except:
+                healthy = False
+
+            if healthy != replica.healthy:
+                logger.info('replica {} is now {}'.format(replica.url, 'healthy' if healthy else 'unhealthy'))
+
+            replica.healthy = healthy
+
+    def start_health_checks(self):
+        self.health_check_task = LoopingCall(self.check_replicas)
+        self.health_check_task.start(self.config.get('health_check_interval', HEALTH_CHECK_INTERVAL))
+
+    def stop_health_checks(self):
+        self.health_check_task.stop()
+
+    def start_owner_expiry(self):
+        self.owner_expiry_task = LoopingCall(self.expire_owners)
+        self.owner_expiry_task.start(min(self.config.get('owner_expiry', OWNER_EXPIRY), OWNER_EXPIRY_CHECK_INTERVAL))
+
+    def run(self):
+        endpoint_specification = self.config.get("endpoint_specification", None)
+
+        reactor.callWhenRunning(self.pools.start)
+        reactor.callWhenRunning(self.start_health_checks)
+        reactor.callWhenRunning(self.start_owner_expiry)
+
+        self.klein_app.run(port=self.config['port'], host='0.0.0.0', endpoint_description=endpoint_specification)
+        reactor.run()
+
+
+def make_router_error_response(message):
+    return [{'type': 'PlainText', 'content': message, 'label': 'Error!'}]
+
+
+def delayed_request_ids(content):
+    """
+    Extract the ids of delayed requests from the content of a response
+    :type content: bytes or str JSON response of a replica
+    :return: list of str request ids
+    """
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        message = json.loads(content)
+    except ValueError:
+        return []
+
+    if not isinstance(message, list):
+        return []
+
+    return [
+        element['request_id'] for element in message
+        if isinstance(element, dict) and element.get('type') == 'DelayedResponse'
+    ]
@@ -0,0 +1,187 @@
+import heapq
+import itertools
+import time
+
+from twisted.internet import threads
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from ..context import DeadlineExceeded, RequestCancelled, set_current_context
+
+
+PRIORITY_CLASSES = {'urgent': 0, 'normal': 1, 'batch': 2}
+DEFAULT_PRIORITY = 'normal'
+
+
+def priority_from_string(value):
+    """
+    Convert the priority supplied by a client, either the name of a priority class or an integer, into a priority.
+    Integers are clamped to the range of the priority classes, so that clients cannot jump ahead of 'urgent'.
+    :type value: str priority class name or integer value
+    :return: int priority, lower values are served first
+    """
+    if value is None:
+        return PRIORITY_CLASSES[DEFAULT_PRIORITY]
+
+    value = str(value).strip().lower()
+
+    if value in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value]
+
+    try:
+        priority = int(value)
+    except ValueError:
+        return PRIORITY_CLASSES[DEFAULT_PRIORITY]
+
+    return min(max(priority, min(PRIORITY_CLASSES.values())), max(PRIORITY_CLASSES.values()))
+
+
+def priority_name(priority):
+    for name, value in PRIORITY_CLASSES.items():
+        if value == priority:
+            return name
+
+    return str(priority)
+
+
+class PriorityExecutor(object):
+    """
+    A PriorityExecutor runs work in a thread pool, by default the reactor one, at most max_workers jobs at a time. Waiting jobs are
+    served by priority first and by deadline second, jobs with the same priority and deadline are served in arrival
+    order. Jobs whose deadline expires or that are cancelled while they are waiting are dropped without being run.
+    """
+    def __init__(self, max_workers, defer_to_thread=None):
+        """
+        :type max_workers: int maximum number of jobs running at the same time
+        :type defer_to_thread: Callable running a function in a thread pool and returning a Deferred with its result,
+        by default twisted.internet.threads.deferToThread
+        """
+        super(PriorityExecutor, self).__init__()
+        self.max_workers = max_workers
+        self.defer_to_thread = defer_to_thread
+
+        self.queue = []
+        self.running = 0
+        self.counter = itertools.count()
+
+        self.submitted = {}
+        self.with_deadline = {}
+        self.completed = {}
+        self.failed = {}
+        self.expired = {}
+        self.missed = {}
+        self.cancelled = {}
+
+    def submit(self, context, fun, *args, **kwargs):
+        """
+        Schedule fun(*args, **kwargs) for execution. The context is bound to the worker thread while fun runs.
+        :type context: RequestContext context of the request carrying priority and deadline
+        :type fun: Callable work to be executed
+        :return: Deferred firing with the result of fun, or failing with DeadlineExceeded or RequestCancelled if the job
+        was dropped
+        """
+        d = Deferred()
+
+        deadline = context.deadline if context.deadline is not None else float('inf')
+
+        heapq.heappush(self.queue, (context.priority, deadline, next(self.counter), context, fun, args, kwargs, d))
+
+        self._count(self.submitted, context)
+
+        if context.deadline is not None:
+            self._count(self.with_deadline, context)
+
+        self._schedule()
+
+        return d
+
+    def cancel(self, context):
+        """
+        Remove the job of a cancelled request from the queue, its Deferred fails with RequestCancelled. Running jobs
+        are not affected, they stop at the next checkpoint of their context.
+        :type context: RequestContext context of the request
+        :return: bool True if a waiting job has been removed
+        """
+        for i, entry in enumerate(self.queue):
+            if entry[3] is context:
+                break
+        else:
+            return False
+
+        _, _, _, _, _, _, _, d = self.queue.pop(i)
+        heapq.heapify(self.queue)
+
+        self._count(self.cancelled, context)
+        d.errback(RequestCancelled('request {} was cancelled in queue'.format(context.request_id)))
+
+        return True
+
+    def _count(self, counter, context):
+        name = priority_name(context.priority)
+        counter[name] = counter.get(name, 0) + 1
+
+    def _schedule(self):
+        while self.running < self.max_workers and self.queue:
+            _, _, _, context, fun, args, kwargs, d = heapq.heappop(self.queue)
+
+            if context.cancelled():
+                self._count(self.cancelled, context)
+                d.errback(RequestCancelled('request {} was cancelled in queue'.format(context.request_id)))
+                continue
+
+            if context.expired():
+                self._count(self.expired, context)
+                self._count(self.missed, context)
+                d.errback(DeadlineExceeded('deadline of request {} expired in queue'.format(context.request_id)))
+                continue
+
+            self.running += 1
+
+            defer_to_thread = self.defer_to_thread if self.defer_to_thread is not None else threads.deferToThread
+
+            work = defer_to_thread(self._run, context, fun, args, kwargs)
+            work.addBoth(self._done, context, d)
+
+    def _run(self, context, fun, args, kwargs):
+        set_current_context(context)
+
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            set_current_context(None)
+
+    def _done(self, result, context, d):
+        self.running -= 1
+
+        self._count(self.failed if isinstance(result, Failure) else self.completed, context)
+
+        if context.deadline is not None and time.time() > context.deadline:
+            self._count(self.missed, context)
+
+        self._schedule()
+
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    @property
+    def queued(self):
+        return len(self.queue)
+
+    def stats(self):
+        miss_rates = {}
+        for name, with_deadline in self.with_deadline.items():
+            miss_rates[name] = float(self.missed.get(name, 0)) / with_deadline
+
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'submitted': dict(self.submitted),
+            'completed': dict(self.completed),
+            'failed': dict(self.failed),
+            'expired': dict(self.expired),
+            'deadline_missed': dict(self.missed),
+            'cancelled': dict(self.cancelled),
+            'deadline_miss_rate': miss_rates,
+        }
@@ -0,0 +1,345 @@
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+
+SCRATCH_DIRECTORY = 'tomaat_scratch'
+SCRATCH_ORPHAN_AGE = 3600  # seconds after which a directory left behind by this process is considered orphaned
+
+TMPFS_ROOT = '/dev/shm'
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def default_scratch_root(tmpfs=False):
+    """
+    :type tmpfs: bool True to put the scratch space on tmpfs (/dev/shm), if available. Files on tmpfs use RAM
+    :return: str tomaat_scratch directory in the system temp directory, or on tmpfs if requested and available
+    """
+    if tmpfs and os.path.isdir(TMPFS_ROOT) and os.access(TMPFS_ROOT, os.W_OK):
+        return os.path.join(TMPFS_ROOT, SCRATCH_DIRECTORY)
+
+    return os.path.join(tempfile.gettempdir(), SCRATCH_DIRECTORY)
+
+
+def directory_size(path):
+    """
+    :type path: str directory
+    :return: int number of bytes of the files in the directory and its subdirectories
+    """
+    size = 0
+
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(directory, filename))
+            except OSError:
+                pass  # removed concurrently
+
+    return size
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+class QuotaFile(object):
+    """
+    File written in the directory of a request, raising ScratchQuotaExceeded as soon as a write would take the
+    directory above the request quota, instead of once the whole file is on disk. Returned by ScratchSpace.open
+    """
+    def __init__(self, space, path, filename, mode='wb'):
+        super(QuotaFile, self).__init__()
+        self.space = space
+        self.path = path
+        self.remaining = space.remaining(path)
+        self.file = open(filename, mode)
+
+    def write(self, data):
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+            if self.remaining < 0:
+                self.space.exceeded(self.path)
+
+        self.file.write(data)
+
+        self.space.record(len(data), self.path)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class ScratchSpace(object):
+    """
+    A ScratchSpace hands out the temporary directories of requests, <pid>_<id> in its root directory, and removes them
+    once the request is over. The directories are plain files on disk, so that they are shared with the processes of
+    delayed-response workers, and named after the process that created them, so that the janitor (collect) can remove
+    the directories of dead processes. Quotas bound the bytes written by one request and by all requests together:
+    writes through open are checked as they happen, files written by other means are checked by check.
+
+    The bytes in use are kept as a running count, so that handing out directories does not walk the scratch space:
+    it is updated by the writes through open, by check, by record (e.g. for uploads) and on release, and reconciled
+    with the content of the disk by the janitor, which also accounts for the files written by other processes.
+    """
+    def __init__(self, root=None, request_quota=None, total_quota=None, orphan_age=SCRATCH_ORPHAN_AGE, tmpfs=False):
+        """
+        :type root: str directory of the scratch space, by default a tomaat_scratch directory in the system temp
+        directory
+        :type request_quota: int maximum number of bytes written in the directory of one request, None for no limit
+        :type total_quota: int maximum number of bytes in the scratch space, None for no limit. No directory is
+        handed out while the scratch space is full
+        :type orphan_age: int seconds after which a directory of this process that is no longer allocated is removed
+        :type tmpfs: bool True to use a directory on tmpfs (/dev/shm) as default root. The files then use RAM,
+        set a total quota accordingly
+        """
+        super(ScratchSpace, self).__init__()
+        self.root = root if root is not None else default_scratch_root(tmpfs)
+        self.request_quota = request_quota
+        self.total_quota = total_quota
+        self.orphan_age = orphan_age
+        self.lock = threading.Lock()
+
+        # directories handed out by this process and not released yet, never removed by the janitor
+        self.active = set()
+
+        # running count of the bytes in the scratch space, and the part of it in each active directory
+        self.used = 0
+        self.sizes = {}
+
+        self.allocated = 0
+        self.released = 0
+        self.rejected = 0
+        self.over_quota = 0
+        self.orphans_removed = 0
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        self.reconcile()
+
+    def allocate(self):
+        """
+        Create the directory of a request
+        :return: str path of the directory
+        """
+        with self.lock:
+            if self.total_quota is not None and self.used >= self.total_quota:
+                self.rejected += 1
+                raise ScratchQuotaExceeded('scratch space {} is full'.format(self.root))
+
+            path = os.path.join(self.root, '{}_{}'.format(os.getpid(), str(uuid.uuid4()).replace('-', '')))
+
+            os.mkdir(path)
+
+            self.active.add(path)
+            self.allocated += 1
+
+        return path
+
+    def release(self, path):
+        """
+        Remove the directory of a request and its content
+        :type path: str path returned by allocate
+        """
+        shutil.rmtree(path, ignore_errors=True)
+
+        with self.lock:
+            self.active.discard(path)
+            self.used -= self.sizes.pop(path, 0)
+            self.released += 1
+
+    @contextmanager
+    def request(self):
+        """
+        Context manager handing out the directory of a request and removing it on exit, whatever the outcome
+        """
+        path = self.allocate()
+
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def open(self, path, filename, mode='wb'):
+        """
+        Open a file for writing in the directory of a request, enforcing the request quota on every write
+        :type path: str path returned by allocate
+        :type filename: str path of the file, in the directory of the request
+        :type mode: str mode of the file, 'wb' or 'ab'
+        :return: QuotaFile file object
+        """
+        return QuotaFile(self, path, filename, mode)
+
+    def remaining(self, path):
+        """
+        :type path: str path returned by allocate
+        :return: int number of bytes that can still be written in the directory of a request, None for no limit
+        """
+        if self.request_quota is None:
+            return None
+
+        return self.request_quota - self.measure(path)
+
+    def measure(self, path):
+        """
+        Measure the directory of a request and update the running count accordingly
+        :type path: str path returned by allocate
+        :return: int number of bytes in the directory
+        """
+        size = directory_size(path)
+
+        with self.lock:
+            if path in self.active:
+                self.used += size - self.sizes.get(path, 0)
+                self.sizes[path] = size
+
+        return size
+
+    def record(self, size, path=None):
+        """
+        Add bytes written in the scratch space, or removed from it if negative, to the running count
+        :type size: int number of bytes
+        :type path: str directory of the request holding the bytes, None for other bytes such as uploads
+        """
+        with self.lock:
+            self.used += size
+
+            if path in self.active:
+                self.sizes[path] = self.sizes.get(path, 0) + size
+
+    def check(self, path):
+        """
+        Raise ScratchQuotaExceeded if the directory of a request holds more bytes than the request quota
+        :type path: str path returned by allocate
+        """
+        if self.request_quota is None:
+            if self.total_quota is not None:
+                self.measure(path)  # keeps the running count up to date
+            return
+
+        remaining = self.remaining(path)
+
+        if remaining is not None and remaining < 0:
+            self.exceeded(path)
+
+    def exceeded(self, path):
+        """
+        Count a request above the request quota and raise ScratchQuotaExceeded
+        :type path: str path returned by allocate
+        """
+        with self.lock:
+            self.over_quota += 1
+
+        raise ScratchQuotaExceeded('request quota of {} bytes exceeded in {}'.format(self.request_quota, path))
+
+    def ensure_room(self, size):
+        """
+        Raise ScratchQuotaExceeded if writing size more bytes in the scratch space would exceed the total quota
+        :type size: int number of bytes about to be written, e.g. by an upload
+        """
+        if self.total_quota is not None and self.used + size > self.total_quota:
+            with self.lock:
+                self.rejected += 1
+
+            raise ScratchQuotaExceeded('scratch space {} is full'.format(self.root))
+
+    def usage(self):
+        """
+        :return: int number of bytes in the scratch space, walking its whole content. See used for the running count
+        """
+        return directory_size(self.root)
+
+    def reconcile(self):
+        """
+        Replace the running count with the bytes actually in the scratch space
+        """
+        usage = self.usage()
+
+        with self.lock:
+            self.used = usage
+
+    def collect(self):
+        """
+        Remove the orphaned directories: those of dead processes, and those of this process that are no longer
+        allocated and older than the orphan age. Directories of other live processes are left to their owner, and
+        are removed once it is dead.
+        :return: int number of removed directories
+        """
+        now = time.time()
+        removed = 0
+
+        for name, pid in self.request_directories():
+            path = os.path.join(self.root, name)
+
+            if pid == os.getpid():
+                with self.lock:
+                    if path in self.active:
+                        continue
+
+                try:
+                    if now - os.path.getmtime(path) <= self.orphan_age:
+                        continue
+                except OSError:
+                    continue  # released concurrently
+
+            elif process_alive(pid):
+                continue
+
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+
+        with self.lock:
+            self.orphans_removed += removed
+
+        self.reconcile()
+
+        return removed
+
+    def request_directories(self):
+        """
+        :return: list of (name, pid) of the request directories in the root, other entries are ignored
+        """
+        directories = []
+
+        for name in os.listdir(self.root):
+            try:
+                directories.append((name, int(name.split('_', 1)[0])))
+            except ValueError:
+                pass  # not created by a ScratchSpace, e.g. the upload spool
+
+        return directories
+
+    def stats(self):
+        return {
+            'root': self.root,
+            'directories': len(self.request_directories()),
+            'active': len(self.active),
+            'usage_bytes': self.used,
+            'request_quota': self.request_quota,
+            'total_quota': self.total_quota,
+            'allocated': self.allocated,
+            'released': self.released,
+            'rejected': self.rejected,
+            'over_quota': self.over_quota,
+            'orphans_removed': self.orphans_removed,
+        }
@@ -1,14 +1,16 @@
 import json
 import requests
-import tempfile
 import uuid
 import os
 import SimpleITK as sitk
 import base64
 import traceback
 import numpy as np
-import shutil
 import sys
+import itertools
+import time
+import gc
+import hmac
 
 try:
     # For Python 3.0 and later
@@ -21,18 +23,56 @@ from multiprocessing import Process, Manager, Lock
 
 from klein import Klein
 from twisted.internet.defer import inlineCallbacks, returnValue, DeferredLock
-from twisted.internet import threads
 from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
 from twisted.logger import Logger
 
+from .admission import AdmissionController, DEFAULT_MAX_IN_FLIGHT, DEFAULT_MAX_QUEUED, DEFAULT_RETRY_AFTER
+from .scheduler import PriorityExecutor, priority_from_string
+from .encoding import split_codec_header, write_compressed_volume, compress_output
+from .meshes import serialize_mesh
+from .uploads import UploadSpool, UploadNotFound, UploadOffsetMismatch, UploadTooLarge, UPLOAD_EXPIRY, \
+    UPLOAD_REFERENCE_PREFIX, UPLOAD_SPOOL_DIRECTORY
+from .scratch import ScratchSpace, ScratchQuotaExceeded, SCRATCH_ORPHAN_AGE
+from .pools import EndpointPools, write_body, encode_body, DEFAULT_POOL_SIZE
+from .profiler import SamplingProfiler, ProfileWatcher, ProfileInProgress, format_collapsed, DEFAULT_PROFILE_INTERVAL
+from ..extras.thread_budget import ThreadBudget
+from ..sparse import encode_sparse_label_volume
+from ..context import RequestContext, DeadlineExceeded, RequestCancelled, checkpoint, current_context, \
+    set_current_context, report_progress, progress_requested, new_request_id, is_request_id
+from ..tracing import Trace, span, payload_size, make_span_exporter, SPAN_KIND_SERVER
+from ..memory import MemoryMonitor, account, SOAK_WINDOW, GROWTH_THRESHOLD
+
 
 ANNOUNCEMENT_SERVER_URL = 'http://tomaat.cloud:8001/announce'
 ANNOUNCEMENT_INTERVAL = 1600  # seconds
 
+WARMUP_VOLUME_SIZE = [64, 64, 64]
+
+UPLOAD_EXPIRY_CHECK_INTERVAL = 60  # seconds
+
+SCRATCH_JANITOR_INTERVAL = 60  # seconds
+
+DELAYED_PROCESS_CHECK_INTERVAL = 1  # seconds
+
+DEFAULT_PROFILE_SECONDS = 10
+
+# progress of a request reported at the end of each stage of a TomaatApp, the rest is response creation
+PROGRESS_PREPROCESSED = 0.2
+PROGRESS_INFERRED = 0.7
+PROGRESS_POSTPROCESSED = 0.9
+
 logger = Logger()
 
 
+class InvalidRequestId(ValueError):
+    pass
+
+
+class InvalidDeadline(ValueError):
+    pass
+
+
 def is_base64(s):
     try:
         if base64.b64encode(base64.b64decode(s)) == s:
@@ -58,22 +98,54 @@ def do_announcement(announcement_server_url, message):
         pass
 
 
+def make_endpoint_specification(config):
+    """
+    Create the specification of the https endpoint of a service, generating a self-signed certificate if needed
+    :type config: dict configuration containing 'port' and optionally 'cert_path' (default ./tomaat_cert)
+    :return: str endpoint specification
+    """
+    if not "cert_path" in config.keys():
+        config["cert_path"] = "./tomaat_cert"
+
+    cert_private = config["cert_path"] + ".key"
+    cert_public = config["cert_path"] + ".crt"
+
+    from . import makecert
+    if not os.path.exists(cert_private) or not os.path.exists(cert_public):
+        makecert.create_self_signed_cert(cert_public,cert_private)
+
+    cert_fingerprint = makecert.get_cert_fingerprint(cert_public)
+    print("\nMake sure to check the fingerprint of this endpoint on the client side.\nThe fingerprint is:\n\n{}\n".format(cert_fingerprint))
+
+    # setup https
+    endpoint_specification = "ssl:{}".format(config['port'])
+    endpoint_specification += ":certKey="+cert_public
+    endpoint_specification += ":privateKey="+cert_private
+
+    return endpoint_specification
+
+
 class TomaatApp(object):
     """
     A TomaatApp is an object that implements the functionality of the user application. More specifically,
     this object implements the workflow that is needed by the app. It requires the following arguments
     """
-    def __init__(self, preprocess_fun, inference_fun, postprocess_fun):
+    def __init__(self, preprocess_fun, inference_fun, postprocess_fun, preview_fun=None):
         """
         To instantiate a TomaatApp the following arguments are needed
         :type preprocess_fun: Callable function or callable object implementing pre-processing
         :type inference_fun: Callable function or callable object implementing inference
         :type postprocess_fun: Callable function or callable object implementing post-processing
+        :type preview_fun: Callable optional function computing a fast, coarse result from the pre-processed data,
+        without modifying it. The result must contain the fields of the output interface. It is published as a
+        partial result of delayed requests before inference starts, and not computed for requests that do not
+        publish progress, such as synchronous ones
         """
         super(TomaatApp, self).__init__()
         self.preprocess_fun = preprocess_fun
         self.inference_fun = inference_fun
         self.postprocess_fun = postprocess_fun
+        self.preview_fun = preview_fun
 
     def __call__(self, data, gpu_lock=None):
         """
@@ -82,17 +154,39 @@ class TomaatApp(object):
         :type gpu_lock: DeferredLock optional lock to allow threads to safely use the GPU. No GPU => no lock needed
         :return: dict containing inference results after post-processing
         """
-        transformed_data = self.preprocess_fun(data)
+        with span('preprocess'):
+            transformed_data = self.preprocess_fun(data)
+
+        checkpoint()  # do not waste inference on requests whose deadline already expired
+
+        if self.preview_fun is not None and progress_requested():
+            with span('preview'):
+                preview = self.preview_fun(transformed_data)
+
+            report_progress(PROGRESS_PREPROCESSED, preview)
+        else:
+            report_progress(PROGRESS_PREPROCESSED)
+
+        with span('inference') as inference_span:
+            if gpu_lock is not None:
+                gpu_lock.acquire()  # acquire GPU lock
 
-        if gpu_lock is not None:
-            gpu_lock.acquire()  # acquire GPU lock
+            if inference_span is not None:
+                inference_span.set_attribute('tomaat.payload_bytes', payload_size(transformed_data))
 
-        result = self.inference_fun(transformed_data)  # GPU call
+            result = self.inference_fun(transformed_data)  # GPU call
 
-        if gpu_lock is not None:
-            gpu_lock.release()  # release GPU lock
+            if gpu_lock is not None:
+                gpu_lock.release()  # release GPU lock
 
-        transformed_result = self.postprocess_fun(result)
+        report_progress(PROGRESS_INFERRED)
+
+        checkpoint()
+
+        with span('postprocess'):
+            transformed_result = self.postprocess_fun(result)
+
+        report_progress(PROGRESS_POSTPROCESSED)
 
         return transformed_result
 
@@ -102,6 +196,10 @@ class TomaatService(object):
 
     announcement_task = None
 
+    upload_expiry_task = None
+
+    scratch_janitor_task = None
+
     gpu_lock = DeferredLock()
 
     def __init__(self, config, app, input_interface, output_interface):
@@ -119,26 +217,69 @@ class TomaatService(object):
 
         self.input_interface = input_interface
         self.output_interface = output_interface
-        if not "cert_path" in self.config.keys():
-            self.config["cert_path"] = "./tomaat_cert"
-
-        cert_private = self.config["cert_path"] + ".key"
-        cert_public = self.config["cert_path"] + ".crt"
-
-        from . import makecert
-        if not os.path.exists(cert_private) or not os.path.exists(cert_public):
-            makecert.create_self_signed_cert(cert_public,cert_private)
-
-        cert_fingerprint = makecert.get_cert_fingerprint(cert_public)
-        print("\nMake sure to check the fingerprint of this endpoint on the client side.\nThe fingerprint is:\n\n{}\n".format(cert_fingerprint))
-
-        # setup https
-        endpoint_specification = "ssl:{}".format(self.config['port'])
-        endpoint_specification += ":certKey="+cert_public
-        endpoint_specification += ":privateKey="+cert_private
-
-        self.config['endpoint_specification'] = endpoint_specification
 
+        self.config['endpoint_specification'] = make_endpoint_specification(self.config)
+
+        self.admission = AdmissionController(
+            max_in_flight=self.config.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+            max_queued=self.config.get('max_queued', DEFAULT_MAX_QUEUED),
+            retry_after=self.config.get('retry_after', DEFAULT_RETRY_AFTER),
+        )
+
+        # thread pools of the endpoints (config field 'thread_pools'), predictions get one thread per admitted request
+        pool_sizes = dict(self.config.get('thread_pools', {}))
+        pool_sizes.setdefault('predict', self.admission.max_in_flight)
+
+        self.pools = EndpointPools(
+            sizes=pool_sizes,
+            default_size=self.config.get('thread_pool_size', DEFAULT_POOL_SIZE)
+        )
+
+        self.executor = PriorityExecutor(
+            max_workers=self.admission.max_in_flight,
+            defer_to_thread=lambda fun, *args: self.pools.defer('predict', fun, *args)
+        )
+
+        # share of the cores used by the SimpleITK filters of each request, see tomaat.extras.thread_budget
+        self.thread_budget = ThreadBudget(self.config['itk_threads']) if 'itk_threads' in self.config else None
+
+        # temporary directories of the requests, see tomaat.server.scratch
+        self.scratch = ScratchSpace(
+            root=self.config.get('scratch_root', None),
+            request_quota=self.config.get('scratch_request_quota', None),
+            total_quota=self.config.get('scratch_total_quota', None),
+            orphan_age=self.config.get('scratch_orphan_age', SCRATCH_ORPHAN_AGE),
+            tmpfs=self.config.get('scratch_tmpfs', False)
+        )
+
+        # by default the uploads are spooled in the scratch space, on the same filesystem as the request directories
+        # they are claimed into, and count towards its total quota
+        self.uploads = UploadSpool(
+            root=self.config.get('upload_spool', os.path.join(self.scratch.root, UPLOAD_SPOOL_DIRECTORY)),
+            expiry=self.config.get('upload_expiry', UPLOAD_EXPIRY)
+        )
+
+        # sampling profiler behind /admin/profile, only if enabled (config field 'profiling')
+        self.profiler = SamplingProfiler() if self.config.get('profiling', False) else None
+
+        # memory accounting of the requests, only if enabled (config field 'memory_accounting'), see tomaat.memory
+        self.memory = None
+
+        if self.config.get('memory_accounting', False):
+            self.memory = MemoryMonitor(
+                trace_python=self.config.get('memory_trace_python', False),
+                soak_window=self.config.get('memory_soak_window', SOAK_WINDOW),
+                growth_threshold=self.config.get('memory_growth_threshold', GROWTH_THRESHOLD)
+            )
+
+        # exporter of the traces of the requests, see tomaat.tracing
+        self.span_exporter = make_span_exporter(self.config)
+
+        # request id -> context of the prediction requests being queued or processed, for cancellation
+        self.contexts = {}
+
+        # the service becomes ready once the warm-up phase has been completed
+        self.ready = False
 
     @klein_app.route('/announcePoint', methods=['GET'])
     def announcePoint(self, request):
@@ -163,12 +304,458 @@ class TomaatService(object):
         request.setHeader('Access-Control-Allow-Headers', '*')
         request.setHeader('Access-Control-Max-Age', '520')  # 42 hours
 
+        result = yield self.dispatch_prediction(request)
+
+        returnValue(write_body(request, result))
+
+    @klein_app.route('/healthz', methods=['GET'])
+    def healthz(self, request):
+        return self.health_data_handler(request)
+
+    @klein_app.route('/readyz', methods=['GET'])
+    def readyz(self, request):
+        return self.readiness_data_handler(request)
+
+    @klein_app.route('/metrics', methods=['GET'])
+    @inlineCallbacks
+    def metrics(self, request):
+        # collecting the metrics walks the scratch space and, with delayed responses, talks to the manager process
+        result = yield self.pools.defer('admin', self.metrics_data_handler, request)
+
+        returnValue(result)
+
+    @klein_app.route('/admin/profile', methods=['GET'])
+    @inlineCallbacks
+    def profile(self, request):
+        result = yield self.pools.defer('admin', self.profile_data_handler, request)
+
+        returnValue(result)
+
+    @klein_app.route('/uploads', methods=['POST'])
+    @inlineCallbacks
+    def create_upload(self, request):
+        result = yield self.pools.defer('uploads', self.create_upload_data_handler, request)
+
+        returnValue(result)
+
+    @klein_app.route('/cancel', methods=['POST'])
+    def cancel(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'POST')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        return self.cancel_data_handler(request)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['GET'])
+    def upload_status(self, request, upload_id):
+        return self.upload_status_data_handler(request, upload_id)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['PUT'])
+    @inlineCallbacks
+    def upload_chunk(self, request, upload_id):
+        result = yield self.pools.defer('uploads', self.upload_chunk_data_handler, request, upload_id)
+
+        returnValue(result)
+
+    @inlineCallbacks
+    def dispatch_prediction(self, request):
+        """
+        Run a prediction request subject to readiness and admission control. Requests received while the service is
+        warming up or while both the processing slots and the waiting queue are full are answered with 503.
+        :type request: Request request sent by the client
+        :return: JSON containing response that can be returned to the client
+        """
+        if not self.ready:
+            returnValue(self.make_unavailable_response(request, 'The service is warming up, retry later'))
+
+        try:
+            context = self.make_request_context(request)
+        except (InvalidRequestId, InvalidDeadline) as e:
+            request.setResponseCode(400)
+            returnValue(json.dumps(self.make_error_response(str(e))))
+
+        if self.request_in_flight(context.request_id):
+            request.setResponseCode(409)
+            returnValue(json.dumps(self.make_error_response(
+                'Request {} is already being processed'.format(context.request_id)
+            )))
+
+        if not self.admission.admit():
+            logger.warn('rejecting request: service overloaded')
+            returnValue(self.make_unavailable_response(request, 'The service is overloaded, retry later'))
+
+        self.contexts[context.request_id] = context
+
+        request.setHeader('X-Tomaat-Request-Id', context.request_id)
+
+        # a client that disconnects does not need the result anymore
+        request.notifyFinish().addErrback(lambda _: self.cancel_request(context.request_id))
+
         logger.info('predicting...')
 
-        result = yield threads.deferToThread(self.received_data_handler, request)
+        try:
+            # the response is encoded in the worker thread, large responses are then streamed by the reactor
+            result = yield self.executor.submit(context, lambda: encode_body(self.received_data_handler(request)))
+        except DeadlineExceeded:
+            logger.warn('dropping request: deadline expired while queued')
+            request.setResponseCode(504)
+            result = json.dumps(self.make_error_response('The deadline of the request expired before processing'))
+        except RequestCancelled:
+            logger.warn('dropping request: cancelled while queued')
+            result = json.dumps(self.make_error_response('The request was cancelled'))
+        finally:
+            self.release_admission(context)
+            self.contexts.pop(context.request_id, None)
 
         returnValue(result)
 
+    def release_admission(self, context):
+        """
+        Give back the admission slot of a request once its response has been created
+        :type context: RequestContext context of the request
+        """
+        self.admission.release()
+
+    def make_request_context(self, request):
+        """
+        Create the context of a request. Priority and deadline are read from the X-Tomaat-Priority and
+        X-Tomaat-Deadline headers or, if the headers are absent, from the 'priority' and 'deadline' POST fields.
+        The identifier used to cancel the request is read in the same way from X-Tomaat-Request-Id or 'request_id',
+        and generated by the service if absent. Knowing the identifier of a request is enough to cancel it, so
+        identifiers supplied by clients must be random: 32 lowercase hexadecimal digits, as uuid.uuid4().hex.
+        The priority is either a priority class ('urgent', 'normal', 'batch') or an integer, lower is more urgent.
+        The deadline is expressed in seconds from the moment the request is received, a finite non-negative number.
+        :type request: Request request sent by the client
+        :return: RequestContext of the request
+        """
+        def get_value(header, field):
+            value = request.getHeader(header)
+
+            if value is None:
+                raw = (request.args or {}).get(field.encode('UTF-8'))
+                if raw:
+                    value = raw[0].decode('utf-8') if isinstance(raw[0], bytes) else raw[0]
+
+            return value
+
+        priority = priority_from_string(get_value('X-Tomaat-Priority', 'priority'))
+
+        deadline = get_value('X-Tomaat-Deadline', 'deadline')
+        if deadline is not None:
+            try:
+                seconds = float(deadline)
+            except ValueError:
+                seconds = float('nan')
+
+            # nan fails both comparisons
+            if not 0 <= seconds < float('inf'):
+                raise InvalidDeadline('Deadlines must be a number of seconds, not {!r}'.format(deadline))
+
+            deadline = time.time() + seconds
+
+        request_id = get_value('X-Tomaat-Request-Id', 'request_id')
+
+        if request_id is None:
+            request_id = new_request_id()
+        elif not is_request_id(request_id):
+            raise InvalidRequestId('Request ids must be made of 32 lowercase hexadecimal digits, as uuid4().hex')
+
+        return RequestContext(request_id=request_id, priority=priority, deadline=deadline)
+
+    def request_in_flight(self, request_id):
+        """
+        :type request_id: str identifier of a request
+        :return: bool True if a request with this identifier is queued or being processed
+        """
+        return request_id in self.contexts
+
+    def cancel_request(self, request_id):
+        """
+        Cancel a prediction request. A waiting request is removed from the queue, a running request stops at the next
+        checkpoint: before inference, between the stages of the app and between the transforms of a TransformChain.
+        :type request_id: str identifier of the request
+        :return: bool True if the request was found
+        """
+        context = self.contexts.get(request_id)
+
+        if context is None:
+            return False
+
+        logger.info('cancelling request {}'.format(request_id))
+
+        context.cancel()
+        self.executor.cancel(context)
+
+        return True
+
+    def cancel_data_handler(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        raw = (request.args or {}).get(b'request_id') or (request.args or {}).get('request_id') or ['']
+        request_id = raw[0].decode('utf-8') if isinstance(raw[0], bytes) else raw[0]
+
+        return json.dumps({'request_id': request_id, 'cancelled': self.cancel_request(request_id)})
+
+    def health_data_handler(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        health = {
+            'status': 'ok',
+            'ready': self.ready,
+            'in_flight': self.executor.running,
+            'queued': self.executor.queued,
+        }
+
+        return json.dumps(health)
+
+    def metrics_data_handler(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        metrics = {
+            'admission': self.admission.stats(),
+            'scheduler': self.executor.stats(),
+            'scratch': self.scratch.stats(),
+            'thread_pools': self.pools.stats(),
+        }
+
+        if self.memory is not None:
+            metrics['memory'] = self.memory_stats()
+
+        return json.dumps(metrics)
+
+    def memory_stats(self):
+        """
+        :return: dict memory statistics of the requests (see tomaat.memory.MemoryMonitor) and the size of the state
+        kept by the service across requests
+        """
+        stats = self.memory.stats()
+        stats['state'] = self.memory_state()
+
+        return stats
+
+    def memory_state(self):
+        """
+        :return: dict size of the long-lived state of the service
+        """
+        return {
+            'contexts': len(self.contexts),
+            'queued': self.executor.queued,
+            'python_objects': len(gc.get_objects()),
+        }
+
+    def profile_data_handler(self, request):
+        """
+        Profile the service for 'seconds' (default 10, at most 60) sampling all threads every 'interval' seconds
+        (default 0.01), see tomaat.server.profiler. Profiling must be enabled by the 'profiling' configuration field,
+        and if an 'admin_token' is configured it must be supplied in the X-Tomaat-Admin-Token header.
+        :type request: Request request sent by the client
+        :return: str collapsed stacks, ready for flamegraph.pl or speedscope
+        """
+        if self.profiler is None:
+            request.setResponseCode(404)
+            return json.dumps(self.make_error_response('Profiling is not enabled'))
+
+        token = self.config.get('admin_token', None)
+
+        supplied = request.getHeader('X-Tomaat-Admin-Token') or ''
+
+        # constant-time comparison, the time taken must not reveal how much of the token is right
+        if token is not None and not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+            request.setResponseCode(403)
+            return json.dumps(self.make_error_response('Invalid admin token'))
+
+        args = request.args or {}
+
+        try:
+            seconds = float(to_str(args.get(b'seconds', [DEFAULT_PROFILE_SECONDS])[0]))
+            interval = float(to_str(args.get(b'interval', [DEFAULT_PROFILE_INTERVAL])[0]))
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps(self.make_error_response('Invalid profile duration or interval'))
+
+        try:
+            counts = self.profiler.run(seconds, interval)
+        except ProfileInProgress:
+            request.setResponseCode(409)
+            return json.dumps(self.make_error_response('A profile is already being taken'))
+
+        request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        request.setHeader('Content-Disposition', 'attachment; filename="tomaat.collapsed"')
+
+        return format_collapsed(counts)
+
+    def readiness_data_handler(self, request):
+        request.setHeader('Content-Type', 'application/json')
+
+        if not self.ready:
+            request.setResponseCode(503)
+            request.setHeader('Retry-After', str(self.admission.retry_after))
+            return json.dumps({'status': 'warming up'})
+
+        return json.dumps({'status': 'ready'})
+
+    def create_upload_data_handler(self, request):
+        """
+        Open a resumable upload. The POST fields are 'size', the number of bytes that will be uploaded, and
+        optionally 'codec', the codec used to compress the uploaded volume.
+        """
+        request.setHeader('Content-Type', 'application/json')
+
+        size = int(to_str(request.args[b'size'][0]))
+
+        codec = request.args.get(b'codec')
+        codec = to_str(codec[0]) if codec else None
+
+        if self.scratch.request_quota is not None and size > self.scratch.request_quota:
+            request.setResponseCode(413)
+            return json.dumps(self.make_error_response('The upload exceeds the scratch space quota'))
+
+        try:
+            self.scratch.ensure_room(size)
+            upload_id = self.uploads.create(size, codec)
+        except ScratchQuotaExceeded:
+            return self.make_unavailable_response(request, 'The service is out of scratch space, retry later')
+        except ValueError as e:
+            request.setResponseCode(400)
+            return json.dumps(self.make_error_response(str(e)))
+
+        return json.dumps({'upload_id': upload_id, 'offset': 0, 'size': size, 'complete': size == 0})
+
+    def upload_status_data_handler(self, request, upload_id):
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            return json.dumps(self.uploads.status(upload_id))
+        except UploadNotFound:
+            request.setResponseCode(404)
+            return json.dumps(self.make_error_response('Unknown upload {}'.format(upload_id)))
+
+    def upload_chunk_data_handler(self, request, upload_id):
+        """
+        Append the body of the request to an upload. The position of the chunk is given by the X-Tomaat-Offset
+        header or the 'offset' query argument and must be equal to the number of bytes received so far. Chunks going
+        past the size declared when the upload was created are refused with status 413.
+        """
+        request.setHeader('Content-Type', 'application/json')
+
+        offset = request.getHeader('X-Tomaat-Offset')
+        if offset is None:
+            offset = to_str(request.args[b'offset'][0])
+
+        request.content.seek(0)
+        content = request.content.read()
+
+        try:
+            self.scratch.ensure_room(len(content))
+            self.uploads.write(upload_id, int(offset), content)
+            self.scratch.record(len(content))
+            return json.dumps(self.uploads.status(upload_id))
+        except ScratchQuotaExceeded:
+            return self.make_unavailable_response(request, 'The service is out of scratch space, retry later')
+        except UploadNotFound:
+            request.setResponseCode(404)
+            return json.dumps(self.make_error_response('Unknown upload {}'.format(upload_id)))
+        except UploadOffsetMismatch:
+            request.setResponseCode(409)
+            return json.dumps(self.uploads.status(upload_id))
+        except UploadTooLarge as e:
+            request.setResponseCode(413)
+            return json.dumps(self.make_error_response(str(e)))
+
+    def start_upload_expiry(self):
+        self.upload_expiry_task = LoopingCall(self.uploads.expire)
+        self.upload_expiry_task.start(min(self.uploads.expiry, UPLOAD_EXPIRY_CHECK_INTERVAL))
+
+    def start_scratch_janitor(self):
+        self.scratch_janitor_task = LoopingCall(self.scratch.collect)
+        self.scratch_janitor_task.start(min(self.scratch.orphan_age, SCRATCH_JANITOR_INTERVAL))
+
+    def make_unavailable_response(self, request, message):
+        """
+        Flag the request as rejected with 503 and a Retry-After header and create the error message for the client
+        :type request: Request request sent by the client
+        :type message: str error message to be returned to the client
+        :return: JSON containing response that can be returned to the client
+        """
+        request.setResponseCode(503)
+        request.setHeader('Retry-After', str(self.admission.retry_after))
+
+        return json.dumps(self.make_error_response(message))
+
+    def make_warmup_data(self, savepath):
+        """
+        Create synthetic data, shaped like the output of parse_request, that is used to warm up the app before
+        the service starts accepting requests. Services needing realistic inputs can override this method.
+        :type savepath: str directory where synthetic files can be stored
+        :return: dict containing data that can be fed to the pre-processing, inference, post-processing pipeline
+        """
+        data = {}
+
+        for element in self.input_interface:
+            if element['type'] == 'volume':
+                size = self.config.get('warmup_volume_size', WARMUP_VOLUME_SIZE)
+
+                volume = sitk.GetImageFromArray(np.random.rand(*size[::-1]).astype(np.float32))
+
+                tmp_filename_mha = os.path.join(savepath, str(uuid.uuid4()).replace('-', '') + '.mha')
+                sitk.WriteImage(volume, tmp_filename_mha)
+
+                data[element['destination']] = [tmp_filename_mha]
+
+            elif element['type'] == 'slider':
+                minimum = float(element.get('minimum', 0))
+                maximum = float(element.get('maximum', minimum))
+                data[element['destination']] = [(minimum + maximum) / 2.]
+
+            elif element['type'] == 'checkbox':
+                data[element['destination']] = ['False']
+
+            elif element['type'] == 'radiobutton':
+                data[element['destination']] = [str(element['options'][0])]
+
+            elif element['type'] == 'fiducials':
+                data[element['destination']] = [np.zeros((1, 3))]
+
+            elif element['type'] == 'transform':
+                tmp_transform = os.path.join(savepath, str(uuid.uuid4()) + '.mat')
+                sitk.WriteTransform(sitk.Transform(3, sitk.sitkIdentity), tmp_transform)
+
+                data[element['destination']] = [tmp_transform]
+
+        # scratch directory of the request, removed once the response is sent. Transforms can store files there.
+        data['savepath'] = savepath
+
+        return data
+
+    def warmup_data_handler(self, iterations):
+        with self.scratch.request() as savepath:
+            for _ in range(iterations):
+                data = self.make_warmup_data(savepath)
+                transformed_result = self.run_app(data)
+                self.make_response(transformed_result, savepath)
+
+    @inlineCallbacks
+    def warm_up(self):
+        """
+        Run the warm-up phase (config field 'warmup_requests', default 0) and flag the service as ready afterwards.
+        A failing warm-up is logged but does not prevent the service from becoming ready.
+        """
+        iterations = self.config.get('warmup_requests', 0)
+
+        if iterations > 0:
+            logger.info('warming up...')
+
+            try:
+                yield self.pools.defer('predict', self.warmup_data_handler, iterations)
+            except:
+                traceback.print_exc()
+                logger.error('Server-side ERROR during warm-up')
+
+        self.ready = True
+
+        logger.info('service ready')
+
     def start_service_announcement(
             self,
             fun=do_announcement,
@@ -206,6 +793,45 @@ class TomaatService(object):
     def stop_service_announcement(self):
         self.announcement_task.stop()
 
+    def run_app(self, data):
+        """
+        Run the app on data, within the thread budget of the service if one is configured (config field 'itk_threads')
+        :type data: dict data returned by parse_request
+        :return: dict containing inference results after post-processing
+        """
+        if self.thread_budget is None:
+            return self.app(data, gpu_lock=self.gpu_lock)
+
+        with self.thread_budget.pipeline():
+            return self.app(data, gpu_lock=self.gpu_lock)
+
+    def make_file_response_element(self, element, filename):
+        """
+        Create the element of the response carrying the content of a file, compressed according to the 'compression'
+        and 'level' settings of the element of the output interface, if any (see tomaat.server.encoding)
+        :type element: dict element of the output interface
+        :type filename: str path of the file
+        :return: dict element of the response
+        """
+        with open(filename, 'rb') as f:
+            content = f.read()
+
+        return self.make_bytes_response_element(element, content)
+
+    def make_bytes_response_element(self, element, content):
+        """
+        Create the element of the response carrying content, compressed as make_file_response_element does
+        :type element: dict element of the output interface
+        :type content: bytes content to send
+        :return: dict element of the response
+        """
+        if 'compression' not in element:
+            return {'type': element['type'], 'content': __base64_encode__(content), 'label': ''}
+
+        codec, compressed = compress_output(element, content)
+
+        return {'type': element['type'], 'content': __base64_encode__(compressed), 'label': '', 'compression': codec}
+
     def make_error_response(self, message):
         """
         Create simple error message to be returned to the client as plain text
@@ -229,13 +855,7 @@ class TomaatService(object):
 
         for element in self.input_interface:
             raw = request.args[element['destination'].encode('UTF-8')]
-            if sys.version_info.major == 2:
-                raw_first = str(raw[0])
-            else:
-                try:
-                    raw_first = raw[0].decode("utf-8")
-                except:
-                    raw_first = raw[0]
+            raw_first = to_str(raw[0])
 
             if element['type'] == 'volume':
                 uid = uuid.uuid4()
@@ -244,15 +864,36 @@ class TomaatService(object):
 
                 tmp_filename_mha = os.path.join(savepath, mha_file)
 
-                with open(tmp_filename_mha, 'wb') as f:
+                codec, payload = split_codec_header(raw_first)
+
+                if raw_first.startswith(UPLOAD_REFERENCE_PREFIX):
+                    # volume sent earlier through a resumable upload
                     try:
-                        f.write(__base64_decode__(raw_first))
-                    except:
-                        f.write(raw_first)
-                        print(
-                            'Your client has passed RAW file content instead of base64 encoded string: '
-                            'this is deprecated and will result in errors in future version of the server'
+                        size = self.uploads.claim(
+                            raw_first[len(UPLOAD_REFERENCE_PREFIX):].strip(), tmp_filename_mha,
+                            max_size=self.scratch.remaining(savepath)
                         )
+                    except ScratchQuotaExceeded:
+                        self.scratch.exceeded(savepath)
+
+                    # the upload left the spool for the directory of the request
+                    self.scratch.record(-size)
+                    self.scratch.measure(savepath)
+                elif codec is not None:
+                    # compressed volume, possibly split in several values of the same field
+                    with self.scratch.open(savepath, tmp_filename_mha) as f:
+                        chunks = itertools.chain([payload], (to_str(chunk) for chunk in raw[1:]))
+                        write_compressed_volume(codec, chunks, f)
+                else:
+                    with self.scratch.open(savepath, tmp_filename_mha) as f:
+                        try:
+                            f.write(__base64_decode__(raw_first))
+                        except:
+                            f.write(raw_first)
+                            print(
+                                'Your client has passed RAW file content instead of base64 encoded string: '
+                                'this is deprecated and will result in errors in future version of the server'
+                            )
                 data[element['destination']] = [tmp_filename_mha]
 
             elif element['type'] == 'slider':
@@ -296,12 +937,15 @@ class TomaatService(object):
                 uid = uuid.uuid4()
                 trf_file = str(uid) + trf_file_type
                 tmp_transform = os.path.join(savepath, trf_file)
-                with open(tmp_transform, 'wb') as f:
+                with self.scratch.open(savepath, tmp_transform) as f:
                     # write base64 data
                     f.write( __base64_decode__(req[len(trf_file_type):]) )
 
                 data[element['destination']] = [tmp_transform]
 
+        # scratch directory of the request, removed once the response is sent. Transforms can store files there.
+        data['savepath'] = savepath
+
         return data
 
     def make_response(self, data, savepath):
@@ -326,36 +970,41 @@ class TomaatService(object):
 
                 writer = sitk.ImageFileWriter()
                 writer.SetFileName(tmp_label_volume)
-                writer.SetUseCompression(True)
+                # with a compression setting the file is compressed afterwards, in parallel
+                writer.SetUseCompression('compression' not in element)
                 writer.Execute(data[field][0])
 
-                with open(tmp_label_volume, 'rb') as f:
-                    vol_string = base64.encodestring(f.read()).decode('utf-8')
+                self.scratch.check(savepath)
 
-                message.append({'type': 'LabelVolume', 'content': vol_string, 'label': ''})
+                message.append(self.make_file_response_element(element, tmp_label_volume))
 
                 os.remove(tmp_label_volume)
 
+            elif type == 'SparseLabelVolume':
+                message.append({'type': 'SparseLabelVolume', 'content': encode_sparse_label_volume(data[field][0]), 'label': ''})
+
             elif type == 'VTKMesh':
-                import vtk
+                mesh_format = element.get('format', 'ascii')
 
-                uid = uuid.uuid4()
+                # a dict label -> mesh, as produced by FromLabelVolumeToVTKMeshes, gives one element per label
+                meshes = data[field][0]
+                meshes = sorted(meshes.items()) if isinstance(meshes, dict) else [(None, meshes)]
 
-                vtk_mesh = str(uid).replace('-', '') + '_seg.vtk'
-                tmp_vtk_mesh = os.path.join(savepath, vtk_mesh)
+                for value, mesh in meshes:
+                    content = serialize_mesh(mesh, mesh_format)
 
-                writer = vtk.vtkPolyDataWriter()
-                writer.SetFileName(tmp_vtk_mesh)
-                writer.SetInputData(data[field][0])
-                writer.SetFileTypeToASCII()
-                writer.Write()
+                    if mesh_format == 'raw':
+                        response_element = {'type': 'VTKMesh', 'content': content, 'label': ''}
+                    else:
+                        response_element = self.make_bytes_response_element(element, content)
 
-                with open(tmp_vtk_mesh, 'rb') as f:
-                    mesh_string = base64.encodestring(f.read()).decode('utf-8')
+                    if 'format' in element:
+                        response_element['format'] = mesh_format
 
-                message.append({'type': 'VTKMesh', 'content': mesh_string, 'label': ''})
+                    if value is not None:
+                        response_element['label'] = str(value)
 
-                os.remove(tmp_vtk_mesh)
+                    message.append(response_element)
 
             elif type == 'PlainText':
                 message.append({'type': 'PlainText', 'content': str(data[field][0]), 'label': ''})
@@ -374,6 +1023,11 @@ class TomaatService(object):
                 uid = uuid.uuid4()
 
                 trf_file_name = str(uid) + '.' + trf_file_type[type]
+
+                if type == "TransformGrid" and 'compression' in element:
+                    # written uncompressed, compressed afterwards in parallel. With gzip the result is a nii.gz file
+                    trf_file_name = str(uid) + '.nii'
+
                 trf_file_path = os.path.join(savepath, trf_file_name)
 
                 if type == "TransformGrid":
@@ -382,51 +1036,164 @@ class TomaatService(object):
                 else:
                     sitk.WriteTransform(data[field][0],trf_file_path)
 
-                with open(trf_file_path, 'rb') as f:
-                    vol_string = base64.encodestring(f.read()).decode("utf-8")
+                self.scratch.check(savepath)
 
-                message.append({'type': type, 'content': vol_string, 'label': ''})
+                message.append(self.make_file_response_element(element, trf_file_path))
 
                 os.remove(trf_file_path)
 
         return message
 
     def received_data_handler(self, request):
-        savepath = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()).replace('-', ''))
+        context = self.start_trace()
+
+        try:
+            with span('request', kind=SPAN_KIND_SERVER, **self.request_span_attributes(context)) as request_span:
+                try:
+                    with account(self.memory), self.scratch.request() as savepath:
+                        self.watch_scratch(current_context(), savepath)
+                        result = self.process_request(request, savepath)
+                except ScratchQuotaExceeded:
+                    logger.error('Scratch space full, rejecting request')
+                    result = json.dumps(self.make_scratch_full_response(request))
+
+                if request_span is not None:
+                    request_span.set_attribute('tomaat.response_bytes', len(result))
+
+            return result
+        finally:
+            self.export_trace(context)
+
+    def start_trace(self):
+        """
+        Attach a trace to the context of the request processed by the current thread, if tracing is configured
+        (config field 'trace_file' or 'trace_collector_url', see tomaat.tracing)
+        :return: RequestContext of the request, None if the request is not traced
+        """
+        context = current_context()
+
+        if self.span_exporter is None or context is None:
+            return None
+
+        context.trace = Trace(context.request_id)
+
+        return context
+
+    def request_span_attributes(self, context):
+        if context is None:
+            return {}
+
+        return {
+            'tomaat.request_id': context.request_id,
+            'tomaat.priority': context.priority,
+            'tomaat.queue_seconds': time.time() - context.received,
+        }
+
+    def export_trace(self, context):
+        """
+        Export the trace of a request, in the background with the exporters of make_span_exporter. Errors are logged
+        and do not affect the request
+        :type context: RequestContext context returned by start_trace, nothing is exported if None
+        """
+        if context is None or context.trace is None:
+            return
+
+        try:
+            self.span_exporter.export(context.trace, self.config.get('name', 'tomaat'))
+        except:
+            traceback.print_exc()
+            logger.error('ERROR while exporting the trace of request {}'.format(context.request_id))
+
+    def watch_scratch(self, context, savepath):
+        """
+        Check the request quota of the scratch space at every checkpoint of the request, so that files written by the
+        transforms (e.g. memory-mapped arrays) are bounded as well
+        :type context: RequestContext context of the request, nothing is done if None
+        :type savepath: str scratch directory of the request
+        """
+        if context is not None and self.scratch.request_quota is not None:
+            context.scratch_check = lambda: self.scratch.check(savepath)
+
+    def make_scratch_full_response(self, request):
+        """
+        Create the response to a request received while the scratch space is full, with status 503 and Retry-After
+        :type request: Request request sent by the client
+        :return: response to be returned to client
+        """
+        request.setResponseCode(503)
+        request.setHeader('Retry-After', str(self.admission.retry_after))
+
+        return self.make_error_response('The service is out of scratch space, retry later')
+
+    def make_scratch_quota_response(self):
+        """
+        Create the response to a request that wrote more than the request quota in its scratch directory
+        :return: response to be returned to client
+        """
+        logger.error('Request exceeds the scratch quota')
+
+        return self.make_error_response('The request exceeds the scratch space quota')
 
-        os.mkdir(savepath)
+    def process_request(self, request, savepath):
+        return json.dumps(self.process_request_message(request, savepath))
 
+    def process_request_message(self, request, savepath):
+        """
+        Parse a request, run the app on it and create the response, stopping at the first failing step
+        :type request: Request request sent by the client
+        :type savepath: str scratch directory of the request
+        :return: response to be returned to client, an error message if a step failed
+        """
         try:
-            data = self.parse_request(request, savepath)
+            with span('parse_request', **{'tomaat.request_bytes': payload_size(request.args)}):
+                data = self.parse_request(request, savepath)
+
+            self.scratch.check(savepath)
+        except ScratchQuotaExceeded:
+            return self.make_scratch_quota_response()
         except:
             traceback.print_exc()
             logger.error('Server-side ERROR during request parsing')
-            response = self.make_error_response('Server-side ERROR during request parsing')
-            return json.dumps(response)
+            return self.make_error_response('Server-side ERROR during request parsing')
 
         try:
-            transformed_result = self.app(data, gpu_lock=self.gpu_lock)
+            transformed_result = self.run_app(data)
+        except RequestCancelled:
+            logger.warn('Request cancelled during processing')
+            return self.make_error_response('The request was cancelled')
+        except ScratchQuotaExceeded:
+            return self.make_scratch_quota_response()
+        except DeadlineExceeded:
+            logger.error('Request deadline expired before inference')
+            return self.make_error_response('The deadline of the request expired before inference')
         except:
             traceback.print_exc()
             logger.error('Server-side ERROR during processing')
-            response = self.make_error_response('Server-side ERROR during processing')
-            return json.dumps(response)
+            return self.make_error_response('Server-side ERROR during processing')
 
         try:
-            response = self.make_response(transformed_result, savepath)
+            with span('make_response'):
+                response = self.make_response(transformed_result, savepath)
+        except ScratchQuotaExceeded:
+            return self.make_scratch_quota_response()
         except:
             traceback.print_exc()
             logger.error('Server-side ERROR during response message creation')
-            response = self.make_error_response('Server-side ERROR during response message creation')
-            return json.dumps(response)
+            return self.make_error_response('Server-side ERROR during response message creation')
 
-        shutil.rmtree(savepath)
-        
-        return json.dumps(response)
+        return response
 
     def run(self):
         endpoint_specification = self.config.get("endpoint_specification",None)
 
+        if 'reactor_threads' in self.config:
+            reactor.suggestThreadPoolSize(self.config['reactor_threads'])
+
+        reactor.callWhenRunning(self.pools.start)
+        reactor.callWhenRunning(self.warm_up)
+        reactor.callWhenRunning(self.start_upload_expiry)
+        reactor.callWhenRunning(self.start_scratch_janitor)
+
         self.klein_app.run(port=self.config['port'], host='0.0.0.0', endpoint_description=endpoint_specification)
         reactor.run()
 
@@ -439,6 +1206,14 @@ class TomaatServiceDelayedResponse(TomaatService):
     multiprocess_manager = Manager()
 
     result_dict = multiprocess_manager.dict()
+    progress_dict = multiprocess_manager.dict()
+    # JSON size of the entries of result_dict and progress_dict, measured when they are stored
+    result_bytes = multiprocess_manager.dict()
+    progress_bytes = multiprocess_manager.dict()
+    profile_window = multiprocess_manager.dict()
+    profile_results = multiprocess_manager.dict()
+    profile_started = multiprocess_manager.Event()
+    memory_records = multiprocess_manager.list()
     reqest_list = multiprocess_manager.list()
 
     multiprocess_lock = Lock()
@@ -449,65 +1224,270 @@ class TomaatServiceDelayedResponse(TomaatService):
         super(TomaatServiceDelayedResponse, self).__init__(**kwargs)
         self.no_concurrent_thread_execution = no_concurrent_thread_execution
 
+        # delayed request id -> event shared with the process of the request, set to cancel it
+        self.cancel_events = {}
+
+        # delayed request id -> process of the request, holding the admission slot of the request until it exits
+        self.delayed_processes = {}
+
+        # delayed request id -> scratch directory of the request, released by this process once the worker exits
+        self.delayed_savepaths = {}
+
+        self.delayed_process_task = None
+
+        if self.profiler is not None:
+            # the worker processes join the profiles through the shared window
+            self.profiler = SamplingProfiler(
+                window=self.profile_window, results=self.profile_results, started=self.profile_started
+            )
+
     def received_data_handler(self, request):
-        req_id = str(uuid.uuid4()).replace('-', '')
+        context = current_context() or RequestContext(request_id=new_request_id())
 
-        savepath = os.path.join(tempfile.gettempdir(), req_id)
+        # the process is tracked under the id of the request, see release_admission
+        req_id = context.request_id
 
-        os.mkdir(savepath)
+        try:
+            savepath = self.scratch.allocate()
+        except ScratchQuotaExceeded:
+            logger.error('Scratch space full, rejecting request')
+            return json.dumps(self.make_scratch_full_response(request))
+
+        # the request is processed in another process, the cancellation event must be shared with it
+        delayed_context = RequestContext(
+            request_id=req_id,
+            priority=context.priority,
+            deadline=context.deadline,
+            cancel_event=self.multiprocess_manager.Event()
+        )
 
         def processing_thread():
-            if self.no_concurrent_thread_execution:
-                self.multiprocess_lock.acquire()
+            set_current_context(delayed_context)
 
-            response = self.make_error_response('Server-side ERROR during processing')
+            delayed_context.progress_callback = lambda progress, partial_result: self.publish_progress(
+                req_id, savepath, progress, partial_result
+            )
 
-            try:
-                data = self.parse_request(request, savepath)
-            except:
-                traceback.print_exc()
-                logger.error('Server-side ERROR during request parsing')
+            self.watch_scratch(delayed_context, savepath)
 
-            try:
-                transformed_result = self.app(data, gpu_lock=self.gpu_lock)
-            except:
-                traceback.print_exc()
-                logger.error('Server-side ERROR during processing')
+            if self.profiler is not None:
+                ProfileWatcher(self.profile_window, self.profile_results, self.profile_started).start()
+
+            if self.memory is not None:
+                # the records of the worker processes are collected by the service process, see memory_stats
+                self.memory.on_record = self.memory_records.append
+
+            traced_context = self.start_trace()
 
             try:
-                response = self.make_response(transformed_result, savepath)
-            except:
-                traceback.print_exc()
-                logger.error('Server-side ERROR during response message creation')
+                with span('request', kind=SPAN_KIND_SERVER, **self.request_span_attributes(traced_context)), \
+                        account(self.memory):
+                    if self.no_concurrent_thread_execution:
+                        self.multiprocess_lock.acquire()
 
-            response = [{
-                'type': 'PlainText',
-                'content': 'The results of your earlier request {} have been received'.format(req_id),
-                'label': ''
-            }] + response
+                    try:
+                        if delayed_context.cancelled():
+                            return
+
+                        response = self.process_request_message(request, savepath)
+
+                        response = [{
+                            'type': 'PlainText',
+                            'content': 'The results of your earlier request {} have been received'.format(req_id),
+                            'label': ''
+                        }] + response
 
-            self.result_dict[req_id] = response
+                        if not delayed_context.cancelled():
+                            self.store_result(req_id, response)
+                    finally:
+                        self.scratch.release(savepath)
 
-            shutil.rmtree(savepath)
+                        if self.no_concurrent_thread_execution:
+                            self.multiprocess_lock.release()
+            finally:
+                self.export_trace(traced_context)
 
-            if self.no_concurrent_thread_execution:
-                self.multiprocess_lock.release()
+                if traced_context is not None:
+                    # the worker process exits with the request, wait for the export of its trace
+                    self.span_exporter.flush()
+
+        self.cancel_events[req_id] = delayed_context.cancel_event
+        self.store_progress(req_id, {'progress': 0., 'response': []})
 
         delegated_process = Process(target=processing_thread, args=())
         delegated_process.start()
 
+        self.delayed_processes[req_id] = delegated_process
+        self.delayed_savepaths[req_id] = savepath
+
         self.reqest_list.append(req_id)
 
-        response = [{'type': 'DelayedResponse', 'request_id': req_id}]
+        return json.dumps(self.make_delayed_response(req_id))
 
-        return json.dumps(response)
+    def request_in_flight(self, request_id):
+        """
+        A delayed request is in flight until its result has been fetched or it has been cancelled
+        """
+        return request_id in self.contexts or request_id in self.cancel_events or request_id in self.delayed_processes
+
+    def release_admission(self, context):
+        """
+        A request handed over to a worker process keeps its admission slot until the process exits (see
+        check_delayed_processes), so that the number of worker processes and of their scratch directories is bounded
+        by the admission limits
+        :type context: RequestContext context of the request
+        """
+        if context.request_id not in self.delayed_processes:
+            self.admission.release()
+
+    def check_delayed_processes(self):
+        """
+        Reap the worker processes that exited, give back their admission slots and release their scratch directories,
+        which the workers remove themselves unless they crashed
+        :return: int number of reaped processes
+        """
+        reaped = 0
+
+        for req_id, process in list(self.delayed_processes.items()):
+            if process.is_alive():
+                continue
+
+            process.join()
+
+            del self.delayed_processes[req_id]
+            self.admission.release()
+
+            savepath = self.delayed_savepaths.pop(req_id, None)
+            if savepath is not None:
+                self.scratch.release(savepath)
+
+            reaped += 1
+
+        return reaped
+
+    def start_delayed_process_check(self):
+        self.delayed_process_task = LoopingCall(self.check_delayed_processes)
+        self.delayed_process_task.start(DELAYED_PROCESS_CHECK_INTERVAL)
+
+    def run(self):
+        reactor.callWhenRunning(self.start_delayed_process_check)
+
+        super(TomaatServiceDelayedResponse, self).run()
+
+    def cancel_request(self, request_id):
+        """
+        Cancel a prediction request. A delayed request is forgotten: its progress and result are discarded and its
+        process stops at the next checkpoint, removing its temporary files. See TomaatService.cancel_request
+        :type request_id: str identifier of the request, as returned in the DelayedResponse element
+        :return: bool True if the request was found
+        """
+        cancel_event = self.cancel_events.pop(request_id, None)
+
+        if cancel_event is None:
+            return super(TomaatServiceDelayedResponse, self).cancel_request(request_id)
+
+        logger.info('cancelling delayed request {}'.format(request_id))
+
+        cancel_event.set()
+
+        if request_id in self.reqest_list:
+            self.reqest_list.remove(request_id)
+
+        self.forget_result(request_id)
+        self.forget_progress(request_id)
+
+        return True
+
+    def memory_stats(self):
+        while len(self.memory_records) > 0:
+            self.memory.add(self.memory_records.pop(0))
+
+        return super(TomaatServiceDelayedResponse, self).memory_stats()
+
+    def memory_state(self):
+        state = super(TomaatServiceDelayedResponse, self).memory_state()
+
+        # the sizes are measured when the entries are stored, the entries themselves are not copied
+        result_bytes = self.result_bytes.values()
+        progress_bytes = self.progress_bytes.values()
+
+        state.update({
+            'delayed_requests': len(self.reqest_list),
+            'delayed_processes': len(self.delayed_processes),
+            'delayed_results': len(result_bytes),
+            'delayed_results_bytes': sum(result_bytes),
+            'delayed_progress': len(progress_bytes),
+            'delayed_progress_bytes': sum(progress_bytes),
+            'cancel_events': len(self.cancel_events),
+        })
+
+        return state
+
+    def store_result(self, req_id, response):
+        """
+        Store the final response of a delayed request, replacing its progress
+        """
+        self.result_dict[req_id] = response
+        self.result_bytes[req_id] = len(json.dumps(response))
+
+        self.forget_progress(req_id)
+
+    def store_progress(self, req_id, state):
+        self.progress_dict[req_id] = state
+        self.progress_bytes[req_id] = len(json.dumps(state))
+
+    def forget_result(self, req_id):
+        self.result_dict.pop(req_id, None)
+        self.result_bytes.pop(req_id, None)
+
+    def forget_progress(self, req_id):
+        self.progress_dict.pop(req_id, None)
+        self.progress_bytes.pop(req_id, None)
+
+    def publish_progress(self, req_id, savepath, progress, partial_result=None):
+        """
+        Store the progress of a delayed request, and the response created from its partial result if any, so that
+        polling /responses returns them until the final result is available
+        :type req_id: str identifier of the delayed request
+        :type savepath: str directory of the temporary files of the request
+        :type progress: float fraction of the work done, between 0 and 1
+        :type partial_result: dict partial result containing the fields of the output interface, or None
+        """
+        state = self.progress_dict.get(req_id, {'progress': 0., 'response': []})
+
+        response = state['response']
+
+        if partial_result is not None:
+            try:
+                response = self.make_response(partial_result, savepath)
+            except:
+                traceback.print_exc()
+                logger.error('Server-side ERROR during partial response message creation')
+
+        self.store_progress(req_id, {'progress': progress, 'response': response})
+
+    def make_delayed_response(self, req_id):
+        """
+        Create the response to a poll of a delayed request that is not complete: a DelayedResponse element with the
+        progress of the request and a 'complete' flag set to False, followed by the latest partial response, if any
+        :type req_id: str identifier of the delayed request
+        :return: response to be returned to client
+        """
+        state = self.progress_dict.get(req_id, {'progress': 0., 'response': []})
+
+        return [{
+            'type': 'DelayedResponse',
+            'request_id': req_id,
+            'progress': state['progress'],
+            'complete': False
+        }] + state['response']
 
     @klein_app.route('/interface', methods=['GET'])
     def interface(self, request):
         request.setHeader('Access-Control-Allow-Origin', '*')
         request.setHeader('Access-Control-Allow-Methods', 'GET')
         request.setHeader('Access-Control-Allow-Headers', '*')
-        request.setHeader('Access-Control-Max-Age', 2520)  # 42 hours
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
 
         return json.dumps(self.input_interface)
 
@@ -517,11 +1497,59 @@ class TomaatServiceDelayedResponse(TomaatService):
         request.setHeader('Access-Control-Allow-Origin', '*')
         request.setHeader('Access-Control-Allow-Methods', 'POST')
         request.setHeader('Access-Control-Allow-Headers', '*')
-        request.setHeader('Access-Control-Max-Age', 2520)  # 42 hours
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
 
-        logger.info('predicting...')
+        result = yield self.dispatch_prediction(request)
+
+        returnValue(write_body(request, result))
+
+    @klein_app.route('/healthz', methods=['GET'])
+    def healthz(self, request):
+        return self.health_data_handler(request)
+
+    @klein_app.route('/readyz', methods=['GET'])
+    def readyz(self, request):
+        return self.readiness_data_handler(request)
+
+    @klein_app.route('/metrics', methods=['GET'])
+    @inlineCallbacks
+    def metrics(self, request):
+        # collecting the metrics walks the scratch space and, with delayed responses, talks to the manager process
+        result = yield self.pools.defer('admin', self.metrics_data_handler, request)
+
+        returnValue(result)
+
+    @klein_app.route('/admin/profile', methods=['GET'])
+    @inlineCallbacks
+    def profile(self, request):
+        result = yield self.pools.defer('admin', self.profile_data_handler, request)
 
-        result = yield threads.deferToThread(self.received_data_handler, request)
+        returnValue(result)
+
+    @klein_app.route('/uploads', methods=['POST'])
+    @inlineCallbacks
+    def create_upload(self, request):
+        result = yield self.pools.defer('uploads', self.create_upload_data_handler, request)
+
+        returnValue(result)
+
+    @klein_app.route('/cancel', methods=['POST'])
+    def cancel(self, request):
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Access-Control-Allow-Methods', 'POST')
+        request.setHeader('Access-Control-Allow-Headers', '*')
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
+
+        return self.cancel_data_handler(request)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['GET'])
+    def upload_status(self, request, upload_id):
+        return self.upload_status_data_handler(request, upload_id)
+
+    @klein_app.route('/uploads/<upload_id>', methods=['PUT'])
+    @inlineCallbacks
+    def upload_chunk(self, request, upload_id):
+        result = yield self.pools.defer('uploads', self.upload_chunk_data_handler, request, upload_id)
 
         returnValue(result)
 
@@ -531,19 +1559,16 @@ class TomaatServiceDelayedResponse(TomaatService):
         request.setHeader('Access-Control-Allow-Origin', '*')
         request.setHeader('Access-Control-Allow-Methods', 'POST')
         request.setHeader('Access-Control-Allow-Headers', '*')
-        request.setHeader('Access-Control-Max-Age', 2520)  # 42 hours
+        request.setHeader('Access-Control-Max-Age', '2520')  # 42 hours
 
         logger.info('getting responses...')
 
-        result = yield threads.deferToThread(self.responses_data_handler, request)
+        result = yield self.pools.defer('responses', lambda: encode_body(self.responses_data_handler(request)))
 
-        returnValue(result)
+        returnValue(write_body(request, result))
 
     def responses_data_handler(self, request):
-        req_id = request.args['request_id'][0]
-
-        print(req_id)
-        print(self.reqest_list)
+        req_id = to_str(request.args[b'request_id'][0])
 
         if req_id not in self.reqest_list:
             response = [{
@@ -557,14 +1582,27 @@ class TomaatServiceDelayedResponse(TomaatService):
         try:
             response = self.result_dict[req_id]
             #removing content of list and dict
-            del self.result_dict[req_id]
+            self.forget_result(req_id)
             self.reqest_list.remove(req_id)
+            self.cancel_events.pop(req_id, None)
         except KeyError:
-            response = [{'type': 'DelayedResponse', 'request_id': req_id}]
+            response = self.make_delayed_response(req_id)
 
 
         return json.dumps(response)
 
+def to_str(raw):
+    """
+    Convert the raw value of a POST field into a string
+    """
+    if sys.version_info.major == 2:
+        return str(raw)
+    else:
+        try:
+            return raw.decode("utf-8")
+        except:
+            return raw
+
 # base64 utils
 def __base64_decode__(data_in):
     if sys.version_info.major == 2:
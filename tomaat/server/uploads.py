@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from .encoding import StreamingDecompressor, VOLUME_CODECS
+from .scratch import ScratchQuotaExceeded
+
+
+UPLOAD_EXPIRY = 3600  # seconds without activity after which an upload is discarded
+UPLOAD_REFERENCE_PREFIX = 'upload:'
+UPLOAD_SPOOL_DIRECTORY = 'tomaat_uploads'
+
+READ_SIZE = 1024 * 1024
+
+
+class UploadNotFound(KeyError):
+    pass
+
+
+class UploadOffsetMismatch(ValueError):
+    def __init__(self, expected):
+        super(UploadOffsetMismatch, self).__init__('expected offset {}'.format(expected))
+        self.expected = expected
+
+
+class UploadIncomplete(ValueError):
+    pass
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UploadSpool(object):
+    """
+    An UploadSpool stores the data of resumable uploads. Each upload is a pair of files in the spool directory:
+    <upload_id>.part, holding the bytes received so far, and <upload_id>.json, holding the expected size and codec.
+    Keeping the state on disk makes it visible to every process of the service, including delayed-response workers.
+    """
+    def __init__(self, root=None, expiry=UPLOAD_EXPIRY):
+        """
+        :type root: str directory of the spool, by default a tomaat_uploads directory in the system temp directory
+        :type expiry: int seconds without activity after which an upload is discarded
+        """
+        super(UploadSpool, self).__init__()
+        self.root = root if root is not None else os.path.join(tempfile.gettempdir(), UPLOAD_SPOOL_DIRECTORY)
+        self.expiry = expiry
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def _paths(self, upload_id):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id):
+            raise UploadNotFound(upload_id)
+
+        part = os.path.join(self.root, upload_id + '.part')
+        info = os.path.join(self.root, upload_id + '.json')
+
+        if not os.path.exists(part) or not os.path.exists(info):
+            raise UploadNotFound(upload_id)
+
+        return part, info
+
+    def create(self, size, codec=None):
+        """
+        Open a new upload session
+        :type size: int total number of bytes that will be uploaded
+        :type codec: str codec used to compress the uploaded file (see tomaat.server.encoding), None if uncompressed
+        :return: str upload id
+        """
+        if codec is not None and codec not in VOLUME_CODECS:
+            raise ValueError('unsupported codec {}'.format(codec))
+
+        upload_id = str(uuid.uuid4()).replace('-', '')
+
+        with open(os.path.join(self.root, upload_id + '.json'), 'w') as f:
+            json.dump({'size': int(size), 'codec': codec, 'created': time.time()}, f)
+
+        open(os.path.join(self.root, upload_id + '.part'), 'wb').close()
+
+        return upload_id
+
+    def status(self, upload_id):
+        """
+        :type upload_id: str upload id
+        :return: dict containing upload_id, offset (bytes received so far), size and complete
+        """
+        part, info = self._paths(upload_id)
+
+        with open(info) as f:
+            size = json.load(f)['size']
+
+        offset = os.path.getsize(part)
+
+        return {'upload_id': upload_id, 'offset': offset, 'size': size, 'complete': offset >= size}
+
+    def write(self, upload_id, offset, data):
+        """
+        Append a chunk to an upload. Chunks must be sent in order: the offset must match the bytes received so far,
+        and the chunk must not go past the size declared when the upload was created
+        :type upload_id: str upload id
+        :type offset: int position of the chunk in the uploaded file
+        :type data: bytes content of the chunk
+        :return: int new offset
+        """
+        part, info = self._paths(upload_id)
+
+        with open(info) as f:
+            size = json.load(f)['size']
+
+        with self.lock:
+            current = os.path.getsize(part)
+
+            if offset != current:
+                raise UploadOffsetMismatch(current)
+
+            if offset + len(data) > size:
+                raise UploadTooLarge('upload {} is limited to {} bytes'.format(upload_id, size))
+
+            with open(part, 'ab') as f:
+                f.write(data)
+
+            return current + len(data)
+
+    def claim(self, upload_id, destination, max_size=None):
+        """
+        Move a completed upload to destination, decompressing it if needed. The upload is removed from the spool.
+        The destination can be on another filesystem than the spool.
+        :type upload_id: str upload id
+        :type destination: str path of the file to be created
+        :type max_size: int maximum number of bytes of the claimed file, None for no limit. ScratchQuotaExceeded is
+        raised, before the file is complete, if the upload is larger
+        :return: int number of bytes the upload took in the spool
+        """
+        part, info = self._paths(upload_id)
+
+        with open(info) as f:
+            metadata = json.load(f)
+
+        size = os.path.getsize(part)
+
+        if size < metadata['size']:
+            raise UploadIncomplete(upload_id)
+
+        if metadata['codec'] is None:
+            if max_size is not None and size > max_size:
+                raise ScratchQuotaExceeded('upload {} is larger than {} bytes'.format(upload_id, max_size))
+
+            shutil.move(part, destination)
+        else:
+            decompressor = StreamingDecompressor(metadata['codec'])
+            written = 0
+
+            with open(part, 'rb') as f_in, open(destination, 'wb') as f_out:
+                for data in itertools.chain(iter(lambda: f_in.read(READ_SIZE), b''), [None]):
+                    data = decompressor.decompress(data) if data is not None else decompressor.flush()
+
+                    written += len(data)
+                    if max_size is not None and written > max_size:
+                        raise ScratchQuotaExceeded('upload {} is larger than {} bytes'.format(upload_id, max_size))
+
+                    f_out.write(data)
+
+            os.remove(part)
+
+        os.remove(info)
+
+        return size
+
+    def expire(self):
+        """
+        Remove the uploads without activity for longer than the expiry time
+        :return: int number of removed uploads
+        """
+        now = time.time()
+        removed = 0
+
+        for filename in os.listdir(self.root):
+            if not filename.endswith('.json'):
+                continue
+
+            upload_id = filename[:-len('.json')]
+
+            part = os.path.join(self.root, upload_id + '.part')
+            info = os.path.join(self.root, filename)
+
+            try:
+                last_activity = os.path.getmtime(part) if os.path.exists(part) else os.path.getmtime(info)
+
+                if now - last_activity > self.expiry:
+                    for path in [part, info]:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    removed += 1
+            except OSError:
+                pass  # claimed or removed concurrently
+
+        return removed
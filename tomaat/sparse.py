@@ -0,0 +1,111 @@
+import base64
+
+import numpy as np
+import SimpleITK as sitk
+
+
+'''
+Sparse encoding of label volumes, used by SparseLabelVolume outputs.
+
+Segmentations are mostly background. Instead of a compressed image file, a label volume is sent as its geometry, the
+bounding box of the labelled voxels and a run-length encoding of the voxels in the bounding box (in the order of the
+array returned by sitk.GetArrayFromImage, that is x varying fastest):
+
+    {
+        'size': [x, y, z], 'spacing': [...], 'origin': [...], 'direction': [...], 'dtype': 'uint8',
+        'bbox': [[x_start, x_stop], [y_start, y_stop], [z_start, z_stop]] or None if all voxels are 0,
+        'values': base64 of the value of each run, little endian, of type dtype,
+        'lengths': base64 of the length of each run, little endian uint32,
+    }
+
+Both encoding and decoding are whole-array numpy operations.
+'''
+
+
+def bounding_box(mask, margin=0):
+    '''
+    :param mask: numpy boolean array
+    :param margin: number of voxels added around the bounding box, within the array
+    :return: tuple of slices of the bounding box of the non zero voxels, None if there are none
+    '''
+    region = []
+
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+
+        if indices.size == 0:
+            return None
+
+        region.append(slice(max(indices[0] - margin, 0), min(indices[-1] + 1 + margin, mask.shape[axis])))
+
+    return tuple(region)
+
+
+def encode_sparse_label_volume(volume):
+    '''
+    :param volume: SimpleITK label volume
+    :return: dict sparse encoding of the volume
+    '''
+    array = sitk.GetArrayViewFromImage(volume)
+
+    content = {
+        'size': [int(s) for s in volume.GetSize()],
+        'spacing': list(volume.GetSpacing()),
+        'origin': list(volume.GetOrigin()),
+        'direction': list(volume.GetDirection()),
+        'dtype': array.dtype.name,
+        'bbox': None,
+        'values': '',
+        'lengths': '',
+    }
+
+    region = bounding_box(array)
+
+    if region is None:
+        return content
+
+    flat = np.ascontiguousarray(array[region]).ravel()
+
+    starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+    lengths = np.diff(np.append(starts, flat.size))
+
+    # the array is indexed z, y, x while the bounding box follows the order of the image size
+    content['bbox'] = [[int(r.start), int(r.stop)] for r in region[::-1]]
+    content['values'] = _encode_array(flat[starts], array.dtype)
+    content['lengths'] = _encode_array(lengths, np.uint32)
+
+    return content
+
+
+def decode_sparse_label_volume(content):
+    '''
+    :param content: dict sparse encoding of a label volume, as produced by encode_sparse_label_volume
+    :return: SimpleITK label volume
+    '''
+    dtype = np.dtype(content['dtype'])
+
+    array = np.zeros(content['size'][::-1], dtype=dtype)
+
+    if content['bbox'] is not None:
+        region = tuple(slice(start, stop) for start, stop in content['bbox'][::-1])
+
+        values = _decode_array(content['values'], dtype)
+        lengths = _decode_array(content['lengths'], np.uint32)
+
+        array[region] = np.repeat(values, lengths).reshape(array[region].shape)
+
+    volume = sitk.GetImageFromArray(array)
+    volume.SetSpacing(content['spacing'])
+    volume.SetOrigin(content['origin'])
+    volume.SetDirection(content['direction'])
+
+    return volume
+
+
+def _encode_array(array, dtype):
+    return base64.b64encode(np.asarray(array, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()).decode('ascii')
+
+
+def _decode_array(data, dtype):
+    return np.frombuffer(base64.b64decode(data), dtype=np.dtype(dtype).newbyteorder('<')).astype(dtype)
@@ -0,0 +1,327 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+
+try:
+    # For Python 3.0 and later
+    import queue
+except ImportError:
+    # Fall back to Python 2's Queue
+    import Queue as queue
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from .context import current_context
+
+
+'''
+Per-request tracing. A Trace attached to the RequestContext of a request (context.trace) records spans: named,
+timed sections of the work, nested in each other, with attributes such as payload sizes. The service opens spans
+around request parsing, the phases of the TomaatApp and response creation, and TransformChain opens one around each
+transform. Code running without a trace pays only the lookup of the context.
+
+Finished traces are exported in the OpenTelemetry protocol JSON encoding (OTLP/JSON), either appended to a file, one
+JSON document per line as the file exporter of the OpenTelemetry collector does, or posted to the /v1/traces endpoint
+of a local collector. Exports happen in a background thread, off the threads serving the requests.
+'''
+
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+TRACE_SCOPE = 'tomaat'
+COLLECTOR_TIMEOUT = 2  # seconds
+EXPORT_QUEUE_SIZE = 1000  # traces waiting for export, further traces are dropped
+
+
+class Span(object):
+    def __init__(self, name, span_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        '''
+        Span is a timed section of the work done for a request
+        :param name: name of the span
+        :param span_id: 16 hex digits identifier of the span
+        :param parent_id: identifier of the enclosing span, None for the root span
+        :param kind: SPAN_KIND_SERVER for the root span of a request, SPAN_KIND_INTERNAL otherwise
+        :param attributes: dict of attributes, values are str, bool, int or float
+        '''
+        super(Span, self).__init__()
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.status = STATUS_OK
+        self.message = ''
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self, trace_id):
+        span = {
+            'traceId': trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int((self.end if self.end is not None else time.time()) * 1e9)),
+            'attributes': [otlp_attribute(key, value) for key, value in sorted(self.attributes.items())],
+            'status': {'code': self.status, 'message': self.message} if self.message else {'code': self.status},
+        }
+
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+
+        return span
+
+
+class Trace(object):
+    def __init__(self, request_id=None):
+        '''
+        Trace collects the spans of a request
+        :param request_id: identifier of the request, used as trace id when it is made of 32 hex digits
+        '''
+        super(Trace, self).__init__()
+        self.request_id = request_id
+        self.trace_id = request_id if is_trace_id(request_id) else uuid.uuid4().hex
+        self.spans = []
+        self.stack = []
+        self.lock = threading.Lock()
+
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        with self.lock:
+            parent_id = self.stack[-1].span_id if self.stack else None
+
+            span = Span(name, uuid.uuid4().hex[:16], parent_id=parent_id, kind=kind, attributes=attributes)
+
+            self.spans.append(span)
+            self.stack.append(span)
+
+        return span
+
+    def end_span(self, span):
+        with self.lock:
+            span.end = time.time()
+
+            if span in self.stack:
+                self.stack.remove(span)
+
+    def to_otlp(self, service_name):
+        '''
+        :param service_name: name of the service, exported as the service.name resource attribute
+        :return: dict OTLP/JSON ExportTraceServiceRequest containing the spans of the trace
+        '''
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [otlp_attribute('service.name', service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': TRACE_SCOPE},
+                    'spans': [span.to_otlp(self.trace_id) for span in self.spans],
+                }],
+            }]
+        }
+
+
+class FileSpanExporter(object):
+    def __init__(self, filename):
+        '''
+        FileSpanExporter appends each trace to a file, as one line of OTLP/JSON
+        :param filename: path of the file
+        '''
+        super(FileSpanExporter, self).__init__()
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def export(self, trace, service_name):
+        line = json.dumps(trace.to_otlp(service_name)) + '\n'
+
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+    def flush(self):
+        pass  # exports are synchronous
+
+
+class CollectorSpanExporter(object):
+    def __init__(self, url, timeout=COLLECTOR_TIMEOUT):
+        '''
+        CollectorSpanExporter posts each trace to an OpenTelemetry collector receiving OTLP/HTTP with JSON encoding
+        :param url: URL of the traces endpoint of the collector, for example http://localhost:4318/v1/traces
+        :param timeout: seconds after which the export is abandoned
+        '''
+        super(CollectorSpanExporter, self).__init__()
+        self.url = url
+        self.timeout = timeout
+
+    def export(self, trace, service_name):
+        import requests
+
+        requests.post(
+            self.url,
+            data=json.dumps(trace.to_otlp(service_name)),
+            headers={'Content-Type': 'application/json'},
+            timeout=self.timeout
+        )
+
+    def flush(self):
+        pass  # exports are synchronous
+
+
+class BackgroundSpanExporter(object):
+    def __init__(self, exporter, max_queued=EXPORT_QUEUE_SIZE):
+        '''
+        BackgroundSpanExporter hands the traces over to a thread exporting them with another exporter, so that a slow
+        file system or collector does not delay the responses. Traces are dropped while max_queued traces are waiting.
+        The thread is started on the first export of each process, so that forked worker processes get their own.
+        :param exporter: exporter doing the export, e.g. a CollectorSpanExporter
+        :param max_queued: maximum number of traces waiting for export
+        '''
+        super(BackgroundSpanExporter, self).__init__()
+        self.exporter = exporter
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.dropped = 0
+
+    def _start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.max_queued)
+
+                thread = threading.Thread(target=self._run, args=(self.queue,))
+                thread.daemon = True
+                thread.start()
+
+                self.pid = os.getpid()
+
+        return self.queue
+
+    def _run(self, traces):
+        while True:
+            trace, service_name = traces.get()
+
+            try:
+                self.exporter.export(trace, service_name)
+            except:
+                traceback.print_exc()
+            finally:
+                traces.task_done()
+
+    def export(self, trace, service_name):
+        try:
+            self._start().put_nowait((trace, service_name))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        '''
+        Wait until the traces exported so far by this process are exported, e.g. before the process exits
+        '''
+        if self.pid == os.getpid():
+            self.queue.join()
+
+
+def make_span_exporter(config):
+    '''
+    :param config: dict service configuration, with 'trace_file' or 'trace_collector_url'
+    :return: span exporter exporting in the background, None if tracing is not configured
+    '''
+    if config.get('trace_collector_url'):
+        return BackgroundSpanExporter(CollectorSpanExporter(config['trace_collector_url']))
+
+    if config.get('trace_file'):
+        return BackgroundSpanExporter(FileSpanExporter(config['trace_file']))
+
+    return None
+
+
+def is_trace_id(value):
+    if value is None or len(value) != 32:
+        return False
+
+    return all(c in '0123456789abcdef' for c in value) and value != '0' * 32
+
+
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, (int, np.integer)):
+        typed = {'intValue': str(int(value))}
+    elif isinstance(value, (float, np.floating)):
+        typed = {'doubleValue': float(value)}
+    else:
+        typed = {'stringValue': str(value)}
+
+    return {'key': key, 'value': typed}
+
+
+def payload_size(value):
+    '''
+    Number of bytes of the arrays and images held by value, as far as they can be found in dicts, lists and tuples
+    :param value: data dictionary or part of it
+    :return: int number of bytes
+    '''
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+
+    if isinstance(value, dict):
+        return sum(payload_size(v) for v in value.values())
+
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+
+    if isinstance(value, bytes):
+        return len(value)
+
+    if hasattr(value, 'GetNumberOfPixels') and hasattr(value, 'GetSizeOfPixelComponent'):
+        return int(value.GetNumberOfPixels() * value.GetNumberOfComponentsPerPixel() * value.GetSizeOfPixelComponent())
+
+    return 0
+
+
+def current_trace():
+    context = current_context()
+
+    return getattr(context, 'trace', None)
+
+
+@contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    '''
+    Record the enclosed work as a span of the trace of the request bound to the current thread, if any
+    :param name: name of the span
+    :param kind: kind of the span
+    :param attributes: attributes of the span
+    :return: the Span, or None if the request is not traced
+    '''
+    trace = current_trace()
+
+    if trace is None:
+        yield None
+        return
+
+    current = trace.start_span(name, kind=kind, attributes=attributes)
+
+    try:
+        yield current
+    except BaseException as e:
+        current.status = STATUS_ERROR
+        current.message = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        trace.end_span(current)